@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Memory of a large scheduler backlog of article requests
+#
+# Builds the article requests of a whole crawl (journals > volumes > issues
+# > articles) the way the download spiders queue them, before (a meta dict
+# copied at every level) and after (journal.context.CrawlContext children
+# sharing their ancestors), and reports the memory held per pending request.
+#
+# Usage (from the project folder):
+#   python benchmarks/crawl_context.py [--journals 20] [--volumes 5] [--issues 12] [--articles 40]
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrapy import Request  # noqa: E402
+
+from journal.context import JournalContext  # noqa: E402
+
+
+def article_url(journal, volume, issue, article):
+    return 'https://onlinelibrary.wiley.com/doi/10.1002/j{}.{}.{}.{}'.format(journal, volume, issue, article)
+
+
+def backlog_before(args):
+    # meta dicts as the callbacks copied them
+    requests = []
+    for journal in range(args.journals):
+        meta = {'journal_name': 'Journal of Testing number {}'.format(journal)}
+        for volume in range(args.volumes):
+            meta['volume_title'] = '{} - Volume {}'.format(2020 - volume, 50 - volume)
+            volume_meta = dict(meta)
+            issue_meta = {'journal_name': volume_meta['journal_name'], 'volume_title': volume_meta['volume_title']}
+            for issue in range(args.issues):
+                issue_meta['issue_number'] = 'Volume {}, Issue {}'.format(50 - volume, issue + 1)
+                response_meta = dict(issue_meta, pause=True)
+                article_meta = {
+                    'journal_name': response_meta['journal_name'],
+                    'volume_title': response_meta['volume_title'],
+                    'issue_number': response_meta['issue_number'],
+                }
+                for article in range(args.articles):
+                    url = article_url(journal, volume, issue, article)
+                    article_meta['article_key'] = 'doi:' + url.split('/doi/')[1]
+                    article_meta['article_title'] = 'Article title number {} of the issue'.format(article)
+                    requests.append(Request(url, dont_filter=True, meta=dict(article_meta, pause=True)))
+    return requests
+
+
+def backlog_after(args):
+    requests = []
+    for journal in range(args.journals):
+        journal_context = JournalContext(journal_name='Journal of Testing number {}'.format(journal))
+        for volume in range(args.volumes):
+            volume_context = journal_context.child(volume_title='{} - Volume {}'.format(2020 - volume, 50 - volume))
+            for issue in range(args.issues):
+                issue_context = volume_context.child(issue_number='Volume {}, Issue {}'.format(50 - volume, issue + 1))
+                for article in range(args.articles):
+                    url = article_url(journal, volume, issue, article)
+                    context = issue_context.child(
+                        article_title='Article title number {} of the issue'.format(article),
+                        article_key='doi:' + url.split('/doi/')[1],
+                    )
+                    requests.append(Request(url, dont_filter=True, meta={'context': context, 'pause': True}))
+    return requests
+
+
+def measure(build, args):
+    gc.collect()
+    tracemalloc.start()
+    requests = build(args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(requests), current
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--journals', type=int, default=20)
+    parser.add_argument('--volumes', type=int, default=5)
+    parser.add_argument('--issues', type=int, default=12)
+    parser.add_argument('--articles', type=int, default=40)
+    args = parser.parse_args()
+
+    count, before = measure(backlog_before, args)
+    count, after = measure(backlog_after, args)
+    print('{} pending article requests'.format(count))
+    print('{:<10} {:>12} {:>14}'.format('', 'total MB', 'bytes/request'))
+    print('{:<10} {:>12.1f} {:>14.0f}'.format('before', before / 1024.0 / 1024, before / count))
+    print('{:<10} {:>12.1f} {:>14.0f}'.format('after', after / 1024.0 / 1024, after / count))
+    print('saved {:.0f} bytes/request ({:.0%})'.format((before - after) / count, 1 - after / float(before)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# HTML fixtures for the offline benchmarks
+#
+# Every fixture is a page of a publisher (Wiley, Taylor & Francis) or of the
+# carleton.ca library shaped like the real one: same markup around the parts
+# the spiders select and some unrelated markup around it. A page recorded
+# from the site (saved from the browser or with open_in_browser) and saved as
+# benchmarks/fixtures/<name>.html is used instead of the generated one.
+#
+#   python benchmarks/fixtures.py      # writes the generated pages to benchmarks/fixtures/
+
+import os
+import os.path
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+FILLER = '<div class="filler"><p>Lorem <b>ipsum</b> dolor sit amet, <a href="#">consectetur</a></p><ul><li><a href="#">link</a></li><li>item</li></ul></div>'
+
+
+def page(body, title='Journal', filler=200):
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title></head>'
+        '<body><header>{filler}</header><main>{body}</main><footer>{filler}</footer></body></html>'
+    ).format(title=title, body=body, filler=FILLER * (filler // 2))
+
+
+# Wiley
+
+def wiley_journal():
+    volumes = ''.join('<li><a href="/loi/1234567x/year/{0}">{0} - Volume {1}</a></li>'.format(2020 - i, 50 - i) for i in range(30))
+    return page('<h1 id="journal-banner-text">Journal of Testing</h1><ul class="rlist loi__list">{}</ul>'.format(volumes))
+
+
+def wiley_volume():
+    issues = ''.join('<li><h4><a href="/toc/1234567x/2020/50/{0}">Volume 50, Issue {0}</a></h4></li>'.format(i) for i in range(1, 13))
+    return page('<ul class="rlist loi__issues">{}</ul>'.format(issues))
+
+
+def wiley_issue(articles=50):
+    return page(''.join(
+        '<div class="issue-item"><a href="/doi/10.1002/jot.{0}"><h2>Article <i>title</i> number {0}</h2></a>'
+        '<ul class="rlist--inline"><li>Author {0}</li></ul></div>'.format(i) for i in range(articles)
+    ))
+
+
+def wiley_article():
+    return page(
+        '<div class="coolBar__second rlist"><ul><li><a class="coolBar__ctrl pdf-download" title="Article PDF" href="/doi/pdf/10.1002/jot.1">PDF</a></li>'
+        '<li><a href="/action/showCitFormats?doi=10.1002%2Fjot.1">Export citation</a></li></ul></div>'
+        '<article>{}</article>'.format(FILLER * 100)
+    )
+
+
+def wiley_citation():
+    return page(
+        '<form action="/action/downloadCitation" method="post"><input type="hidden" name="doi" value="10.1002/jot.1">'
+        '<input type="radio" name="format" value="ris" checked><input type="radio" name="include" value="cit" checked>'
+        '<input type="submit" value="Download"></form>'
+    )
+
+
+def wiley_discipline(journals=20):
+    items = ''.join(
+        '<li class="search__item"><div class="meta__header"><h3><a href="/journal/{0}">Journal number {0}</a></h3>'
+        '{1}</div><div class="meta__details"><a class="meta__date" href="#">1990</a> - <a class="meta__date" href="#">2020</a></div></li>'.format(
+            i, '<span class="meta__title__currentVersion">Now: <a href="/journal/new{0}">New journal {0}</a></span>'.format(i) if i % 5 == 0 else '')
+        for i in range(journals)
+    )
+    return page('<ul class="search-result">{}</ul><div class="pagination"><span><a title="Next page" href="/action/doSearch?startPage=2">Next</a></span></div>'.format(items))
+
+
+def wiley_discipline_journal():
+    return page(
+        '<div class="journal-info"><span>Impact factor:</span><span>2.345</span>'
+        '<span>ISI Journal Citation Reports © Ranking:</span><span>2019: 12/123 (Testing)</span><span>2019: 40/200 (Science)</span>'
+        '<span>Online ISSN:</span><span>1234-5678</span></div>'
+    )
+
+
+# Taylor & Francis
+
+def taylor_journal():
+    volumes = ''.join('<li class="vol_li "><a href="/loi/tjot20?open={0}"><h3>Volume {1} {0}</h3></a></li>'.format(2020 - i, 50 - i) for i in range(30))
+    return page('<ul class="list-of-issues">{}</ul>'.format(volumes), title='Journal of Testing: Vol 50')
+
+
+def taylor_volume():
+    issues = ''.join('<li><a href="/toc/tjot20/50/{0}"><div class="issue-num">Issue {0}</div></a></li>'.format(i) for i in range(1, 13))
+    return page('<ul class="list-of-issues"><li class="vol_li active"><ul>{}</ul></li></ul>'.format(issues))
+
+
+def taylor_issue(articles=30):
+    return page(''.join(
+        '<table class="articleEntry"><tr><td><div class="art_title linkable"><a href="/doi/full/10.1080/tjot.{0}"><span>Article title {0}</span></a></div></td></tr></table>'.format(i)
+        for i in range(articles)
+    ))
+
+
+def taylor_article():
+    return page(
+        '<a class="show-pdf" href="/doi/pdf/10.1080/tjot.1">PDF</a>'
+        '<ul><li class="downloadCitations"><a href="/action/showCitFormats?doi=10.1080/tjot.1">Download citation</a></li></ul>'
+        '<article>{}</article>'.format(FILLER * 100)
+    )
+
+
+def taylor_discipline(journals=1000):
+    # Discipline search with &pageSize=1000
+    return page(''.join(
+        '<article class="searchResultItem"><h4 class="art_title hlFld-Title"><a href="/toc/tj{0}/current">Journal number {0}</a></h4>'
+        '<div class="publicationMeta">Published since 1990</div></article>'.format(i)
+        for i in range(journals)
+    ))
+
+
+def taylor_discipline_journal():
+    return page(
+        '<ul role="menulist"><li><a href="/action/journalInformation?journalCode=tjot20">Journal information</a></li>'
+        '<li><a href="/action/journalInformation?show=aimsScope&journalCode=tjot20">Aims and scope</a></li></ul>'
+    )
+
+
+def taylor_journal_information():
+    return page(
+        '<div><span>Print ISSN:</span> 1234-5678 </div><div><span>Online ISSN:</span> 8765-4321 </div>'
+        '<h3>Currently known as:</h3><ul><li>Journal of Testing  (2000 - current)</li></ul>'
+        '<h3>Formerly known as</h3><ul><li>Testing Quarterly (1990 - 1999)</li></ul>'
+    )
+
+
+def taylor_aims_and_scope():
+    return page('<h1>Aims and scope</h1><div>{}</div>'.format(''.join('<p>Aims paragraph {} about testing.</p>'.format(i) for i in range(10))))
+
+
+# carleton.ca
+
+def carleton_discipline(journals=200):
+    return page('<ul>{}</ul>'.format(''.join(
+        '<li><div class="journal"><div class="title"><a href="/journals/{0}">Journal number {0}</a></div></div></li>'.format(i)
+        for i in range(journals)
+    )))
+
+
+def carleton_journal_details():
+    return (
+        '<div id="journal-details"><h3>Journal of Testing</h3><div class="issn">ISSN: 1234-5678</div>'
+        '<div class="publisher"><a href="#">Wiley</a></div><div class="coverage">Coverage: 1990 - 2020</div>'
+        '<div class="description">  Journal   about testing.  </div></div>'
+        '<div style="margin: 0"><h4>Most Recent Issue: <span>Vol 50, Issue 2: 2020</span></h4></div>'
+    )
+
+
+def carleton_issue_list(articles):
+    return '<div id="result-list"><ol id="toc">{}</ol></div>'.format(''.join(
+        '<li class="journal-item row-{0}"><div class="journal-result"><h4><a href="/article/{0}"><span class="article-title"> Article title {0} </span></a></h4>'
+        '<div class="clear links"><a href="/pdf/{0}">{1}</a></div></div></li>'.format(i, 'PDF Download' if i % 10 else 'Find Full-Text @ My Library')
+        for i in range(articles)
+    ))
+
+
+def carleton_journal(articles=50):
+    years = ''.join(
+        '<div class="accordion-group"><h5>{0}</h5><ul>{1}</ul></div>'.format(
+            2020 - i, ''.join('<li><a href="/journals/1/issues/{0}-{1}">Issue {1}</a></li>'.format(2020 - i, n) for n in range(1, 5)))
+        for i in range(20)
+    )
+    return page(carleton_journal_details() + '<div id="issues">{}</div>'.format(years) + carleton_issue_list(articles))
+
+
+def carleton_issue(articles=100):
+    return page(carleton_journal_details() + carleton_issue_list(articles))
+
+
+def carleton_article():
+    return page(
+        '<div class="download-btn"><a href="/pdf/1">PDF Download</a></div>'
+        '<ul><li><a href="/ris/1">RIS (EndNote)</a></li></ul><article>{}</article>'.format(FILLER * 100)
+    )
+
+
+def carleton_discipline_journal():
+    return page(carleton_journal_details() + '<h3>Journal of Testing</h3><div class="linked-title"><span>Formerly</span> <a href="#">Testing Quarterly</a></div>')
+
+
+FIXTURES = {
+    'wiley_journal': wiley_journal,
+    'wiley_volume': wiley_volume,
+    'wiley_issue': wiley_issue,
+    'wiley_article': wiley_article,
+    'wiley_citation': wiley_citation,
+    'wiley_discipline': wiley_discipline,
+    'wiley_discipline_journal': wiley_discipline_journal,
+    'taylor_journal': taylor_journal,
+    'taylor_volume': taylor_volume,
+    'taylor_issue': taylor_issue,
+    'taylor_article': taylor_article,
+    'taylor_discipline_1000': taylor_discipline,
+    'taylor_discipline_journal': taylor_discipline_journal,
+    'taylor_journal_information': taylor_journal_information,
+    'taylor_aims_and_scope': taylor_aims_and_scope,
+    'carleton_discipline': carleton_discipline,
+    'carleton_discipline_journal': carleton_discipline_journal,
+    'carleton_journal': carleton_journal,
+    'carleton_issue': carleton_issue,
+    'carleton_article': carleton_article,
+}
+
+
+def fixture_path(name):
+    return os.path.join(FIXTURES_DIR, name + '.html')
+
+
+def load_fixture(name):
+    # Recorded page if there is one, generated page otherwise
+    path = fixture_path(name)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read(), 'recorded'
+    return FIXTURES[name]().encode('utf-8'), 'generated'
+
+
+def save_fixtures():
+    if not os.path.exists(FIXTURES_DIR):
+        os.makedirs(FIXTURES_DIR)
+    for name, build in sorted(FIXTURES.items()):
+        path = fixture_path(name)
+        if os.path.exists(path):
+            print('{} exists, skipped'.format(path))
+            continue
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(build())
+        print('{} written'.format(path))
+
+
+if __name__ == '__main__':
+    save_fixtures()
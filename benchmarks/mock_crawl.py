@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+# End-to-end crawl benchmark against the mock publishers
+#
+# Starts benchmarks/mock_server.py for the publishers of the selected
+# spiders, runs every spider over the whole mock corpus (project settings,
+# middlewares and pipelines, files in a temp folder) one after another and
+# reports articles/min, PDFs/min, RIS/min, re-logins and back offs. The
+# server options (latency, error rate, session expiry, corpus size) are the
+# ones of mock_server.py:
+#
+#   python benchmarks/mock_crawl.py --latency 0.2 --error-rate 0.02 --session-requests 200 --articles 20
+#   python benchmarks/mock_crawl.py --spiders taylor_francis_download_auth --set DOWNLOAD_DELAY=0
+#   python benchmarks/mock_crawl.py --page-cache /tmp/pagecache.sqlite   # twice, second run with a warm cache
+#
+# journal_issues and the discipline spiders render pages in the browser pool
+# and are not covered.
+
+import argparse
+import csv
+import json
+import os
+import os.path
+import socket
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from importlib import import_module
+from time import sleep, time
+from urllib.request import urlopen
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+MOCK_SERVER = os.path.join(ROOT_DIR, 'benchmarks', 'mock_server.py')
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'journal.settings')
+
+from scrapy.crawler import CrawlerProcess  # noqa: E402
+from scrapy.utils.project import get_project_settings  # noqa: E402
+from twisted.internet import defer  # noqa: E402
+
+from benchmarks.mock_server import DEFAULT_PORTS, add_server_arguments, journal_urls  # noqa: E402
+
+# Spider name: (spider module, spider class, mock publisher)
+SPIDERS = {
+    'wiley_download_auth': ('wiley_download_auth', 'WileyDownloadAuthSpider', 'wiley'),
+    'wiley_download_auth_light': ('wiley_download_auth_light', 'WileyDownloadAuthLightSpider', 'wiley'),
+    'taylor_francis_download_auth': ('taylor_francis_download_auth', 'TaylorFrancisDownloadAuthSpider', 'taylor'),
+}
+
+
+def server_argv(server_parser, args):
+    # Server options of the driver command line, for the server command line
+    argv = []
+    for dest in vars(server_parser.parse_args([])):
+        argv += ['--' + dest.replace('_', '-'), str(getattr(args, dest))]
+    return argv
+
+
+def start_server(publisher, port, argv):
+    server = subprocess.Popen([sys.executable, MOCK_SERVER, '--publisher', publisher, '--port', str(port)] + argv)
+    deadline = time() + 10
+    while time() < deadline:
+        # Port may be taken by another server
+        if server.poll() is not None:
+            break
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            sleep(0.1)
+    server.kill()
+    raise RuntimeError('Mock {} server did not start on port {}'.format(publisher, port))
+
+
+def server_stats(port):
+    with urlopen('http://127.0.0.1:{}/_mock/stats'.format(port)) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def prepare_spider(name, port, journals, work_dir):
+    # Spider class reading journals.csv, writing ledger, logs and files in work_dir
+    module_name, class_name, publisher = SPIDERS[name]
+    spider_module = import_module('journal.spiders.' + module_name)
+    spider_dir = os.path.join(work_dir, name)
+    os.makedirs(spider_dir)
+
+    csv_file = os.path.join(spider_dir, 'journals.csv')
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Journal_URL'])
+        writer.writerows([url] for url in journal_urls(port, journals))
+
+    spider_module.CSV_FILE_WITH_URLS = csv_file
+    spider_module.LEDGER_FILE = os.path.join(spider_dir, 'download_ledger.sqlite')
+    spider_module.LOG_FOLDER = os.path.join(spider_dir, 'logs')
+    for attribute in dir(spider_module):
+        if attribute.startswith('LOG_FILE_'):
+            setattr(spider_module, attribute, os.path.join(spider_module.LOG_FOLDER, os.path.basename(getattr(spider_module, attribute))))
+
+    spider_cls = getattr(spider_module, class_name)
+    custom_settings = dict(spider_cls.custom_settings, FILES_STORE=os.path.join(spider_dir, 'downloads'))
+    return type(class_name, (spider_cls,), {'custom_settings': custom_settings})
+
+
+def crawl_result(name, crawler, expected_articles, server_before, server_after):
+    stats = crawler.stats.get_stats()
+    elapsed = (stats['finish_time'] - stats['start_time']).total_seconds()
+    articles = stats.get('item_scraped_count', 0)
+    pdfs = stats.get('file_status_count/downloaded', 0)
+    ris = stats.get('ris/written', 0)
+    return {
+        'spider': name,
+        'finish_reason': stats.get('finish_reason'),
+        'elapsed_sec': round(elapsed, 3),
+        'expected_articles': expected_articles,
+        'articles': articles,
+        'pdfs': pdfs,
+        'ris': ris,
+        'articles_per_min': round(articles / elapsed * 60, 2),
+        'pdfs_per_min': round(pdfs / elapsed * 60, 2),
+        'ris_per_min': round(ris / elapsed * 60, 2),
+        'requests': stats.get('downloader/request_count', 0),
+        'response_bytes': stats.get('downloader/response_bytes', 0),
+        'retries': stats.get('retry/count', 0),
+        'relogins': stats.get('session/relogins', 0),
+        'backoffs': sum(value for key, value in stats.items() if key.startswith('adaptive/') and key.endswith('/backoffs')),
+        'errors': stats.get('log_count/ERROR', 0),
+        'toc_only_fallbacks': stats.get('toc_only/fallbacks', 0),
+        'pdf_validation': {key.split('/', 1)[1]: value for key, value in stats.items() if key.startswith('pdf_validation/')},
+        'page_cache': {key.split('/', 1)[1]: value for key, value in stats.items() if key.startswith('pagecache/')},
+        'server': {key: server_after[key] - server_before.get(key, 0) for key in server_after if key not in ('sessions', 'uptime')},
+    }
+
+
+def print_results(results):
+    print('{:<30} {:>8} {:>9} {:>6} {:>6} {:>10} {:>8} {:>8} {:>8} {:>8}'.format(
+        'spider', 'seconds', 'articles', 'pdfs', 'ris', 'articles/m', 'pdfs/m', 'relogins', 'backoffs', 'retries'))
+    for result in results:
+        print('{:<30} {:>8.1f} {:>4}/{:<4} {:>6} {:>6} {:>10.1f} {:>8.1f} {:>8} {:>8} {:>8}'.format(
+            result['spider'], result['elapsed_sec'], result['articles'], result['expected_articles'], result['pdfs'], result['ris'],
+            result['articles_per_min'], result['pdfs_per_min'], result['relogins'], result['backoffs'], result['retries']))
+
+
+def main():
+    server_parser = argparse.ArgumentParser(add_help=False)
+    add_server_arguments(server_parser)
+    parser = argparse.ArgumentParser(parents=[server_parser])
+    parser.add_argument('--spiders', nargs='+', choices=sorted(SPIDERS), default=sorted(SPIDERS))
+    parser.add_argument('--min-pause', type=int, default=0, help='spider min_p (pause before articles and issues)')
+    parser.add_argument('--max-pause', type=int, default=0, help='spider max_p')
+    parser.add_argument('--toc-only', action='store_true', help='spider toc_only (PDF links built from the issue TOC)')
+    parser.add_argument('--page-cache', help='page cache file kept between runs (default: a new one in the work folder)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='project setting override')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--output', help='results JSON file (default: benchmarks/results/mock-crawl-<time>.json)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='journal-mock-crawl-')
+    settings = get_project_settings()
+    settings.set('JOURNALS_STORAGE', os.path.join(work_dir, 'ris'))
+    settings.set('LOG_LEVEL', args.log_level)
+    settings.set('TELNETCONSOLE_ENABLED', False)
+    settings.set('PAGE_CACHE_FILE', os.path.abspath(args.page_cache) if args.page_cache else os.path.join(work_dir, 'pagecache.sqlite'))
+    settings.set('METRICS_SNAPSHOT_FILE', os.path.join(work_dir, '%(name)s.prom'))
+    for override in args.set:
+        name, value = override.split('=', 1)
+        settings.set(name, value)
+
+    publishers = sorted(set(SPIDERS[name][2] for name in args.spiders))
+    servers = {publisher: start_server(publisher, DEFAULT_PORTS[publisher], server_argv(server_parser, args)) for publisher in publishers}
+    expected_articles = args.journals * args.years * args.issues * args.articles
+    process = CrawlerProcess(settings)
+    results = []
+
+    @defer.inlineCallbacks
+    def crawl_all():
+        try:
+            for name in args.spiders:
+                port = DEFAULT_PORTS[SPIDERS[name][2]]
+                crawler = process.create_crawler(prepare_spider(name, port, args.journals, work_dir))
+                server_before = server_stats(port)
+                yield process.crawl(crawler, limit_years=None, limit_issues=None, limit_articles=None, min_p=args.min_pause, max_p=args.max_pause, toc_only=args.toc_only)
+                results.append(crawl_result(name, crawler, expected_articles, server_before, server_stats(port)))
+        finally:
+            # Installed by Scrapy along with the first crawler, importing it
+            # earlier would install the default reactor instead
+            from twisted.internet import reactor
+            if reactor.running:
+                reactor.stop()
+            else:
+                # Failed before process.start()
+                reactor.callWhenRunning(reactor.stop)
+
+    crawl_all()
+    try:
+        process.start(stop_after_crawl=False)
+    finally:
+        for server in servers.values():
+            server.terminate()
+            server.wait()
+
+    print_results(results)
+
+    now = datetime.now()
+    output = args.output or os.path.join(RESULTS_DIR, 'mock-crawl-{}.json'.format(now.strftime('%Y%m%d-%H%M%S')))
+    if not os.path.exists(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'benchmark': 'mock_crawl',
+            'time': now.isoformat(timespec='seconds'),
+            'server': {dest: getattr(args, dest) for dest in vars(server_parser.parse_args([]))},
+            'settings': args.set,
+            'work_dir': work_dir,
+            'results': results,
+        }, f, indent=2)
+    print('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
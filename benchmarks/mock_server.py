@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+
+# Local stand-in of the library proxy and of a publisher site
+#
+# Serves a generated corpus (journals > years > issues > articles) with the
+# markup of Wiley (loi__list, loi__issues, issue-item, showCitFormats,
+# downloadCitation) or of Taylor & Francis (list-of-issues, articleEntry,
+# show-pdf, downloadCitations) behind the carleton.ca proxy login form
+# (form#mc1 posting to /login), plus PDF endpoints. Pages are answered after
+# a configurable latency, with an ETag answering If-None-Match with a 304;
+# errors (503), session expiry, corpus size, PDF size and bandwidth are
+# configurable too:
+#
+#   python benchmarks/mock_server.py --publisher wiley --port 8101 --latency 0.2 --error-rate 0.02 --session-requests 200
+#
+# Journal URLs are http://127.0.0.1:<port>/loi/mj<n> (n from 1), server
+# counters are served as JSON at /_mock/stats. The reactor is imported
+# where it is used, benchmarks/mock_crawl.py imports this module before
+# Scrapy installs its own.
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+from time import time
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+from twisted.web import http
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import FILLER, page  # noqa: E402
+
+PUBLISHERS = ('wiley', 'taylor')
+DEFAULT_PORTS = {'wiley': 8101, 'taylor': 8102}
+DOI_PREFIXES = {'wiley': '10.1002', 'taylor': '10.1080'}
+
+SESSION_COOKIE = b'mock_session'
+LATEST_YEAR = 2020
+LATEST_VOLUME = 50
+CHUNK_SIZE = 64 * 1024
+
+LOGIN_FORM = (
+    '<form id="mc1" action="/login" method="post"><input type="hidden" name="url" value="{url}">'
+    '<input type="text" name="user"><input type="password" name="pass"><input type="submit" value="Login"></form>'
+)
+
+
+def add_server_arguments(parser):
+    # Shared with the driver (benchmarks/mock_crawl.py)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds before every answer')
+    parser.add_argument('--jitter', type=float, default=0.05, help='latency +- this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 answers')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After of the 503 answers (0 - none)')
+    parser.add_argument('--session-ttl', type=float, default=0, help='seconds a login session lasts (0 - forever)')
+    parser.add_argument('--session-requests', type=int, default=0, help='requests a login session lasts (0 - forever)')
+    parser.add_argument('--journals', type=int, default=2)
+    parser.add_argument('--years', type=int, default=2, help='volumes per journal')
+    parser.add_argument('--issues', type=int, default=2, help='issues per volume')
+    parser.add_argument('--articles', type=int, default=10, help='articles per issue')
+    parser.add_argument('--pdf-size', type=int, default=200, help='PDF size in KB')
+    parser.add_argument('--drop-pdf-after', type=int, default=0, help='close the connection of the first download of every PDF after this many KB (0 - never)')
+    parser.add_argument('--pdf-login-rate', type=float, default=0.0, help='share of PDFs whose first download ends the session and gets the login page as application/pdf')
+    parser.add_argument('--bandwidth', type=int, default=0, help='PDF download speed in KB/s per request (0 - unlimited)')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def make_pdf(doi, size):
+    header = '%PDF-1.4\n% Mock article {}\n'.format(doi).encode('utf-8')
+    trailer = b'\n%%EOF\n'
+    filler = b'0123456789abcdef' * (max(0, size - len(header) - len(trailer)) // 16 + 1)
+    return header + filler[:max(0, size - len(header) - len(trailer))] + trailer
+
+
+def make_ris(doi, title, journal):
+    return '\r\n'.join([
+        'TY  - JOUR', 'TI  - {}'.format(title), 'JO  - {}'.format(journal), 'DO  - {}'.format(doi),
+        'UR  - https://doi.org/{}'.format(doi), 'ER  - ', '',
+    ]).encode('utf-8')
+
+
+class MockPublisher(Resource):
+    # One publisher site behind the proxy login. Every path but /login and
+    # /_mock/stats needs the session cookie set by a POST to /login, without
+    # it (or once it expired) the request is redirected to /login?url=<path>
+    # like the proxy does.
+    isLeaf = True
+
+    def __init__(self, publisher, options):
+        Resource.__init__(self)
+        self.publisher = publisher
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.sessions = {}
+        self.pdfs = {}
+        self.dropped_pdfs = set()
+        self.login_pdfs = set()
+        self.stats = dict.fromkeys([
+            'requests', 'pages', 'not_modified', 'login_pages', 'logins', 'sessions_expired', 'redirects_to_login',
+            'errors', 'not_found', 'citations', 'citation_records', 'pdfs', 'pdf_bytes', 'pdf_resumes', 'pdf_drops',
+            'pdf_login_pages',
+        ], 0)
+        self.started = time()
+
+    # Corpus
+
+    def journal_name(self, code):
+        return 'Mock Journal {}'.format(code[2:])
+
+    def journal_exists(self, code):
+        return code.startswith('mj') and code[2:].isdigit() and 1 <= int(code[2:]) <= self.options.journals
+
+    def volumes(self):
+        # (year, volume) newest first
+        return [(LATEST_YEAR - i, LATEST_VOLUME - i) for i in range(self.options.years)]
+
+    def doi(self, code, volume, issue, article):
+        return '{}/{}.{}.{}.{}'.format(DOI_PREFIXES[self.publisher], code, volume, issue, article)
+
+    def parse_doi(self, doi):
+        # DOI -> (journal code, volume, issue, article) or None
+        try:
+            code, volume, issue, article = doi.split('/', 1)[1].split('.')
+            volume, issue, article = int(volume), int(issue), int(article)
+        except ValueError:
+            return None
+        if not self.journal_exists(code) or not 0 <= LATEST_VOLUME - volume < self.options.years:
+            return None
+        if not 1 <= issue <= self.options.issues or not 1 <= article <= self.options.articles:
+            return None
+        return code, volume, issue, article
+
+    def article_title(self, volume, issue, article):
+        return 'Article {} of volume {} issue {}'.format(article, volume, issue)
+
+    # Request handling
+
+    def render(self, request):
+        self.stats['requests'] += 1
+        path = request.path.decode('utf-8')
+
+        if path == '/_mock/stats':
+            request.setHeader(b'Content-Type', b'application/json')
+            return json.dumps(dict(self.stats, sessions=len(self.sessions), uptime=round(time() - self.started, 3))).encode('utf-8')
+
+        if path == '/login':
+            return self.delay(request, self.render_login)
+
+        if not self.has_session(request):
+            self.stats['redirects_to_login'] += 1
+            request.setResponseCode(302)
+            request.setHeader(b'Location', '/login?url={}'.format(quote(request.uri.decode('utf-8'), safe='')).encode('utf-8'))
+            return b''
+
+        if self.random.random() < self.options.error_rate:
+            return self.delay(request, self.render_error)
+
+        return self.delay(request, self.render_page)
+
+    def delay(self, request, render):
+        from twisted.internet import reactor
+
+        latency = max(0.0, self.random.uniform(self.options.latency - self.options.jitter, self.options.latency + self.options.jitter))
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        reactor.callLater(latency, self.answer, request, render, finished)
+        return NOT_DONE_YET
+
+    def answer(self, request, render, finished):
+        from twisted.internet import reactor
+
+        # Client went away while waiting
+        if finished:
+            return
+        body = render(request)
+        request.setHeader(b'Content-Length', str(len(body)).encode('ascii'))
+        drop_after = getattr(request, 'drop_after', 0)
+        if drop_after and not self.options.bandwidth:
+            # Proxy dropping the connection partway, once the bytes are out
+            request.write(body[:drop_after])
+            reactor.callLater(0.2, request.channel.transport.abortConnection)
+        elif self.options.bandwidth and len(body) > CHUNK_SIZE:
+            self.write_chunk(request, body, 0, finished)
+        else:
+            request.write(body)
+            request.finish()
+
+    def write_chunk(self, request, body, offset, finished):
+        from twisted.internet import reactor
+
+        if finished:
+            return
+        chunk = body[offset:offset + CHUNK_SIZE]
+        request.write(chunk)
+        if getattr(request, 'drop_after', 0) and offset + CHUNK_SIZE >= request.drop_after:
+            reactor.callLater(0.2, request.channel.transport.abortConnection)
+            return
+        if offset + CHUNK_SIZE >= len(body):
+            request.finish()
+            return
+        reactor.callLater(len(chunk) / (self.options.bandwidth * 1024.0), self.write_chunk, request, body, offset + CHUNK_SIZE, finished)
+
+    def has_session(self, request):
+        token = request.getCookie(SESSION_COOKIE)
+        session = self.sessions.get(token)
+        if session is None:
+            return False
+
+        session['requests'] += 1
+        ttl_expired = self.options.session_ttl and time() - session['created'] > self.options.session_ttl
+        requests_expired = self.options.session_requests and session['requests'] > self.options.session_requests
+        if ttl_expired or requests_expired:
+            del self.sessions[token]
+            self.stats['sessions_expired'] += 1
+            return False
+        return True
+
+    def render_login(self, request):
+        url = unquote(request.args.get(b'url', [b'/'])[0].decode('utf-8'))
+        if request.method == b'POST' and request.args.get(b'user') and request.args.get(b'pass'):
+            token = uuid4().hex
+            self.sessions[token.encode('ascii')] = {'created': time(), 'requests': 0}
+            self.stats['logins'] += 1
+            request.addCookie(SESSION_COOKIE, token, path='/')
+            request.setResponseCode(302)
+            request.setHeader(b'Location', url.encode('utf-8'))
+            return b''
+
+        self.stats['login_pages'] += 1
+        return self.html(request, page(LOGIN_FORM.format(url=url), title='Carleton University Library Login', filler=20))
+
+    def render_error(self, request):
+        self.stats['errors'] += 1
+        request.setResponseCode(503)
+        if self.options.retry_after:
+            request.setHeader(b'Retry-After', str(self.options.retry_after).encode('ascii'))
+        return self.html(request, page('<h1>Service Unavailable</h1>', title='Service Unavailable', filler=0))
+
+    def render_not_found(self, request):
+        self.stats['not_found'] += 1
+        request.setResponseCode(404)
+        return self.html(request, page('<h1>Page not found</h1>', title='Page not found', filler=0))
+
+    def render_page(self, request):
+        path = request.path.decode('utf-8')
+        args = {key.decode('utf-8'): values[0].decode('utf-8') for key, values in request.args.items()}
+
+        if path == '/action/showCitFormats' and self.parse_doi(args.get('doi', '')):
+            return self.html(request, self.citation_page(args['doi']))
+        dois = [doi.decode('utf-8') for doi in request.args.get(b'doi', [])]
+        if path == '/action/downloadCitation' and request.method == b'POST' and dois and all(map(self.parse_doi, dois)):
+            return self.citation(request, dois)
+        if path.startswith('/doi/pdf/') and self.parse_doi(path[len('/doi/pdf/'):]):
+            return self.pdf(request, path[len('/doi/pdf/'):])
+
+        body = None
+        if self.publisher == 'wiley':
+            body = self.wiley_page(path.strip('/').split('/'))
+        elif self.publisher == 'taylor':
+            body = self.taylor_page(path.strip('/').split('/'), args)
+
+        if body is None:
+            return self.render_not_found(request)
+
+        # Corpus pages never change, If-None-Match gets a 304
+        etag = '"{}"'.format(hashlib.md5(body.encode('utf-8')).hexdigest()).encode('ascii')
+        if request.setETag(etag) == http.CACHED:
+            self.stats['not_modified'] += 1
+            return b''
+        self.stats['pages'] += 1
+        return self.html(request, body)
+
+    def html(self, request, body):
+        request.setHeader(b'Content-Type', b'text/html; charset=utf-8')
+        return body.encode('utf-8')
+
+    def citation_page(self, doi):
+        return page(
+            '<form action="/action/downloadCitation" method="post"><input type="hidden" name="doi" value="{}">'
+            '<input type="radio" name="format" value="ris" checked><input type="radio" name="include" value="cit" checked>'
+            '<input type="submit" value="Download"></form>'.format(doi)
+        )
+
+    def citation(self, request, dois):
+        # One record per doi field, like the Atypon batch export
+        records = []
+        for doi in dois:
+            code, volume, issue, article = self.parse_doi(doi)
+            records.append(make_ris(doi, self.article_title(volume, issue, article), self.journal_name(code)))
+        self.stats['citations'] += 1
+        self.stats['citation_records'] += len(records)
+        request.setHeader(b'Content-Type', b'application/x-research-info-systems')
+        request.setHeader(b'Content-Disposition', 'attachment; filename={}.ris'.format(dois[0].replace('/', '_')).encode('utf-8'))
+        return b'\r\n'.join(records)
+
+    def pdf(self, request, doi):
+        if doi not in self.login_pdfs and self.random.random() < self.options.pdf_login_rate:
+            # Proxy which lost the session and answers with its login page
+            # under the Content-Type of the PDF
+            self.login_pdfs.add(doi)
+            self.sessions.pop(request.getCookie(SESSION_COOKIE), None)
+            self.stats['pdf_login_pages'] += 1
+            request.setHeader(b'Content-Type', b'application/pdf')
+            return page(LOGIN_FORM.format(url=request.uri.decode('utf-8')), title='Carleton University Library Login', filler=20).encode('utf-8')
+
+        if doi not in self.pdfs:
+            self.pdfs[doi] = make_pdf(doi, self.options.pdf_size * 1024)
+        body = self.pdfs[doi]
+        self.stats['pdfs'] += 1
+        request.setHeader(b'Content-Type', b'application/pdf')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        request.setHeader(b'ETag', etag.encode('ascii'))
+
+        # Rest of an interrupted download if the file didn't change
+        range_header = (request.getHeader('Range') or '').strip()
+        if_range = request.getHeader('If-Range')
+        if range_header.startswith('bytes=') and range_header.endswith('-') and if_range in (None, etag):
+            start = int(range_header[len('bytes='):-1])
+            if 0 < start < len(body):
+                self.stats['pdf_resumes'] += 1
+                request.setResponseCode(206)
+                request.setHeader(b'Content-Range', 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body)).encode('ascii'))
+                body = body[start:]
+
+        if self.options.drop_pdf_after and doi not in self.dropped_pdfs and len(body) > self.options.drop_pdf_after * 1024:
+            self.dropped_pdfs.add(doi)
+            self.stats['pdf_drops'] += 1
+            request.drop_after = self.options.drop_pdf_after * 1024
+            self.stats['pdf_bytes'] += request.drop_after
+        else:
+            self.stats['pdf_bytes'] += len(body)
+        return body
+
+    # Wiley
+
+    def wiley_page(self, parts):
+        # /loi/<journal>, /loi/<journal>/year/<year>, /toc/<journal>/<year>/<volume>/<issue>, /doi/<doi>
+        if parts[0] == 'loi' and len(parts) in (2, 4) and self.journal_exists(parts[1]):
+            if len(parts) == 2:
+                return self.wiley_journal(parts[1])
+            volumes = dict(self.volumes())
+            if parts[2] == 'year' and parts[3].isdigit() and int(parts[3]) in volumes:
+                return self.wiley_volume(parts[1], int(parts[3]), volumes[int(parts[3])])
+        if parts[0] == 'toc' and len(parts) == 5 and self.journal_exists(parts[1]):
+            if self.parse_doi(self.doi(parts[1], parts[3], parts[4], 1)):
+                return self.wiley_issue(parts[1], int(parts[3]), int(parts[4]))
+        if parts[0] == 'doi' and self.parse_doi('/'.join(parts[1:])):
+            return self.wiley_article('/'.join(parts[1:]))
+        return None
+
+    def wiley_journal(self, code):
+        volumes = ''.join('<li><a href="/loi/{0}/year/{1}">{1} - Volume {2}</a></li>'.format(code, year, volume) for year, volume in self.volumes())
+        return page('<h1 id="journal-banner-text">{}</h1><ul class="rlist loi__list">{}</ul>'.format(self.journal_name(code), volumes), filler=100)
+
+    def wiley_volume(self, code, year, volume):
+        issues = ''.join(
+            '<li><h4><a href="/toc/{0}/{1}/{2}/{3}">Volume {2}, Issue {3}</a></h4></li>'.format(code, year, volume, issue)
+            for issue in range(1, self.options.issues + 1)
+        )
+        return page('<ul class="rlist loi__issues">{}</ul>'.format(issues), filler=100)
+
+    def wiley_issue(self, code, volume, issue):
+        return page(''.join(
+            '<div class="issue-item"><a href="/doi/{0}"><h2>{1}</h2></a><ul class="rlist--inline"><li>Author {2}</li></ul></div>'.format(
+                self.doi(code, volume, issue, article), self.article_title(volume, issue, article), article)
+            for article in range(1, self.options.articles + 1)
+        ))
+
+    def wiley_article(self, doi):
+        return page(
+            '<div class="coolBar__second rlist"><ul><li><a class="coolBar__ctrl pdf-download" title="Article PDF" href="/doi/pdf/{0}">PDF</a></li>'
+            '<li><a href="/action/showCitFormats?doi={1}">Export citation</a></li></ul></div><article>{2}</article>'.format(doi, quote(doi, safe=''), FILLER * 100)
+        )
+
+    # Taylor & Francis
+
+    def taylor_page(self, parts, args):
+        # /loi/<journal>, /loi/<journal>?open=<year>, /toc/<journal>/<volume>/<issue>, /doi/full/<doi>
+        if parts[0] == 'loi' and len(parts) == 2 and self.journal_exists(parts[1]):
+            volumes = dict(self.volumes())
+            if 'open' not in args:
+                return self.taylor_journal(parts[1])
+            if args['open'].isdigit() and int(args['open']) in volumes:
+                return self.taylor_volume(parts[1], int(args['open']), volumes[int(args['open'])])
+        if parts[0] == 'toc' and len(parts) == 4 and self.journal_exists(parts[1]):
+            if self.parse_doi(self.doi(parts[1], parts[2], parts[3], 1)):
+                return self.taylor_issue(parts[1], int(parts[2]), int(parts[3]))
+        if parts[:2] == ['doi', 'full'] and self.parse_doi('/'.join(parts[2:])):
+            return self.taylor_article('/'.join(parts[2:]))
+        return None
+
+    def taylor_volumes(self, code, active=None):
+        volumes = []
+        for year, volume in self.volumes():
+            issues = ''
+            if year == active:
+                issues = '<ul>{}</ul>'.format(''.join(
+                    '<li><a href="/toc/{0}/{1}/{2}"><div class="issue-num">Issue {2}</div></a></li>'.format(code, volume, issue)
+                    for issue in range(1, self.options.issues + 1)
+                ))
+            volumes.append('<li class="vol_li {0}"><a href="/loi/{1}?open={2}"><h3>Volume {3} {2}</h3></a>{4}</li>'.format(
+                'active' if year == active else '', code, year, volume, issues))
+        return '<ul class="list-of-issues">{}</ul>'.format(''.join(volumes))
+
+    def taylor_journal(self, code):
+        return page(self.taylor_volumes(code), title='{}: Vol {}'.format(self.journal_name(code), LATEST_VOLUME), filler=100)
+
+    def taylor_volume(self, code, year, volume):
+        return page(self.taylor_volumes(code, active=year), title='{}: Vol {}'.format(self.journal_name(code), volume), filler=100)
+
+    def taylor_issue(self, code, volume, issue):
+        return page(''.join(
+            '<table class="articleEntry"><tr><td><div class="art_title linkable"><a href="/doi/full/{0}"><span>{1}</span></a></div></td></tr></table>'.format(
+                self.doi(code, volume, issue, article), self.article_title(volume, issue, article))
+            for article in range(1, self.options.articles + 1)
+        ))
+
+    def taylor_article(self, doi):
+        return page(
+            '<a class="show-pdf" href="/doi/pdf/{0}">PDF</a><ul><li class="downloadCitations"><a href="/action/showCitFormats?doi={0}">Download citation</a></li></ul>'
+            '<article>{1}</article>'.format(doi, FILLER * 100)
+        )
+
+
+def journal_urls(port, journals):
+    return ['http://127.0.0.1:{}/loi/mj{}'.format(port, n) for n in range(1, journals + 1)]
+
+
+def main():
+    from twisted.internet import reactor
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--publisher', choices=PUBLISHERS, default='wiley')
+    parser.add_argument('--port', type=int, help='default: 8101 (wiley), 8102 (taylor)')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    port = args.port or DEFAULT_PORTS[args.publisher]
+    reactor.listenTCP(port, Site(MockPublisher(args.publisher, args)), interface='127.0.0.1')
+    print('Mock {} on http://127.0.0.1:{}/ ({} journals)'.format(args.publisher, port, args.journals))
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
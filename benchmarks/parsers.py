@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+# Offline benchmark of the spider callbacks
+#
+# Feeds the fixture pages (benchmarks/fixtures.py) through every parse
+# callback of the spiders without network, proxy login or browser, and
+# reports per callback:
+#   responses/s, items/s, requests/s  - callback throughput incl. HTML parsing
+#   peak memory                        - tracemalloc peak of one response
+#   allocated bytes/blocks             - memory left allocated by one response
+#                                        (net of frees, incl. the outputs)
+# Results are saved as JSON to benchmarks/results/ so runs can be compared:
+#
+#   python benchmarks/parsers.py [--repeat 20] [--only wiley] [--compare benchmarks/results/<old>.json]
+
+import argparse
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from importlib import import_module
+from time import perf_counter
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'journal.settings')
+
+import lxml.etree  # noqa: E402
+import scrapy  # noqa: E402
+from scrapy.http import HtmlResponse, Request  # noqa: E402
+from scrapy.settings import Settings  # noqa: E402
+from scrapy.statscollectors import MemoryStatsCollector  # noqa: E402
+from scrapy.utils.project import get_project_settings  # noqa: E402
+from scrapy.utils.spider import iterate_spider_output  # noqa: E402
+
+from benchmarks.fixtures import load_fixture  # noqa: E402
+from journal.context import JournalContext  # noqa: E402
+from journal.events import EventSink  # noqa: E402
+from journal.items import JournalItem  # noqa: E402
+from journal.ledger import DownloadLedger  # noqa: E402
+from journal.snapshot import DisciplineSnapshot  # noqa: E402
+
+WILEY_VOLUME_CONTEXT = JournalContext(journal_name='Journal of Testing').child(volume_title='2020 - Volume 50')
+WILEY_ISSUE_CONTEXT = WILEY_VOLUME_CONTEXT.child(issue_number='Volume 50, Issue 1')
+WILEY_ARTICLE_CONTEXT = WILEY_ISSUE_CONTEXT.child(article_title='Article title number 1', article_key='doi:10.1002/jot.1')
+WILEY_VOLUME = {'context': WILEY_VOLUME_CONTEXT, 'cache_page': 'current_volume'}
+WILEY_ISSUE = {'context': WILEY_ISSUE_CONTEXT}
+WILEY_ARTICLE = {'context': WILEY_ARTICLE_CONTEXT}
+WILEY_CITATION = {'context': WILEY_ARTICLE_CONTEXT.child(pdf_url='https://onlinelibrary.wiley.com/doi/pdf/10.1002/jot.1', article_url='https://onlinelibrary.wiley.com/doi/10.1002/jot.1')}
+DISCIPLINE = {'Discipline_Tree': 'Science > Testing', 'Discipline_Name': 'Testing'}
+CARLETON_DISCIPLINE = {'Discipline Tree': 'Science > Testing', 'Discipline Name': 'Testing'}
+
+# (spider module, spider class, callback, fixture, url, meta)
+CASES = [
+    ('wiley_download_auth', 'WileyDownloadAuthSpider', 'parse_journal', 'wiley_journal', 'https://onlinelibrary.wiley.com/loi/1234567x', {}),
+    ('wiley_download_auth', 'WileyDownloadAuthSpider', 'parse_volume', 'wiley_volume', 'https://onlinelibrary.wiley.com/loi/1234567x/year/2020', WILEY_VOLUME),
+    ('wiley_download_auth', 'WileyDownloadAuthSpider', 'parse_issue', 'wiley_issue', 'https://onlinelibrary.wiley.com/toc/1234567x/2020/50/1', WILEY_ISSUE),
+    ('wiley_download_auth', 'WileyDownloadAuthSpider', 'parse_article', 'wiley_article', 'https://onlinelibrary.wiley.com/doi/10.1002/jot.1', WILEY_ARTICLE),
+    ('wiley_download_auth', 'WileyDownloadAuthSpider', 'parse_citation', 'wiley_citation', 'https://onlinelibrary.wiley.com/action/showCitFormats?doi=10.1002%2Fjot.1', WILEY_CITATION),
+    ('wiley_download_auth_light', 'WileyDownloadAuthLightSpider', 'parse_article', 'wiley_article', 'https://onlinelibrary.wiley.com/doi/10.1002/jot.1', WILEY_ARTICLE),
+    ('taylor_francis_download_auth', 'TaylorFrancisDownloadAuthSpider', 'parse_journal', 'taylor_journal', 'https://www.tandfonline.com/loi/tjot20', {}),
+    ('taylor_francis_download_auth', 'TaylorFrancisDownloadAuthSpider', 'parse_volume', 'taylor_volume', 'https://www.tandfonline.com/loi/tjot20?open=2020', WILEY_VOLUME),
+    ('taylor_francis_download_auth', 'TaylorFrancisDownloadAuthSpider', 'parse_issue', 'taylor_issue', 'https://www.tandfonline.com/toc/tjot20/50/1', WILEY_ISSUE),
+    ('taylor_francis_download_auth', 'TaylorFrancisDownloadAuthSpider', 'parse_article', 'taylor_article', 'https://www.tandfonline.com/doi/full/10.1080/tjot.1', WILEY_ARTICLE),
+    ('taylor_francis_download_auth', 'TaylorFrancisDownloadAuthSpider', 'parse_citation', 'wiley_citation', 'https://www.tandfonline.com/action/showCitFormats?doi=10.1080/tjot.1', WILEY_CITATION),
+    ('wiley_scrape_disciline', 'WileyScrapeDiscilineSpider', 'parse_discipline', 'wiley_discipline', 'https://onlinelibrary.wiley.com/action/doSearch?ConceptID=1', DISCIPLINE),
+    ('wiley_scrape_disciline', 'WileyScrapeDiscilineSpider', 'parse_journal', 'wiley_discipline_journal', 'https://onlinelibrary.wiley.com/journal/1',
+     dict(DISCIPLINE, Journal_Name='Journal number 1', Currently_known_as=None, Start_Year='1990', Latest_Year='2020')),
+    ('taylor_francis_scrape_discipline', 'TaylorFrancisScrapeDisciplineSpider', 'parse_discipline', 'taylor_discipline_1000', 'https://www.tandfonline.com/topic/allsubjects/te?target=topic&pageSize=1000', DISCIPLINE),
+    ('taylor_francis_scrape_discipline', 'TaylorFrancisScrapeDisciplineSpider', 'parse_journal', 'taylor_discipline_journal', 'https://www.tandfonline.com/toc/tj1/current',
+     dict(DISCIPLINE, Journal_Name='Journal number 1')),
+    ('taylor_francis_scrape_discipline', 'TaylorFrancisScrapeDisciplineSpider', 'parse_journal_information', 'taylor_journal_information', 'https://www.tandfonline.com/action/journalInformation?journalCode=tjot20',
+     dict(DISCIPLINE, Journal_Name='Journal number 1', Journal_URL='https://www.tandfonline.com/toc/tj1/current', Publisher='Taylor and Francis',
+          aims_and_scope_url='https://www.tandfonline.com/action/journalInformation?show=aimsScope&journalCode=tjot20')),
+    ('taylor_francis_scrape_discipline', 'TaylorFrancisScrapeDisciplineSpider', 'parse_aims_and_scope', 'taylor_aims_and_scope', 'https://www.tandfonline.com/action/journalInformation?show=aimsScope&journalCode=tjot20',
+     dict(DISCIPLINE, Journal_Name='Journal number 1', Journal_URL='https://www.tandfonline.com/toc/tj1/current', Publisher='Taylor and Francis')),
+    ('discipline', 'DisciplineSpider', 'parse', 'carleton_discipline', 'https://journals.scholarsportal.info.proxy.library.carleton.ca/browse/discipline/1', CARLETON_DISCIPLINE),
+    ('discipline', 'DisciplineSpider', 'parse_journal', 'carleton_discipline_journal', 'https://journals.scholarsportal.info.proxy.library.carleton.ca/browse/1', CARLETON_DISCIPLINE),
+    ('journal_issues', 'JournalIssuesSpider', 'parse', 'carleton_journal', 'https://journals.scholarsportal.info.proxy.library.carleton.ca/browse/1', {}),
+    ('journal_issues', 'JournalIssuesSpider', 'parse_issue', 'carleton_issue', 'https://journals.scholarsportal.info.proxy.library.carleton.ca/browse/1/v50i2',
+     {'issn': '12345678', 'journal_name': 'Journal of Testing'}),
+    ('journal_issues', 'JournalIssuesSpider', 'parse_article', 'carleton_article', 'https://journals.scholarsportal.info.proxy.library.carleton.ca/details/1',
+     {'issn': '12345678', 'journal_name': 'Journal of Testing', 'browser_cookies': [], 'item': None}),
+]
+
+
+class BenchmarkCrawler(object):
+    # What the callbacks use of the crawler
+    settings = Settings()
+
+    def __init__(self):
+        self.stats = MemoryStatsCollector(self)
+
+
+def make_spider(module, class_name, work_dir):
+    # Spider without __init__ side effects (ledger, logs in the project folder)
+    spider_module = import_module('journal.spiders.' + module)
+    log_folder = os.path.join(work_dir, module)
+    for attribute in dir(spider_module):
+        if attribute.startswith('LOG_FILE_'):
+            setattr(spider_module, attribute, os.path.join(log_folder, os.path.basename(getattr(spider_module, attribute))))
+    spider_cls = getattr(spider_module, class_name)
+    spider = spider_cls.__new__(spider_cls)
+    scrapy.Spider.__init__(spider)
+    spider.crawler = BenchmarkCrawler()
+    spider.settings = get_project_settings()
+    spider.use_auth = True
+    spider.limit_years = spider.limit_issues = spider.limit_articles = None
+    spider.limit_discipline_journals = None
+    spider.min_p = spider.max_p = 0
+    spider.login_form_xpath = '//form[@id="mc1" and @action="/login"]'
+    spider.ledger = DownloadLedger(os.path.join(work_dir, module + '.sqlite'))
+    spider.snapshot = DisciplineSnapshot(os.path.join(work_dir, module + '_snapshot.sqlite'))
+    spider.delta = False
+    spider.events = EventSink(log_folder, getattr(spider_module, 'LOG_HEADERS', ['URL']), flush_interval=3600)
+    return spider
+
+
+def run_callback(callback, url, body, meta):
+    meta = dict(meta)
+    if 'item' in meta:
+        meta['item'] = JournalItem(file_name='Article title 1', journal='Journal of Testing', issue='Vol 50 Issue 2 2020', year='2020')
+    response = HtmlResponse(url, body=body, encoding='utf-8', request=Request(url, meta=meta))
+    return [output for output in iterate_spider_output(callback(response)) if output is not False]
+
+
+def count_outputs(outputs):
+    requests = sum(1 for output in outputs if isinstance(output, Request))
+    return len(outputs) - requests, requests
+
+
+def measure(case, repeat, work_dir):
+    module, class_name, callback_name, fixture, url, meta = case
+    spider = make_spider(module, class_name, work_dir)
+    callback = getattr(spider, callback_name)
+    body, source = load_fixture(fixture)
+
+    # Warm up (imports, compiled expressions, sqlite tables)
+    items, requests = count_outputs(run_callback(callback, url, body, meta))
+
+    start = perf_counter()
+    for _ in range(repeat):
+        run_callback(callback, url, body, meta)
+    elapsed = perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    base_memory = tracemalloc.get_traced_memory()[0]
+    outputs = run_callback(callback, url, body, meta)
+    peak_memory = tracemalloc.get_traced_memory()[1] - base_memory
+    allocated = tracemalloc.take_snapshot().compare_to(before, 'filename')
+    tracemalloc.stop()
+    del outputs
+
+    spider.events.close()
+    spider.ledger.close()
+
+    return {
+        'case': '{}.{}'.format(module, callback_name),
+        'spider': spider.name,
+        'callback': callback_name,
+        'fixture': fixture,
+        'fixture_source': source,
+        'fixture_bytes': len(body),
+        'repeat': repeat,
+        'items_per_response': items,
+        'requests_per_response': requests,
+        'ms_per_response': round(elapsed / repeat * 1000, 3),
+        'responses_per_sec': round(repeat / elapsed, 2),
+        'items_per_sec': round(items * repeat / elapsed, 2),
+        'requests_per_sec': round(requests * repeat / elapsed, 2),
+        'peak_memory_bytes': peak_memory,
+        'allocated_bytes': sum(stat.size_diff for stat in allocated if stat.size_diff > 0),
+        'allocated_blocks': sum(stat.count_diff for stat in allocated if stat.count_diff > 0),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    previous = {result['case']: result for result in (previous or {}).get('results', [])}
+    print('{:<50} {:>10} {:>10} {:>11} {:>10} {:>10} {:>10}'.format('callback', 'resp/s', 'items/s', 'requests/s', 'peak KB', 'alloc KB', 'blocks'))
+    for result in results:
+        line = '{:<50} {:>10.1f} {:>10.1f} {:>11.1f} {:>10.1f} {:>10.1f} {:>10}'.format(
+            result['case'], result['responses_per_sec'], result['items_per_sec'], result['requests_per_sec'],
+            result['peak_memory_bytes'] / 1024, result['allocated_bytes'] / 1024, result['allocated_blocks'],
+        )
+        if result['case'] in previous:
+            line += '  {:+.1f}%'.format((result['responses_per_sec'] / previous[result['case']]['responses_per_sec'] - 1) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20, help='responses per callback')
+    parser.add_argument('--only', help='run cases containing this text only')
+    parser.add_argument('--output', help='results JSON file (default: benchmarks/results/parsers-<time>.json)')
+    parser.add_argument('--compare', help='previous results JSON file to compare responses/s with')
+    args = parser.parse_args()
+
+    cases = [case for case in CASES if not args.only or args.only in '{}.{}'.format(case[0], case[2])]
+    work_dir = tempfile.mkdtemp(prefix='journal-benchmark-')
+    try:
+        results = [measure(case, args.repeat, work_dir) for case in cases]
+    finally:
+        shutil.rmtree(work_dir)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+    print_results(results, previous)
+
+    now = datetime.now()
+    output = args.output or os.path.join(RESULTS_DIR, 'parsers-{}.json'.format(now.strftime('%Y%m%d-%H%M%S')))
+    if not os.path.exists(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'benchmark': 'parsers',
+            'time': now.isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'scrapy': scrapy.__version__,
+            'lxml': '.'.join(map(str, lxml.etree.LXML_VERSION)),
+            'results': results,
+        }, f, indent=2)
+    print('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# Startup benchmark of the spider modules
+#
+# scrapy crawl <spider> imports every module of SPIDER_MODULES (SpiderLoader)
+# before it runs the one spider, so whatever a spider module does when it is
+# imported is paid by every cron run of every spider. Measured in a fresh
+# interpreter per run (median of --repeat runs, warm .pyc files):
+#   scrapy ms         - import scrapy, the same for every project
+#   settings ms       - get_project_settings() of the command
+#   spider loader ms  - SpiderLoader.from_settings(), all the spider modules
+#   <module> ms       - one spider module alone, after scrapy
+# The spider loader must not call get_project_settings() nor import the
+# modules of FORBIDDEN_MODULES, and stay within --budget ms, else the exit
+# status is 1. Results are saved as JSON to benchmarks/results/:
+#
+#   python benchmarks/startup.py [--repeat 7] [--budget 60] [--compare benchmarks/results/<old>.json]
+
+import argparse
+import json
+import os
+import os.path
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from statistics import median
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+SETTINGS_MODULE = 'journal.settings'
+
+# Spider loader time allowed (ms), scrapy itself not included
+DEFAULT_BUDGET = 60
+# Modules only the spider run may import: the browser, deprecated shims
+FORBIDDEN_MODULES = ['selenium', 'scrapy.loader.processors']
+
+# Runs in the fresh interpreter, prints the measures as JSON
+MEASURE_LOADER = '''
+import json, sys
+from time import perf_counter
+start = perf_counter()
+import scrapy
+scrapy_time = perf_counter() - start
+import scrapy.utils.project
+from scrapy.spiderloader import SpiderLoader
+start = perf_counter()
+settings = scrapy.utils.project.get_project_settings()
+settings_time = perf_counter() - start
+calls = []
+get_project_settings = scrapy.utils.project.get_project_settings
+scrapy.utils.project.get_project_settings = lambda: calls.append(1) or get_project_settings()
+before = set(sys.modules)
+start = perf_counter()
+spiders = SpiderLoader.from_settings(settings).list()
+loader_time = perf_counter() - start
+print(json.dumps({
+    'scrapy': scrapy_time, 'settings': settings_time, 'loader': loader_time,
+    'spiders': spiders, 'settings_calls': len(calls), 'modules': sorted(set(sys.modules) - before),
+}))
+'''
+MEASURE_MODULE = '''
+import json, sys
+from importlib import import_module
+from time import perf_counter
+import scrapy
+start = perf_counter()
+import_module(sys.argv[1])
+print(json.dumps({'module': perf_counter() - start}))
+'''
+
+
+def measure(code, *argv):
+    env = dict(os.environ, SCRAPY_SETTINGS_MODULE=SETTINGS_MODULE, PYTHONPATH=ROOT_DIR)
+    output = subprocess.check_output([sys.executable, '-c', code] + list(argv), cwd=ROOT_DIR, env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def spider_modules():
+    folder = os.path.join(ROOT_DIR, 'journal', 'spiders')
+    return sorted('journal.spiders.' + name[:-3] for name in os.listdir(folder) if name.endswith('.py') and name != '__init__.py')
+
+
+def forbidden(modules):
+    return sorted(module for module in modules if any(module == name or module.startswith(name + '.') for name in FORBIDDEN_MODULES))
+
+
+def run(repeat):
+    # First run writes the .pyc files, not counted
+    runs = [measure(MEASURE_LOADER) for _ in range(repeat + 1)][1:]
+    results = {
+        'scrapy_ms': round(median(run['scrapy'] for run in runs) * 1000, 2),
+        'settings_ms': round(median(run['settings'] for run in runs) * 1000, 2),
+        'loader_ms': round(median(run['loader'] for run in runs) * 1000, 2),
+        'spiders': runs[0]['spiders'],
+        'settings_calls': runs[0]['settings_calls'],
+        'loader_modules': len(runs[0]['modules']),
+        'forbidden_modules': forbidden(runs[0]['modules']),
+        'modules_ms': {},
+    }
+    for module in spider_modules():
+        times = [measure(MEASURE_MODULE, module)['module'] for _ in range(repeat)]
+        results['modules_ms'][module] = round(median(times) * 1000, 2)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    previous = (previous or {}).get('results', {})
+    rows = [
+        ('import scrapy', results['scrapy_ms'], previous.get('scrapy_ms')),
+        ('get_project_settings()', results['settings_ms'], previous.get('settings_ms')),
+        ('spider loader ({} spiders)'.format(len(results['spiders'])), results['loader_ms'], previous.get('loader_ms')),
+    ]
+    rows += [(module, ms, previous.get('modules_ms', {}).get(module)) for module, ms in sorted(results['modules_ms'].items())]
+    print('{:<50} {:>10}'.format('startup', 'ms'))
+    for name, ms, previous_ms in rows:
+        line = '{:<50} {:>10.1f}'.format(name, ms)
+        if previous_ms:
+            line += '  {:+.1f}%'.format((ms / previous_ms - 1) * 100)
+        print(line)
+    print('get_project_settings() calls while loading: {}'.format(results['settings_calls']))
+    print('Modules imported while loading: {}'.format(results['loader_modules']))
+
+
+def check(results, budget):
+    errors = []
+    if results['loader_ms'] > budget:
+        errors.append('spider loader takes {:.1f} ms, budget {} ms'.format(results['loader_ms'], budget))
+    if results['settings_calls']:
+        errors.append('spider modules call get_project_settings() {} times'.format(results['settings_calls']))
+    if results['forbidden_modules']:
+        errors.append('spider modules import {}'.format(', '.join(results['forbidden_modules'])))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=7, help='interpreters per measure')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help='spider loader time allowed (ms)')
+    parser.add_argument('--output', help='results JSON file (default: benchmarks/results/startup-<time>.json)')
+    parser.add_argument('--compare', help='previous results JSON file to compare the times with')
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+    print_results(results, previous)
+
+    now = datetime.now()
+    output = args.output or os.path.join(RESULTS_DIR, 'startup-{}.json'.format(now.strftime('%Y%m%d-%H%M%S')))
+    if not os.path.exists(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    errors = check(results, args.budget)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'benchmark': 'startup',
+            'time': now.isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'budget_ms': args.budget,
+            'errors': errors,
+            'results': results,
+        }, f, indent=2)
+    print('Results saved to {}'.format(output))
+
+    for error in errors:
+        print('FAILED: {}'.format(error))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# Micro-benchmark of the hot parse callbacks selectors
+#
+# Compares the XPath work per page before (response.xpath() with expression
+# strings, page-level values evaluated for every article) and after
+# (journal.selectors.XPathRegistry, page-level values evaluated once) on
+# synthetic pages shaped like the publisher pages.
+#
+# Usage (from the project folder):
+#   python benchmarks/xpath_registry.py [--repeat 200] [--articles 100]
+
+import argparse
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrapy.http import HtmlResponse  # noqa: E402
+
+from journal.spiders import journal_issues, taylor_francis_download_auth, wiley_download_auth  # noqa: E402
+
+FILLER = '<div class="filler"><p>Lorem <b>ipsum</b> dolor sit amet</p><ul><li><a href="#">link</a></li></ul></div>'
+
+
+def html_page(body, filler=200):
+    return HtmlResponse('https://onlinelibrary.wiley.com/page', encoding='utf-8', body='<html><head><title>Journal</title></head><body>{}{}</body></html>'.format(FILLER * filler, body))
+
+
+def wiley_article_page():
+    return html_page(
+        '<div class="coolBar__second rlist"><ul><li><a class="coolBar__ctrl pdf-download" title="Article PDF" href="/doi/pdf/10.1002/abc.123">PDF</a></li></ul></div>'
+        '<a href="/action/showCitFormats?doi=10.1002%2Fabc.123">Export citation</a>'
+    )
+
+
+def wiley_issue_page(articles):
+    return html_page(''.join(
+        '<div class="issue-item"><a href="/doi/10.1002/abc.{0}"><h2>Article <i>title</i> {0}</h2></a></div>'.format(i) for i in range(articles)
+    ))
+
+
+def taylor_article_page():
+    return html_page(
+        '<a class="show-pdf" href="/doi/pdf/10.1080/abc.123">PDF</a>'
+        '<ul><li class="downloadCitations"><a href="/action/showCitFormats?doi=10.1080/abc.123">Citations</a></li></ul>'
+    )
+
+
+def carleton_issue_page(articles):
+    return html_page(
+        '<div id="journal-details"><h3>Journal of Tests</h3><div class="issn">ISSN: 1234-5678</div></div>'
+        '<div style="x"><span>Most Recent Issue: Vol 10, Issue 2: 2019</span></div>'
+        '<div id="result-list"><ol id="toc">' + ''.join(
+            '<li class="journal-item row-{0}"><div class="journal-result"><h4><a href="/article/{0}"><span class="article-title"> Title {0} </span></a></h4>'
+            '<div class="clear links"><a href="/pdf/{0}">PDF Download</a></div></div></li>'.format(i) for i in range(articles)
+        ) + '</ol></div>'
+    )
+
+
+# Before: expression strings, as the callbacks used them
+
+def wiley_article_before(response):
+    response.xpath('//div[@class="coolBar__second rlist"]//a[contains(@class, "pdf-download") and @title="Article PDF"]/@href').get()
+    response.xpath('//a[starts-with(@href, "/action/showCitFormats?")]/@href').get()
+
+
+def wiley_issue_before(response):
+    for article in response.xpath('//div[@class="issue-item"]/a[h2]'):
+        article.xpath('./@href').get()
+        article.xpath('string(./h2)').get()
+
+
+def taylor_article_before(response):
+    response.xpath('//a[@class="show-pdf"]/@href').get()
+    response.xpath('//li[@class="downloadCitations"]/a/@href').get()
+
+
+def carleton_issue_before(response):
+    for article in response.xpath('//div[@id="result-list"]/ol[@id="toc"]/li[contains(@class, "journal-item row-")]/div[@class="journal-result"]'):
+        response.xpath('//div[@id="journal-details"]/h3/text()').extract()
+        article.xpath('.//h4//span[@class="article-title"]/text()').extract()
+        article.xpath('//div[@id="journal-details"]/h3/text()').extract()
+        response.xpath('//div[@id="journal-details"]/following-sibling::div[@style]//span/text()').extract()
+        response.xpath('//div[@id="journal-details"]/following-sibling::div[@style]//span/text()').extract()
+        article.xpath('.//h4//a/@href').get()
+
+
+# After: the spiders registries
+
+def wiley_article_after(response):
+    wiley_download_auth.XPATHS.get(response, 'pdf_url')
+    wiley_download_auth.XPATHS.get(response, 'citation_url')
+
+
+def wiley_issue_after(response):
+    for article in wiley_download_auth.XPATHS.select(response, 'articles'):
+        wiley_download_auth.XPATHS.get(article, 'link_href')
+        wiley_download_auth.XPATHS.get(article, 'article_title')
+
+
+def taylor_article_after(response):
+    taylor_francis_download_auth.XPATHS.get(response, 'pdf_url')
+    taylor_francis_download_auth.XPATHS.get(response, 'citation_url')
+
+
+def carleton_issue_after(response):
+    xpaths = journal_issues.XPATHS
+    xpaths.getall(response, 'journal_name')
+    xpaths.getall(response, 'issue_details')
+    for article in xpaths.evaluate(response, 'articles'):
+        xpaths.getall(article, 'article_title')
+        xpaths.get(article, 'article_url')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--articles', type=int, default=100)
+    args = parser.parse_args()
+
+    cases = [
+        ('wiley parse_article', wiley_article_page(), wiley_article_before, wiley_article_after),
+        ('wiley parse_issue', wiley_issue_page(args.articles), wiley_issue_before, wiley_issue_after),
+        ('taylor parse_article', taylor_article_page(), taylor_article_before, taylor_article_after),
+        ('journal_issues parse_issue', carleton_issue_page(args.articles), carleton_issue_before, carleton_issue_after),
+    ]
+
+    print('{:<28} {:>12} {:>12} {:>8}'.format('callback', 'before ms', 'after ms', 'speedup'))
+    for name, response, before, after in cases:
+        # Parse the document once, as Scrapy does, before timing
+        response.selector
+        before_ms = timeit(lambda: before(response), number=args.repeat) / args.repeat * 1000
+        after_ms = timeit(lambda: after(response), number=args.repeat) / args.repeat * 1000
+        print('{:<28} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(name, before_ms, after_ms, before_ms / after_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Issue citation batches of the Atypon sites (Wiley, Taylor & Francis)
+#
+# /action/downloadCitation takes several doi fields, so the RIS records of
+# up to CITATION_BATCH_SIZE articles of an issue come in one POST instead of
+# a showCitFormats page and a downloadCitation POST per article. The answer
+# is split back into one record per article by its DO field:
+#
+#   articles = [(article_url, article_context), ...]
+#   for batch in batches(articles, size):
+#       yield citation_batch_request(response, batch, callback=self.parse_citations)
+#   ...
+#   records = split_ris(response.body)     # {'10.1002/abc.1': b'TY  - JOUR...'}
+#
+# An answer without any record (error or HTML page sent with a 200) is a
+# failed batch. Articles left out of an answer get their RIS from their
+# article page (showCitFormats and downloadCitation), as without batches.
+
+import re
+
+from scrapy import FormRequest
+
+CITATION_PATH = '/action/downloadCitation'
+
+RIS_END_RE = re.compile(br'^ER  -.*$\n?', re.M)
+RIS_DOI_RE = re.compile(br'^DO  - *(\S+)', re.M)
+
+
+def key_doi(key):
+    # DOI of a journal.ledger.article_key, None for the URL keys
+    if key.startswith('doi:'):
+        return key[len('doi:'):]
+    return None
+
+
+def batches(articles, size):
+    # No batch at all for size 0 (batching off)
+    if size <= 0:
+        return
+    for start in range(0, len(articles), size):
+        yield articles[start:start + size]
+
+
+def citation_batch_request(response, articles, **kwargs):
+    formdata = {
+        'doi': [key_doi(context.article_key) for _, context in articles],
+        'format': 'ris',
+        'include': 'abs',
+        'direct': 'true',
+    }
+    meta = {'context': response.meta['context'], 'articles': articles}
+    return FormRequest(response.urljoin(CITATION_PATH), formdata=formdata, meta=meta, dont_filter=True, **kwargs)
+
+
+def split_ris(body):
+    # {lower case DOI: RIS record}, records without a DO field are dropped
+    records = {}
+    start = 0
+    for end in RIS_END_RE.finditer(body):
+        record = body[start:end.end()].lstrip()
+        start = end.end()
+        match = RIS_DOI_RE.search(record)
+        if match:
+            records[match.group(1).decode('utf-8', 'replace').lower()] = record
+    return records
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Crawl context of the download spiders requests
+#
+# Each level of the journal > volume > issue > article tree adds its own
+# fields on top of its parent's context, so a value (the journal name, the
+# volume title, ...) is stored once for all the requests below it instead of
+# being copied into every request meta dict. A level only has slots for its
+# own fields, the others are looked up in its ancestors. Contexts are
+# immutable, a child can't change what its siblings see:
+#
+#   journal = JournalContext(journal_name='Journal of Testing')
+#   volume = journal.child(volume_title='2020 - Volume 50')
+#   request = response.follow(url, meta={'context': volume.child(issue_number='Issue 1')})
+#   response.meta['context'].journal_name        # 'Journal of Testing'
+
+
+def make_context(parent, fields):
+    level = LEVELS.get(frozenset(fields))
+    if level is None:
+        raise TypeError('No crawl context level with fields {}'.format(', '.join(sorted(fields))))
+    return level(parent, **fields)
+
+
+class CrawlContext(object):
+    __slots__ = ('parent',)
+
+    def __init__(self, parent=None, **fields):
+        object.__setattr__(self, 'parent', parent)
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        # Field of an ancestor level
+        if name.startswith('__') or name == 'parent' or self.parent is None:
+            raise AttributeError(name)
+        return getattr(self.parent, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Crawl contexts are immutable, use child()')
+
+    def __reduce__(self):
+        # Requests are pickled by the disk queues of JOBDIR
+        return make_context, (self.parent, self.own_fields())
+
+    def __repr__(self):
+        return 'CrawlContext({})'.format(', '.join('{}={!r}'.format(name, value) for name, value in self.fields().items()))
+
+    def own_fields(self):
+        return {name: object.__getattribute__(self, name) for name in type(self).__slots__}
+
+    def fields(self):
+        fields = self.parent.fields() if self.parent is not None else {}
+        fields.update(self.own_fields())
+        return fields
+
+    def child(self, **fields):
+        return make_context(self, fields)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+
+class JournalContext(CrawlContext):
+    __slots__ = ('journal_name',)
+
+
+class VolumeContext(CrawlContext):
+    __slots__ = ('volume_title',)
+
+
+class IssueContext(CrawlContext):
+    __slots__ = ('issue_number',)
+
+
+class ArticleContext(CrawlContext):
+    __slots__ = ('article_title', 'article_key')
+
+
+class ArticlePageContext(CrawlContext):
+    __slots__ = ('pdf_url', 'article_url')
+
+
+LEVELS = {frozenset(level.__slots__): level for level in (JournalContext, VolumeContext, IssueContext, ArticleContext, ArticlePageContext)}
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+# Buffered sink for "missing content" events
+#
+# Spiders report journals without issues, issues without articles, articles
+# without PDF or RIS file and so on through EventSink.log(log_file, values).
+# Rows are kept in memory and written through long-lived file handles every
+# EVENT_SINK_FLUSH_INTERVAL seconds (or EVENT_SINK_BUFFER_SIZE rows) instead
+# of opening the log file for every single row.
+#
+# Backends (EVENT_SINK_BACKEND setting):
+#   csv    - one CSV file per log file, same files as before
+#   jsonl  - every event as a JSON line in <log folder>/events.jsonl
+#   sqlite - every event as a row in <log folder>/events.sqlite
+#
+# Event type is the log file name without "log_" prefix and extension, so
+# LOG_FILE_ARTICLE_NO_PDF events are "article_no_pdf_file".
+
+import csv
+import json
+import logging
+import os
+import os.path
+import sqlite3
+from time import time
+
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_HEADERS = ['Journal_Name', 'Discipline_Name']
+URL_HEADER = 'URL'
+
+
+def event_type(log_file):
+    name = os.path.splitext(os.path.basename(log_file))[0]
+    if name.startswith('log_'):
+        name = name[len('log_'):]
+    return name
+
+
+def make_event(log_file, row, timestamp=None):
+    return {
+        'type': event_type(log_file),
+        'journal': next((row[h] for h in JOURNAL_HEADERS if row.get(h)), None),
+        'url': row.get(URL_HEADER),
+        'row': row,
+        'time': timestamp,
+        'log_file': log_file,
+    }
+
+
+def event_matches(event, type=None, journal=None, url=None):
+    return (type is None or event['type'] == type) and \
+        (journal is None or event['journal'] == journal) and \
+        (url is None or event['url'] == url)
+
+
+class CsvEventBackend(object):
+    # Keeps one open handle per log file
+
+    def __init__(self, folder, headers):
+        self.folder = folder
+        self.headers = headers
+        self.files = {}
+
+    def get_writer(self, log_file):
+        if log_file not in self.files:
+            file_exists = os.path.exists(log_file) and os.path.getsize(log_file)
+            f = open(log_file, 'a', newline='', encoding='utf-8')
+            writer = csv.DictWriter(f, fieldnames=self.headers)
+            if not file_exists:
+                writer.writeheader()
+            self.files[log_file] = f, writer
+        return self.files[log_file][1]
+
+    def write(self, events):
+        for event in events:
+            self.get_writer(event['log_file']).writerow(event['row'])
+        for f, writer in self.files.values():
+            f.flush()
+
+    def query(self, type=None, journal=None, url=None):
+        for file_name in sorted(os.listdir(self.folder)):
+            log_file = os.path.join(self.folder, file_name)
+            if not (file_name.startswith('log_') and file_name.endswith('.csv')) or (type is not None and event_type(log_file) != type):
+                continue
+            with open(log_file, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    event = make_event(log_file, row)
+                    if event_matches(event, type, journal, url):
+                        yield event
+
+    def close(self):
+        for f, writer in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class JsonLinesEventBackend(object):
+
+    def __init__(self, folder, headers):
+        self.path = os.path.join(folder, 'events.jsonl')
+        self.file = None
+
+    def write(self, events):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        for event in events:
+            self.file.write(json.dumps({k: v for k, v in event.items() if k != 'log_file'}, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def query(self, type=None, journal=None, url=None):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                event = json.loads(line)
+                if event_matches(event, type, journal, url):
+                    yield event
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SqliteEventBackend(object):
+
+    def __init__(self, folder, headers):
+        self.path = os.path.join(folder, 'events.sqlite')
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS events ('
+            'type TEXT, journal TEXT, url TEXT, row TEXT, time REAL)'
+        )
+        for column in ('type', 'journal', 'url'):
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_{0} ON events ({0})'.format(column))
+        self.connection.commit()
+
+    def write(self, events):
+        self.connection.executemany(
+            'INSERT INTO events (type, journal, url, row, time) VALUES (?, ?, ?, ?, ?)',
+            [(e['type'], e['journal'], e['url'], json.dumps(e['row'], ensure_ascii=False), e['time']) for e in events],
+        )
+        self.connection.commit()
+
+    def query(self, type=None, journal=None, url=None):
+        conditions = [(c, v) for c, v in (('type', type), ('journal', journal), ('url', url)) if v is not None]
+        sql = 'SELECT type, journal, url, row, time FROM events'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join('{} = ?'.format(c) for c, v in conditions)
+        for row in self.connection.execute(sql + ' ORDER BY rowid', [v for c, v in conditions]):
+            yield {'type': row[0], 'journal': row[1], 'url': row[2], 'row': json.loads(row[3]), 'time': row[4]}
+
+    def close(self):
+        self.connection.close()
+
+
+BACKENDS = {
+    'csv': CsvEventBackend,
+    'jsonl': JsonLinesEventBackend,
+    'sqlite': SqliteEventBackend,
+}
+
+
+class EventSink(object):
+
+    def __init__(self, folder, headers, backend='csv', flush_interval=5, buffer_size=100):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.headers = headers
+        self.backend = BACKENDS[backend](folder, headers)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.counts = {}
+        self.write_failed = False
+        self.flush_interval = flush_interval
+        self.flush_task = None
+
+    @classmethod
+    def from_settings(cls, settings, folder, headers):
+        return cls(
+            folder,
+            headers,
+            backend=settings.get('EVENT_SINK_BACKEND', 'csv'),
+            flush_interval=settings.getfloat('EVENT_SINK_FLUSH_INTERVAL', 5),
+            buffer_size=settings.getint('EVENT_SINK_BUFFER_SIZE', 100),
+        )
+
+    def log(self, log_file, list_values):
+        event = make_event(log_file, dict(zip(self.headers, list_values)), time())
+        logger.debug('Event %(type)s: %(url)s', event)
+        self.counts[event['type']] = self.counts.get(event['type'], 0) + 1
+        self.buffer.append(event)
+        if self.flush_task is None:
+            # Spiders create the sink before Scrapy installs the reactor
+            self.flush_task = task.LoopingCall(self.flush_buffer)
+            self.flush_task.start(self.flush_interval, now=False)
+        # After a failed write only the flush task tries again
+        if len(self.buffer) >= self.buffer_size and not self.write_failed:
+            self.flush_buffer()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        events, self.buffer = self.buffer, []
+        try:
+            self.backend.write(events)
+        except Exception:
+            # Kept for the next flush (disk full, locked database)
+            self.buffer = events + self.buffer
+            self.write_failed = True
+            raise
+        self.write_failed = False
+
+    def flush_buffer(self):
+        # An error would stop the flush task for the rest of the crawl
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Could not write %(count)d events, trying again later', {'count': len(self.buffer)})
+
+    def query(self, type=None, journal=None, url=None):
+        self.flush()
+        return list(self.backend.query(type=type, journal=journal, url=url))
+
+    def close(self):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush_buffer()
+        self.backend.close()
+        for type, count in sorted(self.counts.items()):
+            logger.info('Logged %(count)d "%(type)s" events', {'count': count, 'type': type})
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+# Define here your extensions
+#
+# See documentation in:
+# https://doc.scrapy.org/en/latest/topics/extensions.html
+
+import logging
+import numbers
+import os
+import os.path
+import signal
+import sys
+from datetime import datetime
+from time import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.utils.project import data_path
+from scrapy.utils.reactor import listen_tcp
+from twisted.internet import reactor, task, threads
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from journal.metrics import crawler_metrics
+from journal.middlewares import decoded_response, is_login_page
+from journal.profiling import FOLDED_FILE, STAGES_FILE, MemoryReporter, StackSampler
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_STATUSES = (429, 503)
+
+
+class AdaptiveConcurrency(object):
+    # AIMD controller of the downloader slots (one slot per host).
+    #
+    # Healthy responses (latency under ADAPTIVE_TARGET_LATENCY, error rate
+    # under ADAPTIVE_MAX_ERROR_RATE) add about one request of concurrency per
+    # full window of responses and shorten the delay. 429/503 responses,
+    # proxy error pages and unexpected login pages halve the concurrency and
+    # double the delay (or use Retry-After), at most once per window so one
+    # burst of errors backs off only once.
+    #
+    # Current values are published as adaptive/<host>/concurrency and
+    # adaptive/<host>/delay stats.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_concurrency = settings.getint('ADAPTIVE_MAX_CONCURRENCY')
+        self.min_delay = settings.getfloat('ADAPTIVE_MIN_DELAY')
+        self.max_delay = settings.getfloat('ADAPTIVE_MAX_DELAY')
+        self.backoff_delay = settings.getfloat('ADAPTIVE_BACKOFF_DELAY')
+        self.target_latency = settings.getfloat('ADAPTIVE_TARGET_LATENCY')
+        self.max_error_rate = settings.getfloat('ADAPTIVE_MAX_ERROR_RATE')
+        self.error_page_xpath = settings.get('ADAPTIVE_ERROR_PAGE_XPATH')
+        self.login_form_xpath = settings.get('SESSION_LOGIN_FORM_XPATH')
+        self.login_path = settings.get('SESSION_LOGIN_PATH')
+        self.debug = settings.getbool('ADAPTIVE_DEBUG')
+        self.hosts = {}
+
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def get_slot(self, request):
+        key = request.meta.get('download_slot')
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+    def get_host(self, key, slot):
+        if key not in self.hosts:
+            self.hosts[key] = {
+                'concurrency': float(slot.concurrency),
+                'error_rate': 0.0,
+                'responses': 0,
+                'last_backoff': 0.0,
+            }
+        return self.hosts[key]
+
+    def is_backoff_response(self, response, request):
+        if response.status in BACKOFF_STATUSES:
+            return 'status_{}'.format(response.status)
+        # response_downloaded comes before HttpCompressionMiddleware decodes
+        response = decoded_response(response)
+        # Login pages of the spiders own login flow are expected
+        if not request.meta.get('dont_relogin') and is_login_page(response, self.login_form_xpath, self.login_path):
+            return 'login_page'
+        if isinstance(response, HtmlResponse) and response.xpath(self.error_page_xpath):
+            return 'proxy_error'
+        return None
+
+    def is_expired_session(self, host, request):
+        # Login page of a proxy session which already gave one
+        generation = request.meta.get('session_generation')
+        if generation is not None and generation == host.get('login_generation'):
+            return True
+        host['login_generation'] = generation
+        return False
+
+    def response_downloaded(self, response, request, spider):
+        key, slot = self.get_slot(request)
+        latency = request.meta.get('download_latency')
+        if slot is None or latency is None:
+            return
+
+        host = self.get_host(key, slot)
+        host['responses'] += 1
+        reason = self.is_backoff_response(response, request)
+        if reason == 'login_page' and self.is_expired_session(host, request):
+            # Sent with the expired session, replayed after the re-login: the
+            # expiry was backed off once and says nothing more about the host
+            self.stats.inc_value('adaptive/{}/backoff_responses/{}'.format(key, reason))
+            reason = None
+        error = reason is not None or response.status >= 500
+        host['error_rate'] = 0.9 * host['error_rate'] + 0.1 * error
+
+        if reason is not None:
+            self.backoff(key, slot, host, response, reason)
+        elif latency <= self.target_latency and host['error_rate'] <= self.max_error_rate:
+            # Additive increase, about +1 per window of responses
+            host['concurrency'] = min(self.max_concurrency, host['concurrency'] + 1.0 / host['concurrency'])
+            slot.delay = max(self.min_delay, slot.delay * 0.9)
+        elif latency > 2 * self.target_latency:
+            # Slow host, give back some concurrency
+            host['concurrency'] = max(1.0, host['concurrency'] - 1.0 / host['concurrency'])
+
+        slot.concurrency = int(host['concurrency'])
+        self.publish(key, slot, host)
+
+        if self.debug:
+            logger.info('[%(key)s] concurrency: %(concurrency)d delay: %(delay).2fs latency: %(latency).2fs status: %(status)d', {
+                'key': key, 'concurrency': slot.concurrency, 'delay': slot.delay, 'latency': latency, 'status': response.status,
+            }, extra={'spider': spider})
+
+    def backoff(self, key, slot, host, response, reason):
+        self.stats.inc_value('adaptive/{}/backoff_responses/{}'.format(key, reason))
+
+        # Responses of the same window were sent before the last back off
+        now = time()
+        if now - host['last_backoff'] < slot.delay + self.target_latency:
+            return
+        host['last_backoff'] = now
+
+        # Multiplicative decrease
+        host['concurrency'] = max(1.0, host['concurrency'] / 2)
+        delay = max(self.backoff_delay, slot.delay * 2)
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        slot.delay = min(self.max_delay, delay)
+
+        self.stats.inc_value('adaptive/{}/backoffs'.format(key))
+        logger.info('Backing off %(key)s (%(reason)s): concurrency %(concurrency)d, delay %(delay).1fs', {
+            'key': key, 'reason': reason, 'concurrency': int(host['concurrency']), 'delay': slot.delay,
+        })
+
+    def publish(self, key, slot, host):
+        self.stats.set_value('adaptive/{}/concurrency'.format(key), slot.concurrency)
+        self.stats.max_value('adaptive/{}/concurrency_max'.format(key), slot.concurrency)
+        self.stats.set_value('adaptive/{}/delay'.format(key), round(slot.delay, 3))
+        self.stats.set_value('adaptive/{}/error_rate'.format(key), round(host['error_rate'], 3))
+
+    def spider_closed(self, spider):
+        for key, host in sorted(self.hosts.items()):
+            logger.info('%(key)s: %(responses)d responses, concurrency %(concurrency).1f, error rate %(error_rate).2f', dict(host, key=key))
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.metrics.render().encode('utf-8')
+
+
+class CrawlMetrics(object):
+    # Live metrics of the crawl (journal.metrics) on
+    # http://METRICS_HOST:<port>/metrics, the first free port of METRICS_PORT,
+    # and in METRICS_SNAPSHOT_FILE every METRICS_SNAPSHOT_INTERVAL seconds:
+    # callback times (journal.middlewares.CallbackMetricsSpiderMiddleware),
+    # download latency, time in the downloader, bytes and responses per host,
+    # queue and pipeline depths, PDF and RIS outcomes and the numeric stats.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.metrics = crawler_metrics(crawler)
+        self.host = settings.get('METRICS_HOST')
+        self.port_range = [int(port) for port in settings.getlist('METRICS_PORT')]
+        self.snapshot_file = settings.get('METRICS_SNAPSHOT_FILE')
+        self.snapshot_interval = settings.getfloat('METRICS_SNAPSHOT_INTERVAL')
+        self.listener = None
+        self.snapshot_task = None
+        self.spider = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(self.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(self.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(self.item_error, signal=signals.item_error)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        if self.port_range:
+            self.listener = listen_tcp(self.port_range, self.host, Site(MetricsResource(self)))
+            address = self.listener.getHost()
+            logger.info('Metrics on http://%(host)s:%(port)d/metrics', {'host': address.host, 'port': address.port})
+        if self.snapshot_file:
+            self.snapshot_file = data_path(self.snapshot_file % {'name': spider.name})
+            self.snapshot_task = task.LoopingCall(self.write_snapshot)
+            self.snapshot_task.start(self.snapshot_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.snapshot_task is not None:
+            if self.snapshot_task.running:
+                self.snapshot_task.stop()
+            self.write_snapshot()
+        if self.listener is not None:
+            return self.listener.stopListening()
+
+    def write_snapshot(self):
+        # An error would stop the snapshot task for the rest of the crawl
+        try:
+            self.collect()
+            self.metrics.write(self.snapshot_file)
+        except OSError as e:
+            logger.warning('Unable to write metrics snapshot %(path)s: %(error)s', {'path': self.snapshot_file, 'error': e})
+        except Exception:
+            logger.exception('Unable to write metrics snapshot %(path)s', {'path': self.snapshot_file})
+
+    def request_reached_downloader(self, request, spider):
+        request.meta['metrics_downloader_time'] = time()
+
+    def response_downloaded(self, response, request, spider):
+        host = request.meta.get('download_slot') or 'unknown'
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.metrics.observe('journal_download_latency_seconds', latency, host=host)
+        started = request.meta.get('metrics_downloader_time')
+        if started is not None:
+            self.metrics.observe('journal_downloader_seconds', time() - started, host=host)
+        # Streamed bodies are on disk, the response body is empty
+        streamed_file = request.meta.get('streamed_file')
+        size = streamed_file['size'] if streamed_file else len(response.body)
+        self.metrics.inc('journal_download_bytes_total', size, host=host)
+        self.metrics.inc('journal_responses_total', host=host, status=response.status)
+
+    def item_scraped(self, item, response, spider):
+        self.metrics.inc('journal_items_total', outcome='scraped')
+
+    def item_dropped(self, item, response, exception, spider):
+        self.metrics.inc('journal_items_total', outcome='dropped')
+
+    def item_error(self, item, response, spider, failure):
+        self.metrics.inc('journal_items_total', outcome='error')
+
+    def collect(self):
+        # Gauges are read when the metrics are asked for
+        engine = self.crawler.engine
+        if engine is not None and engine.scheduler is not None:
+            self.metrics.set('journal_scheduler_requests', len(engine.scheduler))
+            self.metrics.set('journal_downloader_requests', len(engine.downloader.active))
+            self.metrics.set('journal_items_in_pipelines', engine.scraper.slot.itemproc_size if engine.scraper.slot else 0)
+            for pipeline in engine.scraper.itemproc.middlewares:
+                if hasattr(pipeline, 'pending'):
+                    self.metrics.set('journal_pipeline_pending', pipeline.pending, pipeline=type(pipeline).__name__)
+
+        stats = self.stats.get_stats()
+        self.metrics.clear('journal_stat')
+        for key, value in stats.items():
+            if isinstance(value, numbers.Number) and not isinstance(value, bool):
+                self.metrics.set('journal_stat', value, key=key)
+
+        pdfs = {key.split('/', 1)[1]: value for key, value in stats.items() if key.startswith('file_status_count/')}
+        for status, count in pdfs.items():
+            self.metrics.set('journal_pdf_files_total', count, status=status)
+        pdfs_ok = pdfs.get('downloaded', 0) + pdfs.get('uptodate', 0)
+        if pdfs_ok + pdfs.get('failed', 0):
+            self.metrics.set('journal_pdf_success_ratio', pdfs_ok / float(pdfs_ok + pdfs.get('failed', 0)))
+
+        ris = {status: stats.get('ris/' + status, 0) for status in ('written', 'failed')}
+        for status, count in ris.items():
+            self.metrics.set('journal_ris_files_total', count, status=status)
+        if ris['written'] + ris['failed']:
+            self.metrics.set('journal_ris_success_ratio', ris['written'] / float(ris['written'] + ris['failed']))
+
+    def render(self):
+        self.collect()
+        return self.metrics.render()
+
+
+class CrawlProfiler(object):
+    # On demand profiling of a running crawl (journal.profiling): CPU samples
+    # of the callbacks and pipeline stages (PROFILING_STAGES) as a flame graph
+    # and a stage report, tracemalloc and live object reports every
+    # PROFILING_REPORT_INTERVAL seconds, in <folder of LOG_FOLDER>/profiles/
+    # <spider>-<time>/. Runs from the start with PROFILING_ENABLED, or
+    # between two PROFILING_SIGNAL signals (kill -USR1 <pid>, not on Windows).
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.enabled = settings.getbool('PROFILING_ENABLED')
+        self.signal = getattr(signal, settings.get('PROFILING_SIGNAL') or '', None)
+        if not self.enabled and self.signal is None:
+            raise NotConfigured
+
+        self.folder = settings.get('PROFILING_FOLDER')
+        self.sample_interval = settings.getfloat('PROFILING_SAMPLE_INTERVAL')
+        self.stages = settings.getlist('PROFILING_STAGES')
+        self.report_interval = settings.getfloat('PROFILING_REPORT_INTERVAL')
+        self.top = settings.getint('PROFILING_TOP')
+        self.trace_frames = settings.getint('PROFILING_TRACEMALLOC_FRAMES')
+        self.spider = None
+        self.session = None
+        self.sampler = None
+        self.memory = None
+        self.report_task = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        if self.folder is None:
+            self.folder = os.path.join(os.path.dirname(os.path.abspath(self.log_folder(spider))), 'profiles')
+        if self.signal is not None:
+            signal.signal(self.signal, self.signal_received)
+        if self.enabled:
+            self.start()
+
+    def spider_closed(self, spider):
+        if self.session is not None:
+            return self.stop()
+
+    def log_folder(self, spider):
+        # LOG_FOLDER (or ROOT_DIR) of the module of the spider, or of a base
+        # class for subclassed spiders
+        for cls in type(spider).__mro__:
+            module = sys.modules.get(cls.__module__)
+            if getattr(module, 'LOG_FOLDER', None):
+                return module.LOG_FOLDER
+            if getattr(module, 'ROOT_DIR', None) and cls.__module__.startswith('journal.spiders'):
+                return os.path.join(module.ROOT_DIR, 'logs')
+        return os.path.join(os.getcwd(), 'logs')
+
+    def signal_received(self, signum, frame):
+        # Out of the signal handler, in the reactor thread
+        reactor.callFromThread(self.toggle)
+
+    def toggle(self):
+        if self.session is None:
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        self.session = os.path.join(self.folder, '{}-{}'.format(self.spider.name, datetime.now().strftime('%Y%m%d-%H%M%S')))
+        os.makedirs(self.session, exist_ok=True)
+        self.sampler = StackSampler(self.sample_interval, self.stages)
+        self.memory = MemoryReporter(self.top, self.trace_frames)
+        self.memory.start()
+        self.sampler.start()
+        self.report_task = task.LoopingCall(self.write_reports)
+        self.report_task.start(self.report_interval, now=False)
+        self.stats.inc_value('profiling/sessions')
+        logger.info('Profiling to %(folder)s', {'folder': self.session})
+
+    def stop(self):
+        if self.report_task.running:
+            self.report_task.stop()
+        self.sampler.stop()
+        dfd = self.write_reports()
+        dfd.addBoth(self.stopped, self.session, self.sampler, self.memory)
+        self.session = None
+        return dfd
+
+    def stopped(self, result, session, sampler, memory):
+        # Tracing goes on for a session started since
+        if self.session is None:
+            memory.stop()
+        logger.info('Profiling stopped, %(samples)d samples in %(folder)s', {'samples': sampler.samples, 'folder': session})
+
+    def write_reports(self):
+        try:
+            self.sampler.write_folded(os.path.join(self.session, FOLDED_FILE))
+            self.sampler.write_stages(os.path.join(self.session, STAGES_FILE))
+        except OSError as e:
+            logger.warning('Unable to write profiling reports to %(folder)s: %(error)s', {'folder': self.session, 'error': e})
+        # Heap walks take a while on a big heap, not in the reactor thread
+        dfd = threads.deferToThread(self.memory.write, self.session)
+        dfd.addErrback(self.report_failed, self.session)
+        return dfd
+
+    def report_failed(self, failure, session):
+        logger.warning('Unable to write the memory report to %(folder)s: %(error)s', {'folder': session, 'error': failure.value})
@@ -0,0 +1,676 @@
+# -*- coding: utf-8 -*-
+
+# Crawl frontier shared by several worker processes or hosts
+#
+# With SCHEDULER = 'journal.frontier.FrontierScheduler' the journal,
+# volume, issue, article and citation requests of every worker go to one
+# shared queue (FRONTIER_QUEUE, the spider name by default) instead of the
+# worker's own scheduler queues. Workers lease a few requests at a time for
+# FRONTIER_LEASE_TIME seconds, renew the leases of the requests they still
+# work on and acknowledge a request once its response (or failure) went
+# through the spider, so every request is crawled by one worker. Leases of
+# a worker which died expire and the requests go to another worker, a
+# request leased FRONTIER_MAX_ATTEMPTS times without being acknowledged
+# (a request crashing its workers) is given up as dead. Requests already
+# queued or crawled are not queued again, whichever worker asks, but those
+# with dont_filter. Leased requests dropped on the way (scheduler refused
+# them, IgnoreRequest, errback) are given up once the worker is idle.
+#
+# Login requests (meta['dont_relogin']), which belong to the session of a
+# worker, and retries of leased requests stay in the worker's local queues.
+# Workers stop once nothing is pending or leased anywhere; the next crawl of
+# a finished queue starts from scratch.
+#
+# Backends (FRONTIER_BACKEND setting):
+#   sqlite - one SQLite file (FRONTIER_SQLITE_FILE) for the workers of a box,
+#            leases taken in a write transaction under the SQLite file lock
+#   redis  - a Redis server (FRONTIER_REDIS_URL) for workers on several
+#            hosts, leases taken in WATCH/MULTI transactions
+#   memory - the redis backend on InProcessKeyValueStore, an in-process
+#            stand-in of the Redis commands used (workers of one process)
+#
+#   python -m journal.frontier status wiley_download_auth
+#   python -m journal.frontier clear wiley_download_auth
+
+import argparse
+import logging
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
+from collections import deque
+from time import time
+from uuid import uuid4
+
+from scrapy import signals
+from scrapy.core.scheduler import Scheduler
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.utils.project import data_path, get_project_settings
+from scrapy.utils.request import request_from_dict
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+STATE_PENDING = 'pending'
+STATE_LEASED = 'leased'
+STATE_DONE = 'done'
+STATE_DEAD = 'dead'
+STATES = [STATE_PENDING, STATE_LEASED, STATE_DONE, STATE_DEAD]
+
+# SQLite host parameters per statement
+SQLITE_CHUNK_SIZE = 500
+
+
+def chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def text(value):
+    # Redis answers bytes
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class SqliteFrontierBackend(object):
+    # One row per request of a queue. Every lease runs in a BEGIN IMMEDIATE
+    # transaction, SQLite's write lock on the file keeps two worker
+    # processes from leasing the same rows.
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS frontier ('
+            'id INTEGER PRIMARY KEY, queue TEXT, key TEXT, priority INTEGER, data BLOB, '
+            'state TEXT, worker TEXT, lease_until REAL, attempts INTEGER, '
+            'UNIQUE (queue, key))'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS frontier_next ON frontier (queue, state, priority DESC, id)')
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = data_path(settings.get('FRONTIER_SQLITE_FILE'))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return cls(path)
+
+    def open(self, queue):
+        # A finished crawl is forgotten, an interrupted one goes on
+        with self.transaction():
+            if not self.active(queue):
+                self.connection.execute('DELETE FROM frontier WHERE queue = ?', (queue,))
+
+    def transaction(self):
+        return SqliteTransaction(self.connection)
+
+    def active(self, queue):
+        row = self.connection.execute(
+            'SELECT COUNT(*) FROM frontier WHERE queue = ? AND state IN (?, ?)', (queue, STATE_PENDING, STATE_LEASED)
+        ).fetchone()
+        return row[0]
+
+    def push(self, queue, key, data, priority):
+        cursor = self.connection.execute(
+            'INSERT OR IGNORE INTO frontier (queue, key, priority, data, state, attempts) VALUES (?, ?, ?, ?, ?, 0)',
+            (queue, key, priority, data, STATE_PENDING),
+        )
+        return cursor.rowcount == 1
+
+    def lease(self, queue, worker, count, lease_time, max_attempts):
+        # [(key, data, attempts)], expired leases of other workers included
+        now = time()
+        leased = []
+        with self.transaction():
+            rows = self.connection.execute(
+                'SELECT id, key, data, attempts FROM frontier WHERE queue = ? AND (state = ? OR (state = ? AND lease_until < ?)) '
+                'ORDER BY priority DESC, id LIMIT ?',
+                (queue, STATE_PENDING, STATE_LEASED, now, count),
+            ).fetchall()
+            for row_id, key, data, attempts in rows:
+                attempts += 1
+                if attempts > max_attempts:
+                    self.connection.execute('UPDATE frontier SET state = ?, data = NULL, worker = NULL WHERE id = ?', (STATE_DEAD, row_id))
+                    logger.error('Frontier request %(key)s given up after %(attempts)d leases', {'key': key, 'attempts': attempts - 1})
+                    continue
+                self.connection.execute(
+                    'UPDATE frontier SET state = ?, worker = ?, lease_until = ?, attempts = ? WHERE id = ?',
+                    (STATE_LEASED, worker, now + lease_time, attempts, row_id),
+                )
+                leased.append((key, data, attempts))
+        return leased
+
+    def renew(self, queue, worker, keys, lease_time):
+        with self.transaction():
+            for part in chunks(list(keys), SQLITE_CHUNK_SIZE):
+                self.connection.execute(
+                    'UPDATE frontier SET lease_until = ? WHERE queue = ? AND worker = ? AND state = ? AND key IN ({})'.format(', '.join('?' * len(part))),
+                    [time() + lease_time, queue, worker, STATE_LEASED] + part,
+                )
+
+    def ack(self, queue, key):
+        self.connection.execute(
+            'UPDATE frontier SET state = ?, data = NULL, worker = NULL, lease_until = NULL WHERE queue = ? AND key = ?',
+            (STATE_DONE, queue, key),
+        )
+
+    def release(self, queue, worker, keys):
+        # Leased requests given back unfinished, without using up an attempt
+        with self.transaction():
+            for part in chunks(list(keys), SQLITE_CHUNK_SIZE):
+                self.connection.execute(
+                    'UPDATE frontier SET state = ?, worker = NULL, lease_until = NULL, attempts = attempts - 1 '
+                    'WHERE queue = ? AND worker = ? AND state = ? AND key IN ({})'.format(', '.join('?' * len(part))),
+                    [STATE_PENDING, queue, worker, STATE_LEASED] + part,
+                )
+
+    def counts(self, queue):
+        counts = dict.fromkeys(STATES, 0)
+        for state, count in self.connection.execute('SELECT state, COUNT(*) FROM frontier WHERE queue = ? GROUP BY state', (queue,)):
+            counts[state] = count
+        return counts
+
+    def clear(self, queue):
+        self.connection.execute('DELETE FROM frontier WHERE queue = ?', (queue,))
+
+    def close(self):
+        self.connection.close()
+
+
+class SqliteTransaction(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+class KeyValueFrontierBackend(object):
+    # Redis data of a queue, under journal:frontier:<queue>:
+    #   pending   sorted set  key -> score (priority, then first queued first)
+    #   leased    sorted set  key -> lease end time
+    #   data      hash        key -> pickled request (until acknowledged)
+    #   score     hash        key -> pending score of every request ever queued
+    #   owner     hash        key -> worker holding the lease
+    #   attempts  hash        key -> leases so far
+    #   done      set         acknowledged keys
+    #   dead      set         keys given up
+    # Leases are taken in WATCH/MULTI transactions on pending and leased, a
+    # worker whose transaction lost the race reads the queue again.
+
+    def __init__(self, client, watch_error):
+        self.client = client
+        self.watch_error = watch_error
+
+    @classmethod
+    def from_settings(cls, settings):
+        # Redis client is only needed by this backend
+        try:
+            import redis
+        except ImportError:
+            raise NotConfigured('FRONTIER_BACKEND redis needs the redis package')
+        return cls(redis.Redis.from_url(settings.get('FRONTIER_REDIS_URL')), redis.WatchError)
+
+    def name(self, queue, part):
+        return 'journal:frontier:{}:{}'.format(queue, part)
+
+    def open(self, queue):
+        if not self.active(queue):
+            self.clear(queue)
+
+    def active(self, queue):
+        return self.client.zcard(self.name(queue, 'pending')) + self.client.zcard(self.name(queue, 'leased'))
+
+    def push(self, queue, key, data, priority):
+        # Known requests (pending, leased, done or dead) have a score
+        if self.client.hexists(self.name(queue, 'score'), key):
+            return False
+        score = priority * 1e10 - self.client.incr(self.name(queue, 'sequence'))
+        pipe = self.client.pipeline()
+        pipe.hset(self.name(queue, 'data'), key, data)
+        pipe.hset(self.name(queue, 'score'), key, score)
+        pipe.zadd(self.name(queue, 'pending'), {key: score}, nx=True)
+        pipe.execute()
+        return True
+
+    def lease(self, queue, worker, count, lease_time, max_attempts):
+        pending = self.name(queue, 'pending')
+        leased = self.name(queue, 'leased')
+        while True:
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(pending, leased)
+                    now = time()
+                    keys = [text(key) for key in pipe.zrangebyscore(leased, '-inf', now, start=0, num=count)]
+                    keys += [text(key) for key in pipe.zrevrange(pending, 0, count - len(keys) - 1)] if len(keys) < count else []
+                    if not keys:
+                        pipe.unwatch()
+                        return []
+                    attempts = [int(value or 0) + 1 for value in pipe.hmget(self.name(queue, 'attempts'), keys)]
+                    data = pipe.hmget(self.name(queue, 'data'), keys)
+
+                    pipe.multi()
+                    result = []
+                    for key, key_attempts, key_data in zip(keys, attempts, data):
+                        pipe.zrem(pending, key)
+                        if key_attempts > max_attempts:
+                            pipe.zrem(leased, key)
+                            pipe.hdel(self.name(queue, 'data'), key)
+                            pipe.sadd(self.name(queue, 'dead'), key)
+                            continue
+                        pipe.zadd(leased, {key: now + lease_time})
+                        pipe.hset(self.name(queue, 'owner'), key, worker)
+                        pipe.hset(self.name(queue, 'attempts'), key, key_attempts)
+                        result.append((key, key_data, key_attempts))
+                    pipe.execute()
+                except self.watch_error:
+                    continue
+            for key, key_attempts in zip(keys, attempts):
+                if key_attempts > max_attempts:
+                    logger.error('Frontier request %(key)s given up after %(attempts)d leases', {'key': key, 'attempts': key_attempts - 1})
+            return result
+
+    def owned(self, queue, worker, keys):
+        owners = self.client.hmget(self.name(queue, 'owner'), keys) if keys else []
+        return [key for key, owner in zip(keys, owners) if text(owner) == worker]
+
+    def renew(self, queue, worker, keys, lease_time):
+        keys = self.owned(queue, worker, list(keys))
+        if keys:
+            self.client.zadd(self.name(queue, 'leased'), {key: time() + lease_time for key in keys}, xx=True)
+
+    def ack(self, queue, key):
+        pipe = self.client.pipeline()
+        pipe.zrem(self.name(queue, 'leased'), key)
+        pipe.zrem(self.name(queue, 'pending'), key)
+        pipe.hdel(self.name(queue, 'data'), key)
+        pipe.hdel(self.name(queue, 'owner'), key)
+        pipe.sadd(self.name(queue, 'done'), key)
+        pipe.execute()
+
+    def release(self, queue, worker, keys):
+        keys = self.owned(queue, worker, list(keys))
+        if not keys:
+            return
+        scores = self.client.hmget(self.name(queue, 'score'), keys)
+        pipe = self.client.pipeline()
+        for key, score in zip(keys, scores):
+            pipe.zrem(self.name(queue, 'leased'), key)
+            pipe.hdel(self.name(queue, 'owner'), key)
+            pipe.hincrby(self.name(queue, 'attempts'), key, -1)
+            pipe.zadd(self.name(queue, 'pending'), {key: float(score)})
+        pipe.execute()
+
+    def counts(self, queue):
+        return {
+            STATE_PENDING: self.client.zcard(self.name(queue, 'pending')),
+            STATE_LEASED: self.client.zcard(self.name(queue, 'leased')),
+            STATE_DONE: self.client.scard(self.name(queue, 'done')),
+            STATE_DEAD: self.client.scard(self.name(queue, 'dead')),
+        }
+
+    def clear(self, queue):
+        self.client.delete(*[self.name(queue, part) for part in ('pending', 'leased', 'data', 'score', 'owner', 'attempts', 'done', 'dead', 'sequence')])
+
+    def close(self):
+        pass
+
+
+class InProcessWatchError(Exception):
+    pass
+
+
+class InProcessKeyValueStore(object):
+    # The Redis commands of KeyValueFrontierBackend on dicts, with the same
+    # pipeline semantics (WATCH, MULTI/EXEC, WatchError when a watched key
+    # changed), to run the redis backend without a server
+
+    def __init__(self):
+        self.data = {}
+        self.versions = {}
+        self.lock = threading.RLock()
+
+    def changed(self, name):
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def version(self, name):
+        return self.versions.get(name, 0)
+
+    def pipeline(self, transaction=True):
+        return InProcessPipeline(self)
+
+    # Sorted sets
+
+    def zadd(self, name, mapping, nx=False, xx=False):
+        with self.lock:
+            zset = self.data.setdefault(name, {})
+            added = 0
+            for member, score in mapping.items():
+                exists = member in zset
+                if (nx and exists) or (xx and not exists):
+                    continue
+                added += not exists
+                zset[member] = float(score)
+                self.changed(name)
+            return added
+
+    def zrem(self, name, *members):
+        with self.lock:
+            zset = self.data.get(name, {})
+            removed = [member for member in members if zset.pop(member, None) is not None]
+            if removed:
+                self.changed(name)
+            return len(removed)
+
+    def zcard(self, name):
+        return len(self.data.get(name, {}))
+
+    def zscore(self, name, member):
+        return self.data.get(name, {}).get(member)
+
+    def zrevrange(self, name, start, end):
+        members = sorted(self.data.get(name, {}).items(), key=lambda item: (-item[1], item[0]))
+        return [member for member, score in members[start:None if end == -1 else end + 1]]
+
+    def zrangebyscore(self, name, min, max, start=None, num=None):
+        low = float(min)
+        high = float(max)
+        members = sorted((score, member) for member, score in self.data.get(name, {}).items() if low <= score <= high)
+        members = [member for score, member in members]
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    # Hashes
+
+    def hset(self, name, key, value):
+        with self.lock:
+            new = key not in self.data.setdefault(name, {})
+            self.data[name][key] = value
+            self.changed(name)
+            return int(new)
+
+    def hget(self, name, key):
+        return self.data.get(name, {}).get(key)
+
+    def hmget(self, name, keys):
+        return [self.data.get(name, {}).get(key) for key in keys]
+
+    def hexists(self, name, key):
+        return key in self.data.get(name, {})
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            removed = [key for key in keys if self.data.get(name, {}).pop(key, None) is not None]
+            if removed:
+                self.changed(name)
+            return len(removed)
+
+    def hincrby(self, name, key, amount=1):
+        with self.lock:
+            value = int(self.data.setdefault(name, {}).get(key, 0)) + amount
+            self.data[name][key] = value
+            self.changed(name)
+            return value
+
+    # Sets, counters, keys
+
+    def sadd(self, name, *members):
+        with self.lock:
+            members_set = self.data.setdefault(name, set())
+            added = len(set(members) - members_set)
+            members_set.update(members)
+            self.changed(name)
+            return added
+
+    def scard(self, name):
+        return len(self.data.get(name, ()))
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.data[name] = self.data.get(name, 0) + amount
+            self.changed(name)
+            return self.data[name]
+
+    def delete(self, *names):
+        with self.lock:
+            removed = 0
+            for name in names:
+                if self.data.pop(name, None) is not None:
+                    removed += 1
+                    self.changed(name)
+            return removed
+
+
+class InProcessPipeline(object):
+    # redis-py pipeline: commands run at once after watch(), are queued after
+    # multi() (or from the start without watch()) and run by execute()
+
+    def __init__(self, store):
+        self.store = store
+        self.watched = {}
+        self.queued = []
+        self.immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def reset(self):
+        self.watched = {}
+        self.queued = []
+        self.immediate = False
+
+    def watch(self, *names):
+        self.immediate = True
+        for name in names:
+            self.watched[name] = self.store.version(name)
+
+    def unwatch(self):
+        self.watched = {}
+
+    def multi(self):
+        self.immediate = False
+
+    def execute(self):
+        with self.store.lock:
+            try:
+                if any(self.store.version(name) != version for name, version in self.watched.items()):
+                    raise InProcessWatchError('Watched key changed')
+                return [getattr(self.store, command)(*args, **kwargs) for command, args, kwargs in self.queued]
+            finally:
+                self.reset()
+
+    def __getattr__(self, command):
+        method = getattr(self.store, command)
+        if self.immediate:
+            return method
+
+        def queue(*args, **kwargs):
+            self.queued.append((command, args, kwargs))
+            return self
+        return queue
+
+
+# In-process stores of the memory backend, by FRONTIER_MEMORY_NAME
+_stores = {}
+
+
+def memory_backend(settings):
+    store = _stores.setdefault(settings.get('FRONTIER_MEMORY_NAME', 'default'), InProcessKeyValueStore())
+    return KeyValueFrontierBackend(store, InProcessWatchError)
+
+
+BACKENDS = {
+    'sqlite': SqliteFrontierBackend.from_settings,
+    'redis': KeyValueFrontierBackend.from_settings,
+    'memory': memory_backend,
+}
+
+
+def open_backend(settings):
+    return BACKENDS[settings.get('FRONTIER_BACKEND', 'sqlite')](settings)
+
+
+def frontier_ack(crawler, request, failed=False):
+    # Called by the frontier middlewares once a request went through the spider
+    key = request.meta.get('frontier_key')
+    scheduler = getattr(crawler.engine, 'scheduler', None)
+    if key is not None and isinstance(scheduler, FrontierScheduler):
+        scheduler.ack(key, failed=failed)
+
+
+class FrontierScheduler(Scheduler):
+    # Scrapy scheduler whose requests, but the login flow and retries of
+    # leased requests, are kept in the shared frontier. Requests are
+    # acknowledged by journal.middlewares.FrontierSpiderMiddleware (response
+    # went through the spider) and FrontierDownloaderMiddleware (download
+    # failed for good).
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super(FrontierScheduler, cls).from_crawler(crawler)
+        settings = crawler.settings
+        scheduler.frontier = open_backend(settings)
+        scheduler.queue_name = settings.get('FRONTIER_QUEUE')
+        scheduler.worker = settings.get('FRONTIER_WORKER') or '{}-{}'.format(socket.gethostname(), os.getpid())
+        scheduler.lease_size = settings.getint('FRONTIER_LEASE_SIZE')
+        scheduler.lease_time = settings.getfloat('FRONTIER_LEASE_TIME')
+        scheduler.max_attempts = settings.getint('FRONTIER_MAX_ATTEMPTS')
+        scheduler.poll_interval = settings.getfloat('FRONTIER_POLL_INTERVAL')
+        scheduler.leased = deque()
+        scheduler.held = set()
+        scheduler.next_poll = 0
+        crawler.signals.connect(scheduler.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(scheduler.request_dropped, signal=signals.request_dropped)
+        return scheduler
+
+    def open(self, spider):
+        result = super(FrontierScheduler, self).open(spider)
+        self.queue_name = self.queue_name or spider.name
+        self.frontier.open(self.queue_name)
+        # Leases of requests still worked on don't expire
+        self.renew_task = task.LoopingCall(self.renew)
+        self.renew_task.start(max(self.lease_time / 3, 1), now=False)
+        logger.info('Frontier queue %(queue)s, worker %(worker)s: %(counts)s', {
+            'queue': self.queue_name, 'worker': self.worker, 'counts': self.frontier.counts(self.queue_name),
+        })
+        return result
+
+    def close(self, reason):
+        if self.renew_task.running:
+            self.renew_task.stop()
+        # Others take over what this worker didn't finish
+        if self.held:
+            self.frontier.release(self.queue_name, self.worker, self.held)
+            self.stats.inc_value('frontier/released', len(self.held), spider=self.spider)
+        self.frontier.close()
+        return super(FrontierScheduler, self).close(reason)
+
+    def is_local(self, request):
+        return 'frontier_key' in request.meta or request.meta.get('dont_relogin')
+
+    def enqueue_request(self, request):
+        if self.is_local(request):
+            return super(FrontierScheduler, self).enqueue_request(request)
+        try:
+            data = pickle.dumps(request.to_dict(spider=self.spider), protocol=4)
+        except (ValueError, pickle.PicklingError, AttributeError, TypeError) as e:
+            # Callback which is not a spider method, or meta which can't be pickled
+            logger.debug('Unable to queue %(request)s in the frontier: %(reason)s', {'request': request, 'reason': e})
+            self.stats.inc_value('frontier/unserializable', spider=self.spider)
+            return super(FrontierScheduler, self).enqueue_request(request)
+
+        if not self.frontier.push(self.queue_name, self.frontier_key(request), data, request.priority):
+            self.stats.inc_value('frontier/duplicates', spider=self.spider)
+            return False
+        self.stats.inc_value('frontier/pushed', spider=self.spider)
+        return True
+
+    def frontier_key(self, request):
+        key = self.crawler.request_fingerprinter.fingerprint(request).hex()
+        if request.dont_filter:
+            # Queued again on purpose (the journals after the login), not deduplicated
+            return '{}-{}'.format(key, uuid4().hex)
+        return key
+
+    def next_request(self):
+        request = super(FrontierScheduler, self).next_request()
+        if request is not None:
+            return request
+
+        if not self.leased and time() >= self.next_poll:
+            for key, data, attempts in self.frontier.lease(self.queue_name, self.worker, self.lease_size, self.lease_time, self.max_attempts):
+                self.leased.append((key, data))
+                self.held.add(key)
+                self.stats.inc_value('frontier/leased', spider=self.spider)
+                if attempts > 1:
+                    self.stats.inc_value('frontier/redelivered', spider=self.spider)
+            if not self.leased:
+                self.next_poll = time() + self.poll_interval
+        if not self.leased:
+            return None
+
+        key, data = self.leased.popleft()
+        request = request_from_dict(pickle.loads(data), spider=self.spider)
+        request.meta['frontier_key'] = key
+        self.stats.inc_value('scheduler/dequeued', spider=self.spider)
+        return request
+
+    def has_pending_requests(self):
+        return super(FrontierScheduler, self).has_pending_requests() or bool(self.leased)
+
+    def ack(self, key, failed=False):
+        if key not in self.held:
+            return
+        self.held.discard(key)
+        self.frontier.ack(self.queue_name, key)
+        self.stats.inc_value('frontier/failed' if failed else 'frontier/acked', spider=self.spider)
+
+    def renew(self):
+        if self.held:
+            self.frontier.renew(self.queue_name, self.worker, self.held, self.lease_time)
+
+    def request_dropped(self, request, spider):
+        # Retry or redirect of a leased request refused by the local queues
+        key = request.meta.get('frontier_key')
+        if key is not None:
+            self.ack(key, failed=True)
+
+    def spider_idle(self, spider):
+        # Nothing is left in the engine, so the leased requests still held
+        # were dropped on the way without reaching the frontier middlewares
+        # (IgnoreRequest of process_response, offsite redirect, errback)
+        for key in list(self.held):
+            self.stats.inc_value('frontier/dropped', spider=self.spider)
+            self.ack(key, failed=True)
+        # Other workers may still queue requests, or die and leave theirs
+        if self.frontier.active(self.queue_name):
+            raise DontCloseSpider
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m journal.frontier', description='Inspect or clear a crawl frontier queue')
+    parser.add_argument('command', choices=['status', 'clear'])
+    parser.add_argument('queue', help='FRONTIER_QUEUE, the spider name by default')
+    args = parser.parse_args(argv)
+
+    backend = open_backend(get_project_settings())
+    if args.command == 'clear':
+        backend.clear(args.queue)
+    print(', '.join('{} {}'.format(state, count) for state, count in backend.counts(args.queue).items()))
+    backend.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
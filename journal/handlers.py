@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+
+# Download handlers
+#
+# See documentation in:
+# https://doc.scrapy.org/en/latest/topics/settings.html#download-handlers
+
+import hashlib
+import json
+import os
+import os.path
+import re
+import threading
+from io import BytesIO
+from queue import Queue
+from random import randint
+from time import sleep, time
+from weakref import WeakKeyDictionary
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.http import Headers, HtmlResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.misc import build_from_crawler
+from scrapy.utils.python import to_bytes
+from twisted.internet import defer, threads
+from twisted.internet.error import TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.python.threadpool import ThreadPool
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers as TxHeaders
+
+from journal.validation import InvalidPdf, PdfValidator
+
+
+CONTENT_RANGE_RE = re.compile(br'bytes\s+(\d+)-\d+/(\d+|\*)')
+
+
+class PartialFile(object):
+    # <stream_to>/<sha1 of the URL>.part and its .json validator, kept when a
+    # resumable download is interrupted so the next attempt (a retry or the
+    # next run) only asks for the missing bytes. The offset to resume from
+    # is the size of the .part file, whatever was written before a crash.
+
+    def __init__(self, stream_to, url):
+        name = hashlib.sha1(to_bytes(url)).hexdigest()
+        self.path = os.path.join(stream_to, name + '.part')
+        self.info_path = os.path.join(stream_to, name + '.json')
+
+    def load(self):
+        # (offset, validator) of an interrupted download, (0, None) if none
+        try:
+            with open(self.info_path) as f:
+                info = json.load(f)
+            offset = os.path.getsize(self.path)
+        except (IOError, OSError, ValueError):
+            return 0, None
+        return offset, info.get('validator')
+
+    def save(self, url, validator, length):
+        with open(self.info_path, 'w') as f:
+            json.dump({'url': url, 'validator': validator, 'length': length}, f)
+
+    def discard(self, keep_body=False):
+        paths = [self.info_path] if keep_body else [self.info_path, self.path]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def range_validator(headers):
+    # If-Range value of a response: strong ETag or Last-Modified
+    etag = headers.get(b'ETag')
+    if etag and not etag.startswith(b'W/'):
+        return etag.decode('latin1')
+    last_modified = headers.get(b'Last-Modified')
+    if last_modified:
+        return last_modified.decode('latin1')
+    return None
+
+
+class FileBodyWriter(Protocol):
+    # Writes response body to file chunk by chunk, hashing it on the fly.
+    # With offset the body is appended to the first offset bytes already in
+    # the file (resumed download). The file of a resumable download is kept
+    # when the connection is lost or the download is cancelled. With a
+    # journal.validation.PdfValidator the download is stopped and the file
+    # removed as soon as the body can't be a PDF.
+
+    def __init__(self, finished, file_path, maxsize, offset=0, resumable=False, validator=None, url=None):
+        self.finished = finished
+        self.file_path = file_path
+        self.maxsize = maxsize
+        self.resumable = resumable
+        self.validator = validator
+        self.url = url
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        if offset:
+            self.hash_existing(offset)
+            self.file = open(file_path, 'r+b')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file = open(file_path, 'wb')
+        self.size = offset
+        self.error = None
+        self.keep = False
+
+    def hash_existing(self, offset):
+        with open(self.file_path, 'rb') as f:
+            remaining = offset
+            while remaining:
+                data = f.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                self.md5.update(data)
+                self.sha256.update(data)
+                if self.validator is not None:
+                    self.validator.feed(data)
+                remaining -= len(data)
+
+    def dataReceived(self, data):
+        if self.error is not None:
+            return
+        if self.validator is not None and self.validator.feed(data):
+            self.abort(InvalidPdf(self.validator.reason, self.url))
+            return
+        self.file.write(data)
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+        if self.maxsize and self.size > self.maxsize:
+            self.abort('Response size ({}) larger than download max size ({})'.format(self.size, self.maxsize))
+
+    def abort(self, error, keep=False):
+        self.error = error
+        self.keep = keep and self.resumable
+        # Rest of the body may be in the buffers, the connection can't be
+        # reused: stopping the TCP transport closes it
+        self.transport.stopProducing()
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.file.close()
+        if self.error is None and reason.check(ResponseDone, PotentialDataLoss):
+            if self.validator is not None and self.validator.finish():
+                os.remove(self.file_path)
+                self.finished.errback(InvalidPdf(self.validator.reason, self.url))
+                return
+            self.finished.callback({
+                'path': self.file_path,
+                'size': self.size,
+                'checksum': self.md5.hexdigest(),
+                'sha256': self.sha256.hexdigest(),
+            })
+            return
+
+        # Interrupted, what arrived is kept for a Range request
+        if not (self.keep or (self.error is None and self.resumable)):
+            os.remove(self.file_path)
+        if self.finished.called:
+            return
+        if isinstance(self.error, Exception):
+            self.finished.errback(self.error)
+        elif self.error is not None:
+            self.finished.errback(defer.CancelledError(self.error))
+        else:
+            self.finished.errback(reason)
+
+
+class FileBodyBuffer(Protocol):
+    # Small text bodies (login and error pages) are kept in memory
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.buffer = BytesIO()
+
+    def dataReceived(self, data):
+        self.buffer.write(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.buffer.getvalue())
+        else:
+            self.finished.errback(reason)
+
+
+class StreamingDownloadHandler(HTTP11DownloadHandler):
+    # Scrapy HTTP handler which streams successful non-text responses of
+    # requests with meta['stream_to'] (a directory) into a temp file there
+    # instead of buffering the body in memory. Response body stays empty and
+    # meta['streamed_file'] describes the file. Text responses (login and
+    # error pages) are kept in memory, all other requests go through the
+    # Scrapy handler untouched.
+    #
+    # Files of responses with a strong ETag or a Last-Modified are kept when
+    # the download is interrupted (see PartialFile), the next request of the
+    # URL asks for the rest with Range/If-Range and gets a 200 response of
+    # the whole file (flagged 'resumed') when the server sends a 206.
+    #
+    # Bodies of requests with meta['validate_pdf'] are checked as they
+    # arrive (journal.validation), the download fails with InvalidPdf as
+    # soon as it can't be a PDF.
+    lazy = False
+
+    def __init__(self, crawler):
+        super(StreamingDownloadHandler, self).__init__(crawler)
+        from twisted.internet import reactor
+
+        settings = crawler.settings
+        self.settings = settings
+        self.stats = crawler.stats
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max(settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN'), settings.getint('ADAPTIVE_MAX_CONCURRENCY'))
+        self.agent = Agent(reactor, contextFactory=self._contextFactory, pool=self.pool)
+        self.timeout = settings.getfloat('DOWNLOAD_TIMEOUT')
+        self.maxsize = settings.getint('DOWNLOAD_MAXSIZE')
+
+    async def download_request(self, request):
+        # HTTP proxies are left to the Scrapy handler too
+        if not request.meta.get('stream_to') or request.meta.get('proxy'):
+            return await super(StreamingDownloadHandler, self).download_request(request)
+        return await maybe_deferred_to_future(self.stream_request(request))
+
+    def stream_request(self, request):
+        from twisted.internet import reactor
+
+        headers = TxHeaders(request.headers)
+        # Compressed body can't be written as is
+        headers.removeHeader(b'Accept-Encoding')
+        body = FileBodyProducer(BytesIO(request.body)) if request.body else None
+
+        # Only the missing bytes of an interrupted download
+        partial = PartialFile(request.meta['stream_to'], request.url)
+        offset, validator = partial.load()
+        if offset and validator:
+            headers.setRawHeaders(b'Range', [to_bytes('bytes={}-'.format(offset))])
+            headers.setRawHeaders(b'If-Range', [to_bytes(validator)])
+        else:
+            offset = 0
+
+        start_time = time()
+        dfd = self.agent.request(to_bytes(request.method), to_bytes(request.url), headers, body)
+        dfd.addCallback(self.cb_headers, request, start_time, partial, offset)
+
+        timeout = request.meta.get('download_timeout') or self.timeout
+        timeout_call = reactor.callLater(timeout, dfd.cancel)
+
+        def cancel_timeout(result):
+            if timeout_call.active():
+                timeout_call.cancel()
+            return result
+
+        def cb_timeout(failure):
+            failure.trap(defer.CancelledError)
+            if not timeout_call.active():
+                raise TimeoutError('Getting {} took longer than {} seconds.'.format(request.url, timeout))
+            return failure
+
+        dfd.addErrback(cb_timeout)
+        dfd.addBoth(cancel_timeout)
+        return dfd
+
+    def cb_headers(self, txresponse, request, start_time, partial, offset):
+        request.meta['download_latency'] = time() - start_time
+        headers = Headers(txresponse.headers.getAllRawHeaders())
+        content_type = headers.get(b'Content-Type', b'').lower()
+
+        resumed = txresponse.code == 206 and offset
+        if resumed:
+            match = CONTENT_RANGE_RE.match(headers.get(b'Content-Range', b''))
+            if match is None or int(match.group(1)) != offset:
+                # Not the part asked for, next attempt starts over
+                partial.discard()
+                finished = defer.Deferred()
+                txresponse.deliverBody(FileBodyBuffer(finished))
+                finished.addCallback(self.cb_bad_range, request, headers)
+                return finished
+            self.stats.inc_value('streaming/resumed')
+            self.stats.inc_value('streaming/resumed_bytes', offset)
+        elif txresponse.code != 200 or content_type.startswith(b'text/'):
+            finished = defer.Deferred()
+            txresponse.deliverBody(FileBodyBuffer(finished))
+            finished.addCallback(self.build_response, txresponse, request, headers)
+            return finished
+        else:
+            # Whole file, the server ignored the Range or the file changed
+            offset = 0
+
+        stream_to = request.meta['stream_to']
+        if not os.path.exists(stream_to):
+            os.makedirs(stream_to)
+
+        # Validator of a new download, kept for a Range request if interrupted
+        validator = range_validator(headers)
+        if not resumed:
+            if validator:
+                length = headers.get(b'Content-Length')
+                partial.save(request.url, validator, int(length) if length and length.isdigit() else None)
+            else:
+                partial.discard()
+
+        pdf_validator = None
+        if request.meta.get('validate_pdf'):
+            pdf_validator = PdfValidator.from_settings(self.settings)
+            pdf_validator.check_headers(headers)
+
+        maxsize = request.meta.get('download_maxsize', self.maxsize)
+        finished = defer.Deferred(canceller=lambda d: writer.abort('Download cancelled', keep=True))
+        writer = FileBodyWriter(
+            finished, partial.path, maxsize, offset=offset, resumable=bool(resumed or validator),
+            validator=pdf_validator, url=request.url,
+        )
+        txresponse.deliverBody(writer)
+        finished.addCallback(self.cb_streamed, txresponse, request, headers, partial, resumed)
+        finished.addErrback(self.cb_interrupted, writer, partial)
+        return finished
+
+    def cb_bad_range(self, body, request, headers):
+        raise IOError('Unexpected Content-Range {} resuming {}'.format(headers.get(b'Content-Range'), request.url))
+
+    def cb_streamed(self, streamed_file, txresponse, request, headers, partial, resumed):
+        partial.discard(keep_body=True)
+        request.meta['streamed_file'] = streamed_file
+        if resumed:
+            # The whole file is there now
+            headers.pop(b'Content-Range', None)
+            return self.build_response(b'', txresponse, request, headers, flags=['streamed', 'resumed'], status=200)
+        return self.build_response(b'', txresponse, request, headers, flags=['streamed'])
+
+    def cb_interrupted(self, failure, writer, partial):
+        if failure.check(InvalidPdf):
+            self.stats.inc_value('pdf_validation/aborted')
+            self.stats.inc_value('pdf_validation/aborted/{}'.format(failure.value.reason))
+        if os.path.exists(partial.path):
+            self.stats.inc_value('streaming/interrupted')
+        else:
+            partial.discard()
+        return failure
+
+    def build_response(self, body, txresponse, request, headers, flags=None, status=None):
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return respcls(url=request.url, status=status or txresponse.code, headers=headers, body=body, flags=flags, request=request)
+
+    async def close(self):
+        await maybe_deferred_to_future(self.pool.closeCachedConnections())
+        await super(StreamingDownloadHandler, self).close()
+
+
+class BrowserPool(object):
+    # N headless Chrome instances driven from a thread pool of the same size,
+    # so page rendering never runs on the reactor thread.
+
+    def __init__(self, settings, stats=None):
+        from twisted.internet import reactor
+
+        self.settings = settings
+        self.stats = stats
+        self.size = settings.getint('BROWSER_POOL_SIZE', 2)
+        self.page_wait = settings.getfloat('BROWSER_PAGE_WAIT', 0)
+        self.credentials = settings.getdict('CREDENTIALS')
+        self.login_form_xpath = '//form[@id="mc1"]'
+        self.drivers = Queue()
+        self.all_drivers = []
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=self.size, name='browser_pool')
+        self.threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.close)
+
+    def create_driver(self):
+        # Selenium is only needed by the spiders which render pages
+        from selenium import webdriver
+
+        options = webdriver.ChromeOptions()
+        if self.settings.getbool('BROWSER_HEADLESS', True):
+            options.add_argument('--headless')
+        return webdriver.Chrome(self.settings.get('CHROME_PATH'), options=options)
+
+    def acquire_driver(self):
+        with self.lock:
+            self.queue_depth -= 1
+            if self.drivers.empty() and len(self.all_drivers) < self.size:
+                driver_id = len(self.all_drivers)
+                self.all_drivers.append(None)
+            else:
+                driver_id = None
+
+        if driver_id is None:
+            driver_id, driver = self.drivers.get()
+            if driver is not None:
+                return driver_id, driver
+
+        # New browser, or the slot of one which failed to start
+        try:
+            driver = self.create_driver()
+        except Exception:
+            # Slot back to the pool, else the callers waiting for a browser
+            # wait forever: the next one tries to start it again
+            self.drivers.put((driver_id, None))
+            raise
+        self.all_drivers[driver_id] = driver
+        return driver_id, driver
+
+    def release_driver(self, driver_id, driver):
+        self.drivers.put((driver_id, driver))
+
+    def login_to_library(self, driver):
+        # Check need login or not
+        if not driver.find_elements_by_xpath(self.login_form_xpath + '/input[@name="user"]'):
+            return False
+
+        user = driver.find_element_by_xpath(self.login_form_xpath + '/input[@name="user"]')
+        user.send_keys(self.credentials['user'])
+        sleep(randint(2, 4))
+
+        password = driver.find_element_by_xpath(self.login_form_xpath + '/input[@name="pass"]')
+        password.send_keys(self.credentials['pass'])
+        sleep(randint(2, 4))
+
+        login = driver.find_element_by_xpath(self.login_form_xpath + '/input[@value="Login"]')
+        login.click()
+        return True
+
+    def render(self, request):
+        driver_id, driver = self.acquire_driver()
+        try:
+            start_time = time()
+            driver.get(request.url)
+            sleep(self.page_wait)
+
+            if request.meta.get('browser_login') and self.login_to_library(driver):
+                sleep(self.page_wait)
+
+            url = driver.current_url
+            body = driver.page_source
+            request.meta['browser_cookies'] = driver.get_cookies()
+            latency = time() - start_time
+        finally:
+            self.release_driver(driver_id, driver)
+
+        if url != request.url:
+            request.meta.setdefault('redirect_urls', [request.url])
+        request.meta['download_latency'] = latency
+        request.meta['browser_instance'] = driver_id
+        return driver_id, latency, HtmlResponse(url, body=body, encoding='utf-8', request=request)
+
+    def record_stats(self, result):
+        driver_id, latency, response = result
+        if self.stats:
+            prefix = 'browser_pool/instance_{}'.format(driver_id)
+            self.stats.inc_value(prefix + '/pages')
+            self.stats.inc_value(prefix + '/latency_total', latency)
+            self.stats.max_value(prefix + '/latency_max', latency)
+            self.stats.set_value(prefix + '/latency_avg', self.stats.get_value(prefix + '/latency_total') / self.stats.get_value(prefix + '/pages'))
+            self.stats.set_value('browser_pool/queue_depth', self.queue_depth)
+        return response
+
+    def download(self, request):
+        from twisted.internet import reactor
+
+        with self.lock:
+            self.queue_depth += 1
+        if self.stats:
+            self.stats.set_value('browser_pool/queue_depth', self.queue_depth)
+            self.stats.max_value('browser_pool/queue_depth_max', self.queue_depth)
+
+        dfd = threads.deferToThreadPool(reactor, self.threadpool, self.render, request)
+        dfd.addCallback(self.record_stats)
+        return dfd
+
+    def close(self):
+        if not self.threadpool.started:
+            return
+        self.threadpool.stop()
+        for driver in self.all_drivers:
+            if driver is not None:
+                driver.quit()
+
+
+# One pool per crawler, shared by the http and https handler instances
+_pools = WeakKeyDictionary()
+
+
+class BrowserPoolDownloadHandler(object):
+    # Renders requests flagged with meta['browser'] in the BrowserPool and
+    # hands the page source back as a regular HtmlResponse. Every other
+    # request (PDF files, RIS files) goes through the streaming HTTP handler.
+    lazy = False
+
+    def __init__(self, settings, crawler):
+        self.settings = settings
+        self.crawler = crawler
+        self.default_handler = build_from_crawler(StreamingDownloadHandler, crawler)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler)
+
+    @property
+    def pool(self):
+        if self.crawler not in _pools:
+            _pools[self.crawler] = BrowserPool(self.settings, self.crawler.stats)
+        return _pools[self.crawler]
+
+    async def download_request(self, request):
+        if request.meta.get('browser'):
+            return await maybe_deferred_to_future(self.pool.download(request))
+        return await self.default_handler.download_request(request)
+
+    async def close(self):
+        if self.crawler in _pools:
+            _pools.pop(self.crawler).close()
+        await self.default_handler.close()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Single-file cache of the journal, volume list and issue TOC pages
+#
+# Pages are keyed by request fingerprint in one SQLite file, headers and
+# body compressed with zlib, along with the page type they were cached as,
+# their ETag/Last-Modified validators and the time they were last known to
+# be current. Used by journal.middlewares.PageCacheDownloaderMiddleware.
+
+import json
+import sqlite3
+import zlib
+from time import time
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+
+FIELDS = [
+    'fingerprint',
+    'url',
+    'page_type',
+    'status',
+    'headers',
+    'body',
+    'etag',
+    'last_modified',
+    'validated',
+]
+
+
+def compress_headers(headers):
+    headers = {key.decode('latin1'): [value.decode('latin1') for value in values] for key, values in headers.items()}
+    return zlib.compress(json.dumps(headers).encode('utf-8'))
+
+
+def decompress_headers(data):
+    headers = json.loads(zlib.decompress(data).decode('utf-8'))
+    return Headers({key: [value.encode('latin1') for value in values] for key, values in headers.items()})
+
+
+class PageCache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'fingerprint TEXT PRIMARY KEY, url TEXT, page_type TEXT, status INTEGER, '
+            'headers BLOB, body BLOB, etag TEXT, last_modified TEXT, validated REAL)'
+        )
+        self.connection.commit()
+
+    def get(self, fingerprint):
+        row = self.connection.execute(
+            'SELECT {} FROM pages WHERE fingerprint = ?'.format(', '.join(FIELDS)), (fingerprint,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(FIELDS, row))
+
+    def store(self, fingerprint, page_type, response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        self.connection.execute(
+            'INSERT OR REPLACE INTO pages ({}) VALUES ({})'.format(', '.join(FIELDS), ', '.join('?' * len(FIELDS))),
+            (
+                fingerprint,
+                response.url,
+                page_type,
+                response.status,
+                compress_headers(response.headers),
+                zlib.compress(response.body),
+                etag.decode('latin1') if etag else None,
+                last_modified.decode('latin1') if last_modified else None,
+                time(),
+            ),
+        )
+        self.connection.commit()
+
+    def touch(self, fingerprint, page_type):
+        # Server said the page didn't change
+        self.connection.execute(
+            'UPDATE pages SET page_type = ?, validated = ? WHERE fingerprint = ?', (page_type, time(), fingerprint)
+        )
+        self.connection.commit()
+
+    def response(self, entry, request):
+        headers = decompress_headers(entry['headers'])
+        body = zlib.decompress(entry['body'])
+        respcls = responsetypes.from_args(headers=headers, url=entry['url'], body=body)
+        return respcls(url=entry['url'], status=entry['status'], headers=headers, body=body, flags=['cached'], request=request)
+
+    def close(self):
+        self.connection.close()
@@ -7,7 +7,7 @@
 
 import scrapy
 import re
-from scrapy.loader.processors import Identity, MapCompose
+from itemloaders.processors import Identity, MapCompose
 
 
 def prevent_spec_chars(some_string):
@@ -51,8 +51,11 @@ class TaylorItem(scrapy.Item):
     volume_title = scrapy.Field()
     issue_number = scrapy.Field()
     article_title = scrapy.Field()
+    article_key = scrapy.Field()
     file_urls = scrapy.Field()
     files = scrapy.Field()
+    ris_body = scrapy.Field()
+    pdf_fallback_url = scrapy.Field()
 
 
 class WileyItem(scrapy.Item):
@@ -60,5 +63,8 @@ class WileyItem(scrapy.Item):
     volume_title = scrapy.Field()
     issue_number = scrapy.Field()
     article_title = scrapy.Field()
+    article_key = scrapy.Field()
     file_urls = scrapy.Field()
     files = scrapy.Field()
+    ris_body = scrapy.Field()
+    pdf_fallback_url = scrapy.Field()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Persistent record of downloaded articles
+#
+# Articles are keyed by DOI (or canonical article URL when no DOI can be
+# found), so rerunning a spider over the same journals.csv skips articles
+# which were completely downloaded before.
+
+import re
+import sqlite3
+from time import time
+from urllib.parse import unquote
+
+from w3lib.url import canonicalize_url
+
+DOI_RE = re.compile(r'(10\.\d{4,9}/[^?#\s]+)')
+
+STATUS_DOWNLOADED = 'downloaded'
+STATUS_MISSING = 'missing'
+STATUS_FAILED = 'failed'
+
+FIELDS = [
+    'article_key',
+    'journal_name',
+    'article_url',
+    'pdf_status',
+    'pdf_path',
+    'pdf_size',
+    'pdf_checksum',
+    'pdf_error',
+    'ris_status',
+    'ris_path',
+    'ris_size',
+    'ris_checksum',
+    'updated',
+]
+
+
+def article_doi(url):
+    # DOI in an article URL, as written there
+    match = DOI_RE.search(unquote(url))
+    if match:
+        return match.group(1)
+    return None
+
+
+def article_key(url):
+    doi = article_doi(url)
+    if doi:
+        return 'doi:' + doi.lower()
+    return canonicalize_url(url)
+
+
+class DownloadLedger(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS articles ('
+            'article_key TEXT PRIMARY KEY, journal_name TEXT, article_url TEXT, '
+            'pdf_status TEXT, pdf_path TEXT, pdf_size INTEGER, pdf_checksum TEXT, pdf_error TEXT, '
+            'ris_status TEXT, ris_path TEXT, ris_size INTEGER, ris_checksum TEXT, '
+            'updated REAL)'
+        )
+        # Ledgers written before the PDF checks
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(articles)')]
+        if 'pdf_error' not in columns:
+            self.connection.execute('ALTER TABLE articles ADD COLUMN pdf_error TEXT')
+        self.connection.commit()
+
+    def get(self, key):
+        row = self.connection.execute(
+            'SELECT {} FROM articles WHERE article_key = ?'.format(', '.join(FIELDS)), (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(FIELDS, row))
+
+    def update(self, key, **values):
+        values['updated'] = time()
+        columns = sorted(values)
+        self.connection.execute('INSERT OR IGNORE INTO articles (article_key) VALUES (?)', (key,))
+        self.connection.execute(
+            'UPDATE articles SET {} WHERE article_key = ?'.format(', '.join('{} = ?'.format(c) for c in columns)),
+            [values[c] for c in columns] + [key],
+        )
+        self.connection.commit()
+
+    def is_complete(self, key, need_ris=True):
+        record = self.get(key)
+        if record is None or record['pdf_status'] != STATUS_DOWNLOADED:
+            return False
+        if need_ris:
+            # Article without citation export counts as done
+            return record['ris_status'] in (STATUS_DOWNLOADED, STATUS_MISSING)
+        return True
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# Crawl metrics in the Prometheus text format
+#
+# journal.middlewares.CallbackMetricsSpiderMiddleware and
+# journal.extensions.CrawlMetrics record into the MetricsRegistry of their
+# crawler (crawler_metrics), the extension serves registry.render() on
+# http://METRICS_HOST:<port>/metrics and writes it to METRICS_SNAPSHOT_FILE,
+# which the node_exporter textfile collector can read as well:
+#
+#   registry = crawler_metrics(crawler)
+#   registry.observe('journal_callback_seconds', 0.012, callback='parse_issue')
+#   registry.inc('journal_download_bytes_total', 52431, host='onlinelibrary.wiley.com')
+#   registry.set('journal_scheduler_requests', 120)
+
+import os
+import os.path
+import weakref
+from bisect import bisect_left
+
+# Latency buckets (seconds) of the histograms
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# Metric name: (type, help)
+METRICS = {
+    'journal_callback_seconds': ('histogram', 'Time spent in the spider callbacks'),
+    'journal_callback_errors_total': ('counter', 'Spider callbacks which raised'),
+    'journal_download_latency_seconds': ('histogram', 'Time from sending a request to the response headers, per host'),
+    'journal_downloader_seconds': ('histogram', 'Time from entering the downloader (slot queue included) to the whole response, per host'),
+    'journal_download_bytes_total': ('counter', 'Response body bytes (streamed files included), per host'),
+    'journal_responses_total': ('counter', 'Responses per host and status'),
+    'journal_items_total': ('counter', 'Items per outcome (scraped, dropped, error)'),
+    'journal_scheduler_requests': ('gauge', 'Requests waiting in the scheduler'),
+    'journal_downloader_requests': ('gauge', 'Requests in the downloader'),
+    'journal_items_in_pipelines': ('gauge', 'Items between the spider and the end of the item pipelines'),
+    'journal_pipeline_pending': ('gauge', 'Work in progress of an item pipeline (files downloading, RIS files writing)'),
+    'journal_pdf_files_total': ('counter', 'PDF files per status (downloaded, uptodate, invalid, failed)'),
+    'journal_ris_files_total': ('counter', 'RIS files per status (written, failed)'),
+    'journal_pdf_success_ratio': ('gauge', 'Share of the PDF files downloaded or up to date'),
+    'journal_ris_success_ratio': ('gauge', 'Share of the RIS files written'),
+    'journal_stat': ('gauge', 'Numeric Scrapy stats'),
+}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    # Cumulative buckets are computed when rendered
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            yield bound, total
+
+
+class MetricsRegistry(object):
+    # Counters, gauges and histograms by name and labels, used from the
+    # reactor thread only
+
+    def __init__(self, buckets=None):
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        series = self.values.setdefault(name, {})
+        key = self.key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values.setdefault(name, {})[self.key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        series = self.values.setdefault(name, {})
+        key = self.key(labels)
+        if key not in series:
+            series[key] = Histogram(self.buckets)
+        series[key].observe(value)
+
+    def clear(self, name):
+        self.values.pop(name, None)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.values):
+            metric_type, description = METRICS.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in sorted(self.values[name].items()):
+                if isinstance(value, Histogram):
+                    for bound, count in value.samples():
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', format_value(float(bound)))]), count))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(value.sum)))
+                    lines.append('{}_count{} {}'.format(name, format_labels(labels), value.count))
+                else:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Readers never see a half written file
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+# Registry of every crawler, shared by its middlewares and extensions
+_registries = weakref.WeakKeyDictionary()
+
+
+def crawler_metrics(crawler):
+    if crawler not in _registries:
+        _registries[crawler] = MetricsRegistry([float(bound) for bound in crawler.settings.getlist('METRICS_BUCKETS')])
+    return _registries[crawler]
@@ -5,7 +5,97 @@
 # See documentation in:
 # https://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
-from scrapy import signals
+import os
+import os.path
+import zlib
+from time import perf_counter, time
+from urllib.parse import urljoin, urlparse
+from weakref import WeakKeyDictionary
+
+from scrapy import Item, signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import FormRequest, HtmlResponse, Request, TextResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.gz import gunzip
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.project import data_path
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from journal.frontier import frontier_ack
+from journal.httpcache import PageCache
+from journal.metrics import crawler_metrics
+from journal.validation import InvalidPdf, PdfValidator
+
+REDIRECT_META_KEYS = ['redirect_urls', 'redirect_times', 'redirect_ttl', 'redirect_reasons']
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# Re-login requests get their own downloader slot, so they don't wait
+# behind the requests queued for the host (which get the login page anyway)
+LOGIN_META = {'dont_relogin': True, 'download_slot': 'session_login'}
+
+# Decoded copy of each Content-Encoded response, shared by the middlewares
+# and extensions checking the same response. The copy keeps its parsed
+# selector, so the body is also parsed once.
+_decoded_responses = WeakKeyDictionary()
+
+
+def decode_body(body, encoding):
+    # Encodings HttpCompressionMiddleware asks for, else ValueError
+    if encoding in (b'gzip', b'x-gzip'):
+        return gunzip(body)
+    if encoding == b'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Raw deflate of some servers
+            return zlib.decompress(body, -15)
+    raise ValueError('Unsupported Content-Encoding {!r}'.format(encoding))
+
+
+def decode_response(response):
+    encodings = response.headers.getlist('Content-Encoding')
+    if not encodings:
+        return response
+    try:
+        body = decode_body(response.body, encodings[-1].lower())
+    except (OSError, EOFError, ValueError, zlib.error):
+        return response
+    headers = response.headers.copy()
+    if len(encodings) > 1:
+        headers.setlist('Content-Encoding', encodings[:-1])
+    else:
+        del headers['Content-Encoding']
+    kwargs = dict(cls=responsetypes.from_args(headers=headers, url=response.url, body=body), headers=headers, body=body)
+    if issubclass(kwargs['cls'], TextResponse):
+        kwargs['encoding'] = None
+    return response.replace(**kwargs)
+
+
+def decoded_response(response):
+    # The response as HttpCompressionMiddleware (590) passes it on. Downloader
+    # middlewares above it and response_downloaded handlers get the body
+    # still Content-Encoded, their body checks work on a decoded copy
+    if not response.headers.get('Content-Encoding'):
+        return response
+    decoded = _decoded_responses.get(response)
+    if decoded is None:
+        # Not stored when undecodable, the value would keep the key alive
+        decoded = decode_response(response)
+        if decoded is not response:
+            _decoded_responses[response] = decoded
+    return decoded
+
+
+def is_login_page(response, login_form_xpath, login_path):
+    # Library proxy login page, or redirect to it
+    if urlparse_cached(response).path == login_path:
+        return True
+    if response.status in REDIRECT_STATUSES:
+        location = response.headers.get('Location', b'').decode('latin1')
+        return urlparse(response.urljoin(location)).path == login_path
+    response = decoded_response(response)
+    return isinstance(response, HtmlResponse) and bool(response.xpath(login_form_xpath))
 
 
 class JournalSpiderMiddleware(object):
@@ -56,6 +146,96 @@ class JournalSpiderMiddleware(object):
         spider.logger.info('Spider opened: %s' % spider.name)
 
 
+class SnapshotSpiderMiddleware(object):
+    # Carries meta['snapshot_key'] and meta['snapshot_fingerprint'], set by
+    # the discipline scrapers on the request of a journal, along the
+    # follow-up requests of that journal and records the item scraped from
+    # them in spider.snapshot (journal.snapshot.DisciplineSnapshot).
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def process_spider_output(self, response, result, spider):
+        for output in result:
+            yield self.record(response, output, spider)
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for output in result:
+            yield self.record(response, output, spider)
+
+    def record(self, response, output, spider):
+        key = response.meta.get('snapshot_key')
+        snapshot = getattr(spider, 'snapshot', None)
+        if key is not None and snapshot is not None:
+            if isinstance(output, Request):
+                output.meta.setdefault('snapshot_key', key)
+                output.meta.setdefault('snapshot_fingerprint', response.meta['snapshot_fingerprint'])
+            elif isinstance(output, (dict, Item)):
+                snapshot.update(key, response.meta['snapshot_fingerprint'], output)
+                self.stats.inc_value('snapshot/recorded')
+        return output
+
+
+class CallbackMetricsSpiderMiddleware(object):
+    # Times the spider callbacks for journal.extensions.CrawlMetrics
+    # (journal_callback_seconds by callback name): the time spent producing
+    # their output, next to the spider so the other middlewares aren't
+    # counted. Callbacks are generators, their body runs as they are read.
+
+    def __init__(self, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        self.metrics = crawler_metrics(crawler)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        callback = getattr(response.request.callback, '__name__', 'parse')
+        elapsed = 0.0
+        result = iter(result)
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    output = next(result)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += perf_counter() - start
+                yield output
+        except Exception:
+            self.metrics.inc('journal_callback_errors_total', callback=callback)
+            raise
+        finally:
+            self.metrics.observe('journal_callback_seconds', elapsed, callback=callback)
+
+    async def process_spider_output_async(self, response, result, spider):
+        callback = getattr(response.request.callback, '__name__', 'parse')
+        elapsed = 0.0
+        result = result.__aiter__()
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    output = await result.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += perf_counter() - start
+                yield output
+        except Exception:
+            self.metrics.inc('journal_callback_errors_total', callback=callback)
+            raise
+        finally:
+            self.metrics.observe('journal_callback_seconds', elapsed, callback=callback)
+
+
 class JournalDownloaderMiddleware(object):
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
@@ -101,3 +281,368 @@ class JournalDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class PolitenessDownloaderMiddleware(object):
+    # Randomized pause between requests to the same host which doesn't block
+    # the reactor. Requests flagged with meta['pause'] go to their own
+    # <host>:pause downloader slot, whose delay and jitter make a random pause
+    # of spider.min_p to spider.max_p seconds: the downloader spaces them in
+    # the slot queue while other requests of the host, other hosts and item
+    # pipelines keep running.
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def get_pause(self, spider):
+        # Slot delay and jitter of a uniform pause between min_p and max_p
+        min_p = getattr(spider, 'min_p', None)
+        max_p = getattr(spider, 'max_p', None)
+        if min_p is None or max_p is None:
+            return 0, 0
+        # Spider arguments from command line come as strings
+        min_p, max_p = int(min_p), int(max_p)
+        delay = (min_p + max_p) / 2.0
+        return delay, (max_p - min_p) / (2 * delay) if delay else 0
+
+    def process_request(self, request, spider):
+        if not request.meta.get('pause'):
+            return None
+
+        host = urlparse_cached(request).hostname
+        request.meta['download_slot'] = '{}:pause'.format(host)
+        request.meta['pause_time'] = time()
+        slot = self.crawler.engine.downloader._get_slot(request)[1]
+        slot.delay, slot.jitter = self.get_pause(spider)
+        self.stats.inc_value('politeness/paused_count')
+        return None
+
+    def process_response(self, request, response, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            host = urlparse_cached(request).hostname
+            self.stats.inc_value('politeness/work_time', latency)
+            self.stats.inc_value('politeness/work_time/{}'.format(host), latency)
+            pause_time = request.meta.get('pause_time')
+            if pause_time is not None:
+                # Time spent in the slot queue
+                wait = max(0, time() - pause_time - latency)
+                self.stats.inc_value('politeness/wait_time', wait)
+                self.stats.inc_value('politeness/wait_time/{}'.format(host), wait)
+        return response
+
+    def spider_closed(self, spider):
+        wait_time = self.stats.get_value('politeness/wait_time', 0)
+        work_time = self.stats.get_value('politeness/work_time', 0)
+        if wait_time + work_time:
+            self.stats.set_value('politeness/wait_ratio', round(wait_time / (wait_time + work_time), 3))
+        spider.logger.info('Politeness: %.1fs waiting, %.1fs downloading', wait_time, work_time)
+
+
+class SessionDownloaderMiddleware(object):
+    # Keeps the library proxy session alive. A response which is the proxy
+    # login page (login form or redirect to /login) means the session expired:
+    # one re-login is made with the login form from that page while every
+    # other request waits, then the affected requests are scheduled again.
+    # Requests with meta['dont_relogin'] (the spiders' own login flow) and
+    # browser pool pages, which log in inside the browser, are left alone.
+    #
+    # Files pipeline requests with meta['validate_pdf'] answered with
+    # something else than a PDF (InvalidPdf from the streaming handler, or a
+    # buffered body failing journal.validation) are downloaded again after
+    # a re-login, PDF_VALIDATION_RETRIES times at most.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.settings = settings
+        self.stats = crawler.stats
+        self.credentials = settings.getdict('CREDENTIALS')
+        self.login_form_xpath = settings.get('SESSION_LOGIN_FORM_XPATH')
+        self.login_path = settings.get('SESSION_LOGIN_PATH')
+        self.max_retries = settings.getint('SESSION_MAX_RETRIES')
+        self.max_failures = settings.getint('SESSION_MAX_FAILURES')
+        self.pdf_retries = settings.getint('PDF_VALIDATION_RETRIES')
+        self.generation = 0
+        self.failures = 0
+        self.relogin = None
+        self.waiting = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def is_login_page(self, response):
+        return is_login_page(response, self.login_form_xpath, self.login_path)
+
+    def process_request(self, request, spider):
+        if request.meta.get('dont_relogin') or self.relogin is None:
+            request.meta['session_generation'] = self.generation
+            return None
+
+        # Re-login in progress, download after it
+        waiting = defer.Deferred()
+        self.waiting.append((waiting, request))
+        self.stats.inc_value('session/waited')
+        return waiting
+
+    def process_response(self, request, response, spider):
+        if request.meta.get('dont_relogin') or request.meta.get('browser'):
+            return response
+        if not self.is_login_page(response):
+            if request.meta.get('validate_pdf') and response.status == 200 and 'streamed' not in response.flags:
+                # Checked as the files pipeline will get it, not Content-Encoded
+                body = decoded_response(response).body
+                reason = PdfValidator.from_settings(self.settings).check(response.headers, body)
+                if reason:
+                    # Left to the files pipeline once out of retries
+                    return self.invalid_pdf(request, InvalidPdf(reason, request.url), spider) or response
+            return response
+
+        self.stats.inc_value('session/login_pages')
+        retries = request.meta.get('session_retries', 0)
+        if retries >= self.max_retries:
+            spider.logger.error('Gave up on %(request)s, still getting login page after %(retries)d re-logins', {
+                'request': request, 'retries': retries,
+            })
+            self.stats.inc_value('session/gave_up')
+            raise IgnoreRequest('Session expired')
+
+        # Session already renewed since this request was sent
+        if request.meta.get('session_generation', 0) < self.generation:
+            return self.replay(request, session_retries=retries + 1)
+
+        if self.relogin is None:
+            self.start_relogin(response, spider)
+        return self.replay(request, session_retries=retries + 1)
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, InvalidPdf) and not request.meta.get('dont_relogin'):
+            return self.invalid_pdf(request, exception, spider)
+        return None
+
+    def invalid_pdf(self, request, error, spider):
+        # The proxy answers PDF links with its pages (not always the login
+        # form) once the session lapsed, the PDF gets another chance after
+        # a re-login. None once out of retries.
+        self.stats.inc_value('pdf_validation/rejected/{}'.format(error.reason))
+        retries = request.meta.get('pdf_retries', 0)
+        if retries >= self.pdf_retries:
+            self.stats.inc_value('pdf_validation/gave_up')
+            return None
+
+        spider.logger.warning('%(error)s, downloading it again after a re-login', {'error': error})
+        if request.meta.get('session_generation', 0) >= self.generation and self.relogin is None:
+            self.start_relogin(None, spider, login_url=urljoin(request.url, self.login_path))
+        self.stats.inc_value('pdf_validation/requeued')
+        return self.replay(request, pdf_retries=retries + 1)
+
+    def replay(self, request, **counters):
+        meta = {k: v for k, v in request.meta.items() if k not in REDIRECT_META_KEYS}
+        meta.update(counters)
+        # Replay the URL the spider asked for, not the login redirect
+        url = request.meta.get('redirect_urls', [request.url])[0]
+        self.stats.inc_value('session/replayed')
+        return request.replace(url=url, meta=meta, dont_filter=True)
+
+    def start_relogin(self, response, spider, login_url=None):
+        spider.logger.info('Proxy session expired, logging in again')
+        self.relogin = defer.Deferred()
+        try:
+            if login_url is None and response.status in REDIRECT_STATUSES:
+                # Not followed (e.g. files pipeline requests)
+                login_url = response.urljoin(response.headers['Location'].decode('latin1'))
+            if login_url is not None:
+                # Get the login page first
+                login_page = Request(login_url, meta=dict(LOGIN_META), dont_filter=True)
+                dfd = self.download(login_page)
+                dfd.addCallback(self.login_request)
+            else:
+                dfd = defer.maybeDeferred(self.login_request, response)
+            dfd.addCallback(self.download)
+        except Exception:
+            # Nothing started, the waiting requests must not wait forever
+            self.relogin_failed(Failure(), spider)
+            return
+        dfd.addCallbacks(self.relogin_done, self.relogin_failed, callbackArgs=(spider,), errbackArgs=(spider,))
+
+    def download(self, request):
+        # Through the downloader middlewares only, not the spider
+        return deferred_from_coro(self.crawler.engine.download_async(request))
+
+    def login_request(self, response):
+        return FormRequest.from_response(
+            response,
+            formxpath=self.login_form_xpath,
+            formdata=self.credentials,
+            meta=dict(LOGIN_META),
+            dont_filter=True,
+        )
+
+    def relogin_done(self, response, spider):
+        if self.is_login_page(response):
+            return self.relogin_failed(None, spider)
+        self.failures = 0
+        self.generation += 1
+        self.stats.inc_value('session/relogins')
+        spider.logger.info('Logged in again, session %d', self.generation)
+        self.release_waiting()
+
+    def relogin_failed(self, failure, spider):
+        self.failures += 1
+        self.stats.inc_value('session/relogin_failed')
+        spider.logger.error('Re-login failed (%(failures)d in a row): %(reason)s', {
+            'failures': self.failures, 'reason': failure.value if failure else 'login page returned',
+        })
+        self.release_waiting()
+        if self.failures >= self.max_failures:
+            deferred_from_coro(self.crawler.engine.close_spider_async(reason='session_expired'))
+
+    def release_waiting(self):
+        relogin, self.relogin = self.relogin, None
+        waiting, self.waiting = self.waiting, []
+        for dfd, request in waiting:
+            request.meta['session_generation'] = self.generation
+            dfd.callback(None)
+        relogin.callback(None)
+
+
+class PageCacheDownloaderMiddleware(object):
+    # Keeps journal pages, volume lists and issue TOCs, the requests with
+    # meta['cache_page'] set to one of the PAGE_CACHE_TTL page types, in
+    # journal.httpcache.PageCache. A page younger than the TTL of its type is
+    # answered from the cache without waiting for the host; an older one is
+    # asked again with If-None-Match/If-Modified-Since and a 304 answer
+    # reuses the cached page. PDFs, citation exports and login pages are
+    # never cached.
+
+    def __init__(self, settings, stats, fingerprinter):
+        if not settings.getbool('PAGE_CACHE_ENABLED'):
+            raise NotConfigured
+        self.stats = stats
+        self.fingerprinter = fingerprinter
+        self.path = data_path(settings.get('PAGE_CACHE_FILE'))
+        self.page_ttl = settings.getdict('PAGE_CACHE_TTL')
+        self.login_form_xpath = settings.get('SESSION_LOGIN_FORM_XPATH')
+        self.login_path = settings.get('SESSION_LOGIN_PATH')
+        self.cache = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler.settings, crawler.stats, crawler.request_fingerprinter)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def fingerprint(self, request):
+        # Hex, the key of the cached pages
+        return self.fingerprinter.fingerprint(request).hex()
+
+    def spider_opened(self, spider):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.cache = PageCache(self.path)
+
+    def spider_closed(self, spider):
+        self.cache.close()
+
+    def is_cacheable(self, request):
+        return request.method == 'GET' and request.meta.get('cache_page') in self.page_ttl and not request.meta.get('dont_cache')
+
+    def is_fresh(self, entry, request):
+        # Page cached as current volume keeps the short TTL until revalidated,
+        # 0 - never expires
+        ttls = [self.page_ttl.get(page_type) for page_type in (entry['page_type'], request.meta['cache_page'])]
+        ttls = [ttl for ttl in ttls if ttl]
+        return not ttls or time() - entry['validated'] < min(ttls)
+
+    def process_request(self, request, spider):
+        if not self.is_cacheable(request):
+            return None
+
+        entry = self.cache.get(self.fingerprint(request))
+        if entry is None:
+            self.stats.inc_value('pagecache/miss')
+            return None
+
+        if self.is_fresh(entry, request):
+            self.stats.inc_value('pagecache/hit')
+            return self.cache.response(entry, request)
+
+        if not entry['etag'] and not entry['last_modified']:
+            self.stats.inc_value('pagecache/expired')
+            return None
+
+        if entry['etag']:
+            request.headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            request.headers['If-Modified-Since'] = entry['last_modified']
+        self.stats.inc_value('pagecache/revalidate')
+        return None
+
+    def process_response(self, request, response, spider):
+        if 'cached' in response.flags or not self.is_cacheable(request):
+            return response
+
+        fingerprint = self.fingerprint(request)
+        if response.status == 304:
+            entry = self.cache.get(fingerprint)
+            if entry is None:
+                return response
+            self.cache.touch(fingerprint, request.meta['cache_page'])
+            self.stats.inc_value('pagecache/not_modified')
+            return self.cache.response(entry, request)
+
+        if response.status == 200 and not is_login_page(response, self.login_form_xpath, self.login_path):
+            self.cache.store(fingerprint, request.meta['cache_page'], response)
+            self.stats.inc_value('pagecache/stored')
+        return response
+
+
+class FrontierSpiderMiddleware(object):
+    # Acknowledges a request leased from the shared frontier
+    # (journal.frontier.FrontierScheduler) once the spider is done with its
+    # response: the output went through the other spider middlewares, or the
+    # callback raised. Lowest order, the last one to see the output.
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        for output in result:
+            yield output
+        frontier_ack(self.crawler, response.request)
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for output in result:
+            yield output
+        frontier_ack(self.crawler, response.request)
+
+    def process_spider_exception(self, response, exception, spider):
+        frontier_ack(self.crawler, response.request, failed=True)
+
+
+class FrontierDownloaderMiddleware(object):
+    # Acknowledges a leased request whose download failed for good. Lowest
+    # order, process_exception runs after RetryMiddleware gave up.
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_exception(self, request, exception, spider):
+        frontier_ack(self.crawler, request, failed=True)
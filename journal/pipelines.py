@@ -1,64 +1,193 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import os.path
+import threading
 
+from scrapy.exceptions import DropItem
 from scrapy.http import Request
-from scrapy.pipelines.files import FilesPipeline
+from scrapy.pipelines.files import FilesPipeline, FSFilesStore
+from scrapy.pipelines.media import FileException
+from scrapy.utils.request import referer_str
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from journal.ledger import STATUS_DOWNLOADED, STATUS_FAILED
+from journal.storage import PARTIAL_FOLDER, ContentAddressedFilesStore, JournalFilesStore
+from journal.validation import InvalidPdf, PdfValidator
+
+logger = logging.getLogger(__name__)
 
 # class JournalPipeline(object):
 #     def process_item(self, item, spider):
 #         return item
 
 
-class JournalPdfPipeline(FilesPipeline):
-    def get_media_requests(self, item, info):
-        return [Request(pdf_url, meta={
-            'file_ext': 'txt' if 'risfile' in pdf_url else 'pdf',
-            'file_name': item['file_name'],
-            'issue': item['issue'],
-            'year': item['year'],
-            'journal': item['journal'],
-        }, cookies=item['cookies'], dont_filter=True) for pdf_url in item.get('file_urls')]
-
-    def file_path(self, request, response=None, info=None):
-        return '{journal}/{year}/{issue}/{file_name}.{extension}'.format(
-            journal=request.meta['journal'],
-            year=request.meta['year'],
-            issue=request.meta['issue'],
-            file_name=request.meta['file_name'],
-            extension=request.meta['file_ext'],
+class RisWriterPipeline(object):
+    # Writes item['ris_body'] to <storage>/journal/year/issue/<article_title>.txt
+    # in a small thread pool, so RIS files never block the reactor thread
+
+    def __init__(self, storage, threads_count, stats):
+        self.storage = storage
+        self.threads_count = threads_count
+        self.stats = stats
+        self.threadpool = None
+        # RIS files waiting for or being written (journal.extensions.CrawlMetrics)
+        self.pending = 0
+        self.created_directories = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            crawler.settings.get('JOURNALS_STORAGE'),
+            crawler.settings.getint('RIS_WRITER_THREADS', 4),
+            crawler.stats,
         )
 
+    def open_spider(self, spider):
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=self.threads_count, name='ris_writer')
+        self.threadpool.start()
 
-class TaylorPdfPipeline(FilesPipeline):
-    def get_media_requests(self, item, info):
-        return [Request(pdf_url, meta={
-            'file_ext': 'pdf',
-            'file_name': item['article_title'],
-            'issue': item['issue_number'],
-            'year': item['volume_title'],
-            'journal': item['journal_name'],
-        }, dont_filter=True) for pdf_url in item.get('file_urls')]
-
-    def file_path(self, request, response=None, info=None):
-        return '{journal}/{year}/{issue}/{file_name}.{extension}'.format(
-            journal=request.meta['journal'],
-            year=request.meta['year'],
-            issue=request.meta['issue'],
-            file_name=request.meta['file_name'],
-            extension=request.meta['file_ext'],
+    def close_spider(self, spider):
+        self.threadpool.stop()
+
+    def make_directory(self, directory):
+        # Every issue folder is checked on disk once per crawl
+        if directory in self.created_directories:
+            return
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.created_directories.add(directory)
+
+    def write_file(self, file_path, body):
+        self.make_directory(os.path.dirname(file_path))
+        with open(file_path, 'wb') as f:
+            f.write(body)
+        return len(body), hashlib.md5(body).hexdigest()
+
+    def process_item(self, item, spider):
+        if not item.get('ris_body'):
+            return item
+
+        file_path = os.path.join(
+            self.storage,
+            item['journal_name'],
+            item['volume_title'],
+            item['issue_number'],
+            item['article_title'] + '.txt',
+        )
+        self.pending += 1
+        dfd = threads.deferToThreadPool(reactor, self.threadpool, self.write_file, file_path, item['ris_body'])
+        dfd.addCallbacks(
+            self.file_written, self.file_failed,
+            callbackArgs=(item, file_path, spider), errbackArgs=(item, file_path, spider),
         )
+        return dfd
 
+    def file_written(self, result, item, file_path, spider):
+        size, checksum = result
+        self.pending -= 1
+        self.stats.inc_value('ris/written', spider=spider)
+        self.stats.inc_value('ris/bytes', size, spider=spider)
+        ledger = getattr(spider, 'ledger', None)
+        if ledger is not None and item.get('article_key'):
+            ledger.update(item['article_key'], ris_status=STATUS_DOWNLOADED, ris_path=file_path, ris_size=size, ris_checksum=checksum)
+        del item['ris_body']
+        return item
 
-class WileyPdfPipeline(FilesPipeline):
-    def get_media_requests(self, item, info):
-        return [Request(pdf_url, meta={
-            'file_ext': 'pdf',
-            'file_name': item['article_title'],
-            'issue': item['issue_number'],
-            'year': item['volume_title'],
-            'journal': item['journal_name'],
-        }, dont_filter=True) for pdf_url in item.get('file_urls')]
-
-    def file_path(self, request, response=None, info=None):
+    def file_failed(self, failure, item, file_path, spider):
+        logger.error('Error writing RIS file %(path)s: %(error)s', {'path': file_path, 'error': failure.value}, extra={'spider': spider})
+        self.pending -= 1
+        self.stats.inc_value('ris/failed', spider=spider)
+        ledger = getattr(spider, 'ledger', None)
+        if ledger is not None and item.get('article_key'):
+            ledger.update(item['article_key'], ris_status=STATUS_FAILED)
+        del item['ris_body']
+        return item
+
+
+class JournalFilesPipeline(FilesPipeline):
+    def __init__(self, store_uri, download_func=None, *, crawler=None):
+        super(JournalFilesPipeline, self).__init__(store_uri, download_func=download_func, crawler=crawler)
+        settings = crawler.settings
+
+        # Write every unique file once, journal tree as hardlinks
+        if settings.getbool('FILES_CONTENT_ADDRESSED'):
+            self.store = ContentAddressedFilesStore(store_uri)
+        elif isinstance(self.store, FSFilesStore):
+            self.store = JournalFilesStore(store_uri)
+
+        # Bodies are streamed to disk by journal.handlers.StreamingDownloadHandler
+        self.stream_dir = None
+        if settings.getbool('FILES_STREAMING') and isinstance(self.store, JournalFilesStore):
+            self.stream_dir = os.path.join(self.store.basedir, PARTIAL_FOLDER)
+
+        # PDF bodies are checked before they are stored (journal.validation)
+        self.validate_pdf = settings.getbool('PDF_VALIDATION_ENABLED')
+        self.settings = settings
+
+    @property
+    def pending(self):
+        # Files downloading (journal.extensions.CrawlMetrics)
+        spiderinfo = getattr(self, 'spiderinfo', None)
+        return len(spiderinfo.downloading) if spiderinfo is not None else 0
+
+    def file_request(self, url, cookies=None, **meta):
+        if self.stream_dir:
+            meta['stream_to'] = self.stream_dir
+        if self.validate_pdf and meta.get('file_ext') == 'pdf':
+            meta['validate_pdf'] = True
+        return Request(url, meta=meta, cookies=cookies, dont_filter=True)
+
+    def media_downloaded(self, response, request, info, *args, **kwargs):
+        streamed_file = response.meta.get('streamed_file')
+
+        # Viewer, landing or error page instead of the PDF
+        if response.status == 200 and request.meta.get('file_ext') == 'pdf' and b'html' in response.headers.get('Content-Type', b'').lower():
+            if streamed_file is not None:
+                os.remove(streamed_file['path'])
+            logger.warning('File (html): Got an HTML page instead of the PDF from %(request)s referred in <%(referer)s>', {
+                'request': request, 'referer': referer_str(request),
+            }, extra={'spider': info.spider})
+            raise FileException('html-page')
+
+        # Streamed bodies were checked by the download handler
+        if streamed_file is None and response.status == 200 and request.meta.get('validate_pdf'):
+            reason = PdfValidator.from_settings(self.settings).check(response.headers, response.body)
+            if reason:
+                self.invalid_pdf(InvalidPdf(reason, request.url), request, info)
+
+        if streamed_file is None:
+            return super(JournalFilesPipeline, self).media_downloaded(response, request, info, *args, **kwargs)
+
+        if response.status != 200:
+            os.remove(streamed_file['path'])
+            logger.warning('File (code: %(status)s): Error downloading file from %(request)s referred in <%(referer)s>', {
+                'status': response.status, 'request': request, 'referer': referer_str(request),
+            }, extra={'spider': info.spider})
+            raise FileException('download-error')
+
+        self.inc_stats('downloaded')
+        path = self.file_path(request, response=response, info=info)
+        self.store.persist_temp_file(path, streamed_file['path'], info, digest=streamed_file['sha256'])
+        return {'url': request.url, 'path': path, 'checksum': streamed_file['checksum'], 'status': 'downloaded'}
+
+    def media_failed(self, failure, request, info):
+        if failure.check(InvalidPdf):
+            self.invalid_pdf(failure.value, request, info)
+        return super(JournalFilesPipeline, self).media_failed(failure, request, info)
+
+    def invalid_pdf(self, error, request, info):
+        # The reason goes to the download ledger (pdf_error)
+        logger.warning('File (%(reason)s): Not a PDF from %(request)s referred in <%(referer)s>', {
+            'reason': error.reason, 'request': request, 'referer': referer_str(request),
+        }, extra={'spider': info.spider})
+        self.inc_stats('invalid')
+        raise FileException(error.reason)
+
+    def file_path(self, request, response=None, info=None, *, item=None):
         return '{journal}/{year}/{issue}/{file_name}.{extension}'.format(
             journal=request.meta['journal'],
             year=request.meta['year'],
@@ -66,3 +195,70 @@ class WileyPdfPipeline(FilesPipeline):
             file_name=request.meta['file_name'],
             extension=request.meta['file_ext'],
         )
+
+    def item_completed(self, results, item, info):
+        # PDF link built from the TOC (spider toc_only mode) was wrong, the
+        # spider gets the real one from the article page
+        fallback = getattr(info.spider, 'pdf_fallback_request', None)
+        if item.get('pdf_fallback_url') and fallback is not None and not all(ok for ok, _ in results):
+            info.spider.crawler.stats.inc_value('toc_only/fallbacks', spider=info.spider)
+            info.spider.crawler.engine.crawl(fallback(item))
+            raise DropItem('PDF not found at {}, following the article page {}'.format(', '.join(item['file_urls']), item['pdf_fallback_url']))
+
+        # Remember downloaded PDF in the spider download ledger
+        ledger = getattr(info.spider, 'ledger', None)
+        if ledger is not None and item.get('article_key'):
+            for ok, result in results:
+                if ok:
+                    ledger.update(
+                        item['article_key'],
+                        pdf_status=STATUS_DOWNLOADED,
+                        pdf_path=os.path.join(self.store.basedir, result['path']),
+                        pdf_size=os.path.getsize(self.store.stored_path(result['path'])),
+                        pdf_checksum=result['checksum'],
+                        pdf_error=None,
+                    )
+                else:
+                    ledger.update(item['article_key'], pdf_status=STATUS_FAILED, pdf_error=str(result.value) or 'download-error')
+        # Files given up, the other file_status_count values count the successes
+        for ok, result in results:
+            if not ok:
+                info.spider.crawler.stats.inc_value('file_status_count/failed', spider=info.spider)
+        return super(JournalFilesPipeline, self).item_completed(results, item, info)
+
+
+class JournalPdfPipeline(JournalFilesPipeline):
+    def get_media_requests(self, item, info):
+        return [self.file_request(
+            pdf_url,
+            cookies=item['cookies'],
+            file_ext='txt' if 'risfile' in pdf_url else 'pdf',
+            file_name=item['file_name'],
+            issue=item['issue'],
+            year=item['year'],
+            journal=item['journal'],
+        ) for pdf_url in item.get('file_urls')]
+
+
+class TaylorPdfPipeline(JournalFilesPipeline):
+    def get_media_requests(self, item, info):
+        return [self.file_request(
+            pdf_url,
+            file_ext='pdf',
+            file_name=item['article_title'],
+            issue=item['issue_number'],
+            year=item['volume_title'],
+            journal=item['journal_name'],
+        ) for pdf_url in item.get('file_urls')]
+
+
+class WileyPdfPipeline(JournalFilesPipeline):
+    def get_media_requests(self, item, info):
+        return [self.file_request(
+            pdf_url,
+            file_ext='pdf',
+            file_name=item['article_title'],
+            issue=item['issue_number'],
+            year=item['volume_title'],
+            journal=item['journal_name'],
+        ) for pdf_url in item.get('file_urls')]
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Sampling profiler and memory reports of journal.extensions.CrawlProfiler
+#
+# StackSampler reads the stack of every thread PROFILING_SAMPLE_INTERVAL
+# seconds from a daemon thread (sys._current_frames, no tracing hooks, the
+# profiled code runs at full speed). Samples of threads waiting (reactor
+# poll, idle pool threads) are left out, the others are CPU time of the
+# innermost stage on the stack: a spider callback or pipeline method named
+# in PROFILING_STAGES. Reports go to one folder per profiling session:
+#
+#   stacks.folded   folded stacks ("thread;module:function;... count") for
+#                   flamegraph.pl, speedscope or inferno
+#   stages.txt      samples and estimated CPU seconds per stage
+#   memory-NNN.txt  top tracemalloc allocations, growth since the previous
+#                   report, live objects per type and Scrapy live refs
+
+import gc
+import linecache
+import os
+import os.path
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+from scrapy.utils.trackref import format_live_refs
+
+# Innermost (module, function) of a waiting thread: reactor polls, threads
+# blocked on a condition (idle pool threads)
+IDLE_FRAMES = {
+    ('epollreactor', 'doPoll'),
+    ('pollreactor', 'doPoll'),
+    ('selectreactor', 'doSelect'),
+    ('kqreactor', 'doKEvent'),
+    ('win32eventreactor', 'doWaitForMultipleEvents'),
+    ('selectors', 'select'),
+    ('threading', 'wait'),
+}
+FOLDED_FILE = 'stacks.folded'
+STAGES_FILE = 'stages.txt'
+MEMORY_FILE = 'memory-{:03d}.txt'
+NO_STAGE = '(other)'
+
+
+def is_idle(code):
+    return (os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name) in IDLE_FRAMES
+
+
+def frame_name(code):
+    # folder.module:function, shorter than the path and the same on every host
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    parent = os.path.basename(os.path.dirname(code.co_filename))
+    return '{}.{}:{}'.format(parent, module, code.co_name)
+
+
+class StackSampler(object):
+    # Counts the folded stacks and the stages of the busy threads
+
+    def __init__(self, interval, stages):
+        self.interval = interval
+        self.stages = set(stages)
+        self.stacks = Counter()
+        self.stage_samples = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        with self.lock:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                self.samples += 1
+                if is_idle(frame.f_code):
+                    self.idle_samples += 1
+                    continue
+                stack = []
+                stage = None
+                while frame is not None:
+                    if stage is None and frame.f_code.co_name in self.stages:
+                        stage = frame.f_code.co_name
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'thread-{}'.format(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.stage_samples[stage or NO_STAGE] += 1
+
+    def write_folded(self, path):
+        with self.lock:
+            lines = ['{} {}'.format(stack, count) for stack, count in self.stacks.most_common()]
+        write_text(path, '\n'.join(lines) + '\n')
+
+    def write_stages(self, path):
+        with self.lock:
+            busy = sum(self.stage_samples.values())
+            lines = [
+                'Samples: {} every {}s, {} idle, {} busy'.format(self.samples, self.interval, self.idle_samples, busy),
+                '',
+                '{:<30} {:>10} {:>12} {:>8}'.format('stage', 'samples', 'cpu seconds', 'share'),
+            ]
+            for stage, count in self.stage_samples.most_common():
+                lines.append('{:<30} {:>10} {:>12.2f} {:>7.1f}%'.format(stage, count, count * self.interval, 100.0 * count / busy))
+        write_text(path, '\n'.join(lines) + '\n')
+
+
+class MemoryReporter(object):
+    # Reports of the heap: tracemalloc allocations (when tracing) and the
+    # growth since the previous report, live objects per type
+
+    def __init__(self, top, trace_frames):
+        self.top = top
+        self.trace_frames = trace_frames
+        self.previous = None
+        self.reports = 0
+
+    def start(self):
+        if self.trace_frames and not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.previous = None
+
+    def write(self, folder):
+        # Runs in a thread, the reactor goes on meanwhile
+        self.reports += 1
+        lines = []
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append('Traced memory: {:.1f} MiB, peak {:.1f} MiB'.format(current / 1048576.0, peak / 1048576.0))
+            # One grouping of the traces, the growth is computed from the
+            # sizes of the previous report (Snapshot.compare_to groups both)
+            sizes = {}
+            for stat in tracemalloc.take_snapshot().statistics('lineno'):
+                frame = stat.traceback[0]
+                if frame.filename != tracemalloc.__file__:
+                    sizes[(frame.filename, frame.lineno)] = (stat.size, stat.count)
+            lines += ['', 'Top allocations'] + self.format_sizes(sorted(sizes.items(), key=lambda item: -item[1][0]))
+            if self.previous is not None:
+                growth = sorted(sizes.items(), key=lambda item: -abs(item[1][0] - self.previous.get(item[0], (0, 0))[0]))
+                lines += ['', 'Growth since the previous report'] + self.format_sizes(growth, self.previous)
+            self.previous = sizes
+
+        counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+        lines += ['', 'Live objects per type']
+        lines += ['{:>10}  {}'.format(count, name) for name, count in counts.most_common(self.top)]
+        lines += ['', format_live_refs().strip()]
+        path = os.path.join(folder, MEMORY_FILE.format(self.reports))
+        write_text(path, '\n'.join(lines) + '\n')
+        return path
+
+    def format_sizes(self, sizes, previous=None):
+        lines = []
+        for (filename, lineno), (size, count) in sizes[:self.top]:
+            diff = ' ({:+.1f} KiB)'.format((size - previous.get((filename, lineno), (0, 0))[0]) / 1024.0) if previous is not None else ''
+            lines.append('{:>10.1f} KiB{} {:>8} blocks  {}:{}  {}'.format(
+                size / 1024.0, diff, count, filename, lineno, linecache.getline(filename, lineno).strip(),
+            ))
+        return lines
+
+
+def write_text(path, text):
+    # Reports are replaced whole, a reader never sees half of one
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
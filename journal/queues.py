@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Scheduler queue of the download spiders (SCHEDULER_PRIORITY_QUEUE)
+#
+# Requests are popped by priority first, which with a negative DEPTH_PRIORITY
+# means the deepest first (article, citation, then the next issue TOC), so a
+# journal is finished before the next volumes of every journal are expanded.
+# Among requests of the same priority the journals take turns, one giant
+# journal can't starve the others. Journals are told apart by the journal
+# name of the request crawl context (journal.context).
+#
+# At most SCHEDULER_MAX_MEMORY_REQUESTS requests are kept in memory, the
+# others wait in one disk queue per priority (SCHEDULER_DISK_QUEUE) and are
+# read back when their priority comes up. Without JOBDIR the disk queues are
+# in a temporary folder removed when the spider closes, with JOBDIR they are
+# the scheduler's persistent queues.
+
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict, deque
+
+from scrapy import signals
+from scrapy.utils.misc import build_from_crawler, load_object
+
+logger = logging.getLogger(__name__)
+
+
+def journal_key(request):
+    context = request.meta.get('context')
+    if context is not None:
+        return context.get('journal_name')
+    return request.meta.get('journal_name')
+
+
+class JournalFairPriorityQueue(object):
+    # Same interface as scrapy.pqueues.ScrapyPriorityQueue: push(), pop(),
+    # close() returning the priorities left on disk and __len__(). Scrapy
+    # priorities are used as is, higher first. Start requests take their
+    # turn with the others, start_queue_cls is not used.
+
+    @classmethod
+    def from_crawler(cls, crawler, downstream_queue_cls, key, startprios=(), *, start_queue_cls=None):
+        return cls(crawler, downstream_queue_cls, key, startprios, start_queue_cls=start_queue_cls)
+
+    def __init__(self, crawler, downstream_queue_cls, key, startprios=(), *, start_queue_cls=None):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_memory = settings.getint('SCHEDULER_MAX_MEMORY_REQUESTS')
+
+        # The scheduler memory queue has key '' and spills to a temporary
+        # folder, its JOBDIR queue already is a disk queue
+        self.persistent = bool(key)
+        if self.persistent:
+            self.disk_queue_cls = downstream_queue_cls
+            self.path = key
+        else:
+            self.disk_queue_cls = load_object(settings['SCHEDULER_DISK_QUEUE'])
+            self.path = None
+
+        # {priority: OrderedDict({journal: deque([request, ...])})}
+        self.memory = {}
+        self.memory_count = 0
+        # {priority: disk queue}
+        self.disk = {}
+        for priority in startprios or ():
+            self.disk[priority] = self.disk_queue(priority)
+
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    def disk_queue(self, priority):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='journal-scheduler-')
+        return build_from_crawler(self.disk_queue_cls, self.crawler, os.path.join(self.path, str(priority)))
+
+    def push(self, request):
+        if self.memory_count >= self.max_memory and self.push_disk(request):
+            self.stats.inc_value('scheduler/spilled', spider=self.crawler.spider)
+            return
+        self.push_memory(request)
+
+    def push_memory(self, request):
+        journals = self.memory.setdefault(request.priority, OrderedDict())
+        journals.setdefault(journal_key(request), deque()).append(request)
+        self.memory_count += 1
+
+    def push_disk(self, request):
+        if request.priority not in self.disk:
+            self.disk[request.priority] = self.disk_queue(request.priority)
+        try:
+            self.disk[request.priority].push(request)
+        except ValueError as e:
+            # Callback or meta which can't be pickled, stays in memory
+            logger.debug('Unable to spill %(request)s to disk: %(reason)s', {'request': request, 'reason': e})
+            self.stats.inc_value('scheduler/unserializable', spider=self.crawler.spider)
+            return False
+        return True
+
+    def pop(self):
+        priorities = set(self.memory)
+        priorities.update(priority for priority, queue in self.disk.items() if len(queue))
+        if not priorities:
+            return None
+        priority = max(priorities)
+        if priority not in self.memory:
+            self.load(priority)
+        return self.pop_memory(priority)
+
+    def pop_memory(self, priority):
+        # Next journal in turn, it goes back to the end of the line
+        journals = self.memory[priority]
+        journal, queue = next(iter(journals.items()))
+        request = queue.popleft()
+        if queue:
+            journals.move_to_end(journal)
+        else:
+            del journals[journal]
+        if not journals:
+            del self.memory[priority]
+        self.memory_count -= 1
+        return request
+
+    def load(self, priority):
+        # Fill the free memory with the requests spilled at this priority
+        queue = self.disk[priority]
+        for _ in range(max(1, min(len(queue), self.max_memory - self.memory_count))):
+            request = queue.pop()
+            if request is None:
+                break
+            self.push_memory(request)
+            self.stats.inc_value('scheduler/reloaded', spider=self.crawler.spider)
+
+    def close(self):
+        # JOBDIR: requests in memory go to disk with the others for the next run
+        if self.persistent:
+            lost = 0
+            for priority in list(self.memory):
+                while priority in self.memory:
+                    if not self.push_disk(self.pop_memory(priority)):
+                        lost += 1
+            if lost:
+                logger.warning('%(lost)d pending requests could not be saved in JOBDIR', {'lost': lost})
+        active = []
+        for priority, queue in self.disk.items():
+            if len(queue):
+                active.append(priority)
+            queue.close()
+        self.disk = {}
+        return active
+
+    def spider_closed(self, spider):
+        # The scheduler only closes its JOBDIR queue
+        if self.persistent or self.path is None:
+            return
+        for queue in self.disk.values():
+            queue.close()
+        self.disk = {}
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __len__(self):
+        return self.memory_count + sum(len(queue) for queue in self.disk.values())
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# Precompiled XPath expressions for the parse callbacks
+#
+# response.xpath() parses and compiles its expression string on every call.
+# XPathRegistry compiles each expression once with lxml.etree.XPath, when it
+# is first evaluated (the spider loader imports every spider module, only the
+# spider run pays for its expressions), and evaluates it directly on the lxml
+# tree of the response (or of a selected node):
+#
+#   XPATHS = XPathRegistry(
+#       journal_name='//h1[@id="journal-banner-text"]/text()',
+#       volumes='//ul[contains(@class, "loi__list")]//li/a',
+#       title='string(.)',
+#   )
+#   XPATHS.get(response, 'journal_name')      # first text value or None
+#   for volume in XPATHS.select(response, 'volumes'):
+#       XPATHS.get(volume, 'title')
+
+from lxml import etree
+from scrapy.http import TextResponse
+from scrapy.selector import Selector, SelectorList
+
+
+def get_root(node):
+    if isinstance(node, TextResponse):
+        return node.selector.root
+    if isinstance(node, Selector):
+        return node.root
+    return node
+
+
+class XPathRegistry(object):
+
+    def __init__(self, **expressions):
+        self.expressions = expressions
+        self.compiled = {}
+
+    def __contains__(self, name):
+        return name in self.expressions
+
+    def evaluate(self, node, name):
+        xpath = self.compiled.get(name)
+        if xpath is None:
+            xpath = self.compiled[name] = etree.XPath(self.expressions[name], smart_strings=False)
+        return xpath(get_root(node))
+
+    def getall(self, node, name):
+        # Text and attribute values, string() results as one item list
+        result = self.evaluate(node, name)
+        if isinstance(result, list):
+            return [value if isinstance(value, str) else etree.tostring(value, encoding='unicode') for value in result]
+        return [result]
+
+    def get(self, node, name, default=None):
+        values = self.getall(node, name)
+        return values[0] if values else default
+
+    def select(self, node, name):
+        # Element results as selectors, e.g. for response.follow()
+        return SelectorList(Selector(root=element) for element in self.evaluate(node, name))
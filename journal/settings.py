@@ -33,15 +33,18 @@ USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Ge
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 1
+CONCURRENT_REQUESTS = 16
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://doc.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
 DOWNLOAD_DELAY = 1
 # The download delay setting will honor only one of:
-# CONCURRENT_REQUESTS_PER_DOMAIN = 16
+CONCURRENT_REQUESTS_PER_DOMAIN = 1
 # CONCURRENT_REQUESTS_PER_IP = 16
+# DOWNLOAD_DELAY and CONCURRENT_REQUESTS_PER_DOMAIN are only the start values
+# for every host, journal.extensions.AdaptiveConcurrency adjusts them per
+# host from the responses (see ADAPTIVE_* settings below)
 
 # Disable cookies (enabled by default)
 # COOKIES_ENABLED = False
@@ -57,21 +60,128 @@ DOWNLOAD_DELAY = 1
 
 # Enable or disable spider middlewares
 # See https://doc.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    'journal.middlewares.JournalSpiderMiddleware': 543,
-# }
+SPIDER_MIDDLEWARES = {
+    # 'journal.middlewares.JournalSpiderMiddleware': 543,
+    # Records the discipline scrapers journals for their delta runs
+    'journal.middlewares.SnapshotSpiderMiddleware': 543,
+    # Acknowledges frontier requests once their output went through the others
+    'journal.middlewares.FrontierSpiderMiddleware': 10,
+    # Next to the spider, times the callbacks alone
+    'journal.middlewares.CallbackMetricsSpiderMiddleware': 950,
+}
 
 # Enable or disable downloader middlewares
 # See https://doc.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    'journal.middlewares.JournalDownloaderMiddleware': 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    # 'journal.middlewares.JournalDownloaderMiddleware': 543,
+    # Before PolitenessDownloaderMiddleware (100), cached pages don't pause
+    'journal.middlewares.PageCacheDownloaderMiddleware': 50,
+    'journal.middlewares.PolitenessDownloaderMiddleware': 100,
+    # Before RedirectMiddleware (600) to catch the redirects to the login page,
+    # and before HttpCompressionMiddleware (590): decodes the bodies it checks
+    'journal.middlewares.SessionDownloaderMiddleware': 650,
+    # Acknowledges frontier requests whose download failed after the retries
+    'journal.middlewares.FrontierDownloaderMiddleware': 10,
+}
+
+# Re-login when the library proxy answers with its login page
+SESSION_LOGIN_FORM_XPATH = '//form[@id="mc1" and @action="/login"]'
+SESSION_LOGIN_PATH = '/login'
+# Replays of one request and failed re-logins in a row before giving up
+SESSION_MAX_RETRIES = 3
+SESSION_MAX_FAILURES = 3
+
+# Cache journal pages, volume lists and issue TOCs (requests with
+# meta['cache_page']) in one compressed SQLite file (relative to the project
+# .scrapy folder), revalidated with ETag/Last-Modified once stale
+PAGE_CACHE_ENABLED = True
+PAGE_CACHE_FILE = 'pagecache.sqlite'
+# Seconds a page type is used without asking the server, 0 - forever
+PAGE_CACHE_TTL = {
+    'journal': 24 * 3600,
+    'current_volume': 6 * 3600,
+    'closed_volume': 0,
+}
+
+# Deepest requests first (articles and citations before the next issue TOC),
+# journals of the same depth take turns (journal.queues)
+DEPTH_PRIORITY = -1
+SCHEDULER_PRIORITY_QUEUE = 'journal.queues.JournalFairPriorityQueue'
+# Pending requests over this many wait in disk queues
+SCHEDULER_MAX_MEMORY_REQUESTS = 5000
+
+# Shared crawl frontier for workers on one or several hosts draining the
+# same queue (journal.frontier), with leases taken over from dead workers:
+# SCHEDULER = 'journal.frontier.FrontierScheduler'
+# 'sqlite' (FRONTIER_SQLITE_FILE, relative to the project .scrapy folder,
+# workers of one box), 'redis' (FRONTIER_REDIS_URL) or 'memory' (one process)
+FRONTIER_BACKEND = 'sqlite'
+FRONTIER_SQLITE_FILE = 'frontier.sqlite'
+FRONTIER_REDIS_URL = 'redis://localhost:6379/0'
+# Queue of the workers, None - the spider name
+FRONTIER_QUEUE = None
+# Requests leased at once, seconds before an unrenewed lease goes to another
+# worker and leases of one request before it is given up
+FRONTIER_LEASE_SIZE = 8
+FRONTIER_LEASE_TIME = 300
+FRONTIER_MAX_ATTEMPTS = 3
+# Seconds between polls of an empty frontier
+FRONTIER_POLL_INTERVAL = 1
 
 # Enable or disable extensions
 # See https://doc.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-# }
+EXTENSIONS = {
+    # 'scrapy.extensions.telnet.TelnetConsole': None,
+    'journal.extensions.AdaptiveConcurrency': 500,
+    'journal.extensions.CrawlMetrics': 510,
+    'journal.extensions.CrawlProfiler': 520,
+}
+
+# AIMD concurrency and delay per host (journal.extensions.AdaptiveConcurrency)
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_MAX_CONCURRENCY = 8
+ADAPTIVE_MIN_DELAY = 0.25
+ADAPTIVE_MAX_DELAY = 60
+# Delay after the first back off (429/503, proxy error or login page)
+ADAPTIVE_BACKOFF_DELAY = 5
+# Only grow while responses come faster and with fewer errors than this
+ADAPTIVE_TARGET_LATENCY = 5.0
+ADAPTIVE_MAX_ERROR_RATE = 0.1
+ADAPTIVE_ERROR_PAGE_XPATH = '//title[contains(., "Proxy Error") or contains(., "Service Unavailable") or contains(., "Too Many Requests")]'
+ADAPTIVE_DEBUG = False
+
+# Live crawl metrics (journal.extensions.CrawlMetrics) in the Prometheus
+# text format on http://METRICS_HOST:<port>/metrics, the first free port of
+# METRICS_PORT ([] - no endpoint), and every METRICS_SNAPSHOT_INTERVAL
+# seconds in METRICS_SNAPSHOT_FILE (relative to the project .scrapy folder,
+# %(name)s - spider name, None - no snapshots)
+METRICS_ENABLED = True
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = [9410, 9430]
+METRICS_SNAPSHOT_FILE = 'metrics/%(name)s.prom'
+METRICS_SNAPSHOT_INTERVAL = 60
+# Buckets (seconds) of the callback and download time histograms
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# On demand profiling (journal.extensions.CrawlProfiler): from the start
+# with PROFILING_ENABLED, or between two PROFILING_SIGNAL signals sent to the
+# crawl process (kill -USR1 <pid>, POSIX only, None - no signal). Reports go
+# to PROFILING_FOLDER, None - a profiles folder next to the spider LOG_FOLDER
+PROFILING_ENABLED = False
+PROFILING_SIGNAL = 'SIGUSR1'
+PROFILING_FOLDER = None
+# Seconds between two stack samples and between two sets of reports
+PROFILING_SAMPLE_INTERVAL = 0.01
+PROFILING_REPORT_INTERVAL = 60
+# Callbacks and pipeline methods the CPU samples are reported by
+PROFILING_STAGES = [
+    'parse_journal', 'parse_volume', 'parse_issue', 'parse_citations', 'parse_article', 'parse_citation', 'save_data', 'save_ris',
+    'get_media_requests', 'file_path', 'media_downloaded', 'item_completed', 'process_item', 'write_file',
+]
+# Lines of the memory reports and traceback frames kept by tracemalloc per
+# allocation (0 - no tracemalloc, live object counts only)
+PROFILING_TOP = 25
+PROFILING_TRACEMALLOC_FRAMES = 1
 
 # Configure item pipelines
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
@@ -80,6 +190,42 @@ DOWNLOAD_DELAY = 1
 # }
 # FILES_STORE = 'D:\\Work\\Python\\Scrapy\\journal_private\\downloads'
 
+# Store each unique PDF once under FILES_STORE/.blobs/ by its SHA-256 and
+# expose journal/year/issue paths as hardlinks (or manifest.csv rows)
+FILES_CONTENT_ADDRESSED = False
+
+# Write PDF bodies to FILES_STORE/.partial/ as they arrive instead of
+# holding them in memory, interrupted downloads are kept there and resumed
+# with Range/If-Range requests by the retry or the next run. The handler is
+# the Scrapy HTTP handler for every request without meta['stream_to']
+FILES_STREAMING = True
+DOWNLOAD_HANDLERS = {
+    'http': 'journal.handlers.StreamingDownloadHandler',
+    'https': 'journal.handlers.StreamingDownloadHandler',
+}
+
+# Check PDF bodies as they arrive (journal.validation): Content-Type, %PDF-
+# header, %%EOF trailer and size. A body which isn't a PDF is dropped, never
+# stored, and downloaded again after a re-login up to PDF_VALIDATION_RETRIES
+# times, then the ledger records the article as failed with the reason
+PDF_VALIDATION_ENABLED = True
+PDF_MIN_SIZE = 1024
+PDF_CONTENT_TYPES = ['application/pdf', 'application/x-pdf', 'application/octet-stream', 'binary/octet-stream']
+PDF_VALIDATION_RETRIES = 1
+
+# Threads writing RIS files for journal.pipelines.RisWriterPipeline
+RIS_WRITER_THREADS = 4
+
+# DOIs per /action/downloadCitation request of an issue (journal.citations),
+# 0 - a showCitFormats page and a downloadCitation request per article
+CITATION_BATCH_SIZE = 50
+
+# Missing content logs of the spiders (journal.events.EventSink):
+# 'csv' (log_*.csv files), 'jsonl' (events.jsonl) or 'sqlite' (events.sqlite)
+EVENT_SINK_BACKEND = 'csv'
+EVENT_SINK_FLUSH_INTERVAL = 5
+EVENT_SINK_BUFFER_SIZE = 100
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://doc.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
@@ -94,6 +240,7 @@ DOWNLOAD_DELAY = 1
 # AUTOTHROTTLE_DEBUG = False
 
 # Enable and configure HTTP caching (disabled by default)
+# journal.middlewares.PageCacheDownloaderMiddleware caches the pages worth it
 # See https://doc.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 # HTTPCACHE_ENABLED = True
 # HTTPCACHE_EXPIRATION_SECS = 0
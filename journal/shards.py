@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+# Sharded runs of the spiders reading journals.csv
+#
+# One Scrapy process parses pages and handles items on a single core. The
+# runner splits journals.csv in N shards by a stable hash of the journal URL
+# (for a given N a journal always lands in the same shard), starts a worker
+# process per shard running the spider over its shard with its own proxy
+# login session, waits for all of them and merges what they wrote:
+#
+#   python -m journal.shards wiley_download_auth --workers 4
+#   python -m journal.shards taylor_francis_download_auth -o items.jl -a limit_years=5 -s CONCURRENT_REQUESTS=8
+#   python -m journal.shards journal_issues --workers 2 --csv other_journals.csv
+#
+# Every worker has a folder <work dir>/shard-<n> with its journals.csv, its
+# missing content logs (logs/), its final stats (stats.json), its metrics
+# snapshot (metrics.prom), its items feed and its console output
+# (console.log). Once the workers are done the logs
+# are added to the spider log folder (EVENT_SINK_BACKEND of the project),
+# the stats are merged into <work dir>/stats.json and the feeds into the -o
+# file. The download ledger, the page cache and the files store are shared
+# by the workers, SQLite files take concurrent writers.
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import os.path
+import subprocess
+import sys
+from datetime import datetime
+from importlib import import_module
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import get_project_settings
+
+from journal.events import BACKENDS
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARDS_DIR = os.path.join(ROOT_DIR, 'shards')
+
+# Journal URL column of the journals.csv files
+URL_COLUMNS = ['Journal_URL', 'URL']
+
+SHARD_CSV = 'journals.csv'
+SHARD_LOGS = 'logs'
+SHARD_STATS = 'stats.json'
+SHARD_CONSOLE = 'console.log'
+SHARD_METRICS = 'metrics.prom'
+
+# Feed formats the shard feeds can be merged in, by -o file extension
+FEED_FORMATS = {
+    '.jl': 'jsonlines',
+    '.jsonl': 'jsonlines',
+    '.json': 'json',
+    '.csv': 'csv',
+}
+
+
+def spider_module(spider_cls):
+    module = sys.modules[spider_cls.__module__]
+    if not hasattr(module, 'CSV_FILE_WITH_URLS'):
+        raise ValueError('Spider {} does not read journals.csv'.format(spider_cls.name))
+    return module
+
+
+def log_folder_attribute(module):
+    # journal_issues writes its logs in the project folder
+    return 'LOG_FOLDER' if hasattr(module, 'LOG_FOLDER') else 'ROOT_DIR'
+
+
+def shard_index(url, workers):
+    digest = hashlib.sha1(url.strip().encode('utf-8')).hexdigest()
+    return int(digest, 16) % workers
+
+
+def split_csv(csv_file, workers, work_dir):
+    # Shard folders of the shards with journals, in shard order
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        url_column = next((column for column in URL_COLUMNS if column in fieldnames), None)
+        if url_column is None:
+            raise ValueError('No {} column in {}'.format(' or '.join(URL_COLUMNS), csv_file))
+        shards = [[] for _ in range(workers)]
+        for row in reader:
+            shards[shard_index(row[url_column], workers)].append(row)
+
+    shard_dirs = []
+    for index, rows in enumerate(shards):
+        if not rows:
+            continue
+        shard_dir = os.path.join(work_dir, 'shard-{}'.format(index))
+        os.makedirs(shard_dir)
+        with open(os.path.join(shard_dir, SHARD_CSV), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        shard_dirs.append(shard_dir)
+    return shard_dirs
+
+
+def configure_shard(module, shard_dir):
+    # The spider reads the shard journals.csv and logs to the shard folder
+    log_folder = os.path.join(shard_dir, SHARD_LOGS)
+    module.CSV_FILE_WITH_URLS = os.path.join(shard_dir, SHARD_CSV)
+    setattr(module, log_folder_attribute(module), log_folder)
+    for attribute in dir(module):
+        if attribute.startswith('LOG_FILE_'):
+            setattr(module, attribute, os.path.join(log_folder, os.path.basename(getattr(module, attribute))))
+
+
+def feed_path(shard_dir, output):
+    return os.path.join(shard_dir, 'items' + os.path.splitext(output)[1])
+
+
+def run_worker(args):
+    settings = get_project_settings()
+    # Metrics snapshot of every worker next to its stats
+    settings.set('METRICS_SNAPSHOT_FILE', os.path.join(os.path.abspath(args.worker), SHARD_METRICS))
+    for name, value in args.set:
+        settings.set(name, value, priority='cmdline')
+    if args.output:
+        settings.set('FEEDS', {feed_path(args.worker, args.output): {'format': FEED_FORMATS[os.path.splitext(args.output)[1]]}}, priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    spider_cls = process.spider_loader.load(args.spider)
+    configure_shard(spider_module(spider_cls), args.worker)
+    crawler = process.create_crawler(spider_cls)
+    process.crawl(crawler, **dict(args.argument))
+    process.start()
+
+    with open(os.path.join(args.worker, SHARD_STATS), 'w') as f:
+        json.dump(crawler.stats.get_stats(), f, default=str, indent=2, sort_keys=True)
+    return 0 if crawler.stats.get_value('finish_reason') == 'finished' else 1
+
+
+def worker_argv(args, shard_dir):
+    argv = [sys.executable, '-m', 'journal.shards', args.spider, '--worker', shard_dir]
+    for name, value in args.argument:
+        argv += ['-a', '{}={}'.format(name, value)]
+    for name, value in args.set:
+        argv += ['-s', '{}={}'.format(name, value)]
+    if args.output:
+        argv += ['-o', args.output]
+    return argv
+
+
+def run_workers(args, shard_dirs):
+    workers = []
+    for shard_dir in shard_dirs:
+        console = open(os.path.join(shard_dir, SHARD_CONSOLE), 'w')
+        workers.append((shard_dir, subprocess.Popen(worker_argv(args, shard_dir), cwd=ROOT_DIR, stdout=console, stderr=subprocess.STDOUT), console))
+        print('Started {} on {} (pid {})'.format(args.spider, os.path.basename(shard_dir), workers[-1][1].pid))
+
+    failed = []
+    for shard_dir, worker, console in workers:
+        while True:
+            try:
+                worker.wait()
+                break
+            except KeyboardInterrupt:
+                # Ctrl-C reaches the workers too, they close their spiders
+                print('Waiting for the workers to stop')
+        console.close()
+        if worker.returncode:
+            failed.append(shard_dir)
+        print('{} done (exit code {})'.format(os.path.basename(shard_dir), worker.returncode))
+    return failed
+
+
+def merge_events(shard_dirs, folder, headers, backend):
+    # Shard events go to the spider log files, appended like a spider does
+    backend_cls = BACKENDS[backend]
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    target = backend_cls(folder, headers)
+    count = 0
+    for shard_dir in shard_dirs:
+        shard_folder = os.path.join(shard_dir, SHARD_LOGS)
+        if not os.path.isdir(shard_folder):
+            continue
+        source = backend_cls(shard_folder, headers)
+        events = [dict(event, log_file=os.path.join(folder, os.path.basename(event.get('log_file') or ''))) for event in source.query()]
+        source.close()
+        if events:
+            target.write(events)
+            count += len(events)
+    target.close()
+    return count
+
+
+def merge_stats(shard_stats):
+    # Counters add up, maximums, start and finish times don't
+    merged = {}
+    for stats in shard_stats:
+        for key, value in stats.items():
+            if key not in merged:
+                merged[key] = value
+            elif key == 'start_time' or key.endswith('min'):
+                merged[key] = min(merged[key], value)
+            elif key in ('finish_time', 'elapsed_time_seconds') or key.endswith('max') or key.startswith('memusage/'):
+                merged[key] = max(merged[key], value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] += value
+            elif value != merged[key]:
+                merged[key] = ', '.join(sorted(set(str(merged[key]).split(', ')) | {str(value)}))
+    merged['shards'] = len(shard_stats)
+    return merged
+
+
+def merge_feeds(paths, output):
+    feed_format = FEED_FORMATS[os.path.splitext(output)[1]]
+    if feed_format == 'json':
+        items = []
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                items.extend(json.load(f))
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False, indent=4)
+        return len(items)
+
+    count = 0
+    with open(output, 'w', encoding='utf-8', newline='') as out:
+        header = None
+        for path in paths:
+            with open(path, encoding='utf-8', newline='') as f:
+                lines = f.readlines()
+            if feed_format == 'csv' and lines:
+                # One header, the shard feeds share the item fields
+                if header is None:
+                    header = lines[0]
+                    out.write(header)
+                lines = lines[1:]
+            out.writelines(lines)
+            count += len(lines)
+    return count
+
+
+def merge_shards(args, work_dir, shard_dirs):
+    settings = get_project_settings()
+    module = import_module(args.module_name)
+    events = merge_events(shard_dirs, getattr(module, log_folder_attribute(module)), module.LOG_HEADERS, settings.get('EVENT_SINK_BACKEND', 'csv'))
+    print('Merged {} missing content events into {}'.format(events, getattr(module, log_folder_attribute(module))))
+
+    shard_stats = []
+    for shard_dir in shard_dirs:
+        path = os.path.join(shard_dir, SHARD_STATS)
+        if os.path.exists(path):
+            with open(path) as f:
+                shard_stats.append(json.load(f))
+    stats = merge_stats(shard_stats)
+    with open(os.path.join(work_dir, SHARD_STATS), 'w') as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+    print('Merged stats of {} shards into {}: {} items, {} requests, finish reason {}'.format(
+        len(shard_stats), os.path.join(work_dir, SHARD_STATS),
+        stats.get('item_scraped_count', 0), stats.get('downloader/request_count', 0), stats.get('finish_reason')))
+
+    if args.output:
+        feeds = [feed_path(shard_dir, args.output) for shard_dir in shard_dirs if os.path.exists(feed_path(shard_dir, args.output))]
+        print('Merged {} items into {}'.format(merge_feeds(feeds, args.output), args.output))
+
+
+def run(args):
+    settings = get_project_settings()
+    spider_cls = load_object(settings['SPIDER_LOADER_CLASS']).from_settings(settings).load(args.spider)
+    module = spider_module(spider_cls)
+    args.module_name = module.__name__
+
+    work_dir = args.work_dir or os.path.join(SHARDS_DIR, '{}-{:%Y%m%d-%H%M%S}'.format(args.spider, datetime.now()))
+    shard_dirs = split_csv(args.csv or module.CSV_FILE_WITH_URLS, args.workers, work_dir)
+    print('{} shards in {}'.format(len(shard_dirs), work_dir))
+
+    failed = run_workers(args, shard_dirs)
+    merge_shards(args, work_dir, shard_dirs)
+    if failed:
+        print('Not finished: {} (see {} there)'.format(', '.join(os.path.basename(shard_dir) for shard_dir in failed), SHARD_CONSOLE))
+        return 1
+    return 0
+
+
+def name_value(value):
+    name, _, value = value.partition('=')
+    if not name:
+        raise argparse.ArgumentTypeError('NAME=VALUE expected')
+    return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m journal.shards', description='Run a spider over journals.csv in parallel worker processes')
+    parser.add_argument('spider', help='wiley_download_auth, taylor_francis_download_auth, journal_issues, ...')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes (default: one per core)')
+    parser.add_argument('--csv', help='journals CSV file (default: the journals.csv of the spider)')
+    parser.add_argument('--work-dir', help='shard folders (default: shards/<spider>-<time>)')
+    parser.add_argument('-a', dest='argument', action='append', default=[], type=name_value, metavar='NAME=VALUE', help='spider argument')
+    parser.add_argument('-s', dest='set', action='append', default=[], type=name_value, metavar='NAME=VALUE', help='setting override')
+    parser.add_argument('-o', dest='output', help='merged items feed ({})'.format(', '.join(sorted(FEED_FORMATS))))
+    parser.add_argument('--worker', metavar='SHARD_DIR', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.output and os.path.splitext(args.output)[1] not in FEED_FORMATS:
+        parser.error('-o file extension must be one of {}'.format(', '.join(sorted(FEED_FORMATS))))
+    if args.worker:
+        return run_worker(args)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Previous run of the discipline scrapers
+#
+# Every journal of a discipline search is recorded with a fingerprint of its
+# search result entry (title, links, date range) and the item scraped from
+# its pages, so a delta run only follows the journals whose entry is new or
+# changed and emits the others from here. Entries are keyed by discipline
+# and journal link.
+
+import hashlib
+import json
+import sqlite3
+from time import time
+
+FIELDS = [
+    'snapshot_key',
+    'fingerprint',
+    'item',
+    'updated',
+]
+
+
+def snapshot_key(discipline_tree, discipline_name, journal_url):
+    return '\x1f'.join([discipline_tree or '', discipline_name or '', journal_url])
+
+
+def entry_fingerprint(*values):
+    return hashlib.sha1('\x1f'.join(value or '' for value in values).encode('utf-8')).hexdigest()
+
+
+class DisciplineSnapshot(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS journals ('
+            'snapshot_key TEXT PRIMARY KEY, fingerprint TEXT, item TEXT, updated REAL)'
+        )
+        self.connection.commit()
+
+    def get(self, key):
+        row = self.connection.execute(
+            'SELECT {} FROM journals WHERE snapshot_key = ?'.format(', '.join(FIELDS)), (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        record = dict(zip(FIELDS, row))
+        record['item'] = json.loads(record['item'])
+        return record
+
+    def unchanged_item(self, key, fingerprint):
+        # Item of the previous run if the entry is the same
+        record = self.get(key)
+        if record is None or record['fingerprint'] != fingerprint:
+            return None
+        return record['item']
+
+    def update(self, key, fingerprint, item):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO journals ({}) VALUES (?, ?, ?, ?)'.format(', '.join(FIELDS)),
+            (key, fingerprint, json.dumps(dict(item), ensure_ascii=False), time()),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
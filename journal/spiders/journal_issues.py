@@ -1,28 +1,22 @@
 # -*- coding: utf-8 -*-
 import scrapy
-import pickle
 import csv
 import os.path
 import re
 
-from scrapy.http import FormRequest
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from time import sleep
-from scrapy.selector import Selector
-from scrapy.utils.project import get_project_settings
+from journal.events import EventSink
 from journal.items import JournalItem
+from journal.selectors import XPathRegistry
 from scrapy.loader import ItemLoader
-from scrapy.loader.processors import TakeFirst, MapCompose
-from random import randint
+from itemloaders.processors import TakeFirst, MapCompose
 
 
-settings = get_project_settings()
+# User configuration parameters
+BROWSER_POOL_SIZE = 4
 
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 CSV_FILE_WITH_URLS = os.path.join(ROOT_DIR, 'journals.csv')
-COOKIES_FILE = os.path.join(ROOT_DIR, 'cookies.pkl')
 
 # LOG_FILE_JOURNAL_WITHOUT_ISSUES = os.path.join(ROOT_DIR, 'journals_without_issues.log')
 # LOG_FILE_ISSUE_MIX_ARTICLES = os.path.join(ROOT_DIR, 'mix_pdf_and_no_pdf_issues.log')
@@ -39,27 +33,21 @@ LOG_FILE_ISSUE_NO_ATRICLES = os.path.join(ROOT_DIR, 'log_no_article_issues.csv')
 LOG_FILE_ARTICLE_NO_PDF = os.path.join(ROOT_DIR, 'log_article_no_pdf_file.csv')
 LOG_FILE_ARTICLE_NO_RIS = os.path.join(ROOT_DIR, 'log_article_no_ris_file.csv')
 
-
-def load_cookies():
-    if os.path.exists(COOKIES_FILE):
-        return pickle.load(open(COOKIES_FILE, 'rb'))
-    return False
-
-
-def save_to_log(file_path, val):
-    with open(file_path, 'a', encoding='utf-8') as f:
-        f.write('{}\n'.format(val))
-
-
-def save_to_log_csv(file_path, list_values):
-    row = dict(zip(LOG_HEADERS, list_values))
-    file_exists = os.path.exists(file_path)
-
-    with open(file_path, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=LOG_HEADERS)
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(row)
+# Parse callbacks XPath expressions, compiled once
+XPATHS = XPathRegistry(
+    issn='//div[@id="journal-details"]/div[@class="issn"]/text()',
+    journal_name='//div[@id="journal-details"]/h3/text()',
+    years='//div[@id="issues"]//div[@class="accordion-group" and descendant::ul]',
+    issue_links='.//li/a/@href',
+    pdf_links='//div[@id="result-list"]/ol[@id="toc"]/li/div[@class="journal-result"]//div[@class="clear links"]//a[contains(text(), "PDF Download")]',
+    no_pdf_links='//div[@id="result-list"]/ol[@id="toc"]/li/div[@class="journal-result"]//div[@class="clear links"]//a[contains(text(), "Find Full-Text @ My Library")]',
+    issue_details='//div[@id="journal-details"]/following-sibling::div[@style]//span/text()',
+    articles='//div[@id="result-list"]/ol[@id="toc"]/li[contains(@class, "journal-item row-")]/div[@class="journal-result"]',
+    article_title='.//h4//span[@class="article-title"]/text()',
+    article_url='.//h4//a/@href',
+    pdf_url='//div[@class="download-btn"]/a[contains(., "PDF Download")]/@href',
+    ris_url='//li/a[contains(text(), "RIS (EndNote)")]/@href',
+)
 
 
 class JournalIssuesSpider(scrapy.Spider):
@@ -67,206 +55,168 @@ class JournalIssuesSpider(scrapy.Spider):
     allowed_domains = ['carleton.ca']
 
     custom_settings = {
-        'FILES_STORE': settings.get('JOURNALS_STORAGE'),
         'ITEM_PIPELINES': {
             'journal.pipelines.JournalPdfPipeline': 300,
         },
+        'DOWNLOAD_HANDLERS': {
+            'http': 'journal.handlers.BrowserPoolDownloadHandler',
+            'https': 'journal.handlers.BrowserPoolDownloadHandler',
+        },
+        'BROWSER_POOL_SIZE': BROWSER_POOL_SIZE,
+        'BROWSER_PAGE_WAIT': 5,
+        'CONCURRENT_REQUESTS': BROWSER_POOL_SIZE,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': BROWSER_POOL_SIZE,
+        # Browser pool size already limits the load
+        'ADAPTIVE_CONCURRENCY_ENABLED': False,
     }
 
-    def set_cookies(self):
-            self.driver.get('https://www.petsmart.ca/')
-            for cookie in self.cookies:
-                self.driver.add_cookie(cookie)
+    @classmethod
+    def update_settings(cls, settings):
+        # Files go to JOURNALS_STORAGE of the crawl settings unless custom_settings say otherwise
+        settings.set('FILES_STORE', settings.get('JOURNALS_STORAGE'), priority='spider')
+        super(JournalIssuesSpider, cls).update_settings(settings)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        # Settings of the crawl, not read when the spider module is imported
+        spider = super(JournalIssuesSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.events = EventSink.from_settings(crawler.settings, ROOT_DIR, LOG_HEADERS)
+        return spider
 
     def __init__(self, use_auth=True, limit_years=None, limit_issues=None, min_p=5, max_p=7, *args, **kwargs):
         super(JournalIssuesSpider, self).__init__(*args, **kwargs)
-        self.settings = settings
         self.use_auth = use_auth
         self.limit_years = limit_years
         self.limit_issues = limit_issues
         self.min_p = min_p
         self.max_p = max_p
-        self.driver = webdriver.Chrome(self.settings.get('CHROME_PATH'))
 
-        if self.use_auth:
-            self.cookies = load_cookies()
-            if self.cookies:
-                self.set_cookies()
-        else:
-            self.cookies = False
-
-    def login_to_library(self):
-        # Check need login or not
-        try:
-            user = self.driver.find_element_by_xpath('//form[@id="mc1"]/input[@name="user"]')
-            need_login = True
-        except NoSuchElementException:
-            need_login = False
-
-        # Login block
-        if need_login:
-            user = self.driver.find_element_by_xpath('//form[@id="mc1"]/input[@name="user"]')
-            user.send_keys(self.settings.get('CREDENTIALS')['user'])
-            sleep(randint(2, 4))
-
-            password = self.driver.find_element_by_xpath('//form[@id="mc1"]/input[@name="pass"]')
-            sleep(randint(2, 4))
-            password.send_keys(self.settings.get('CREDENTIALS')['pass'])
-
-            login = self.driver.find_element_by_xpath('//form[@id="mc1"]/input[@value="Login"]')
-            login.click()
-            sleep(randint(2, 4))
+    def closed(self, reason):
+        self.events.close()
+
+    def browser_meta(self, **meta):
+        # Render page in the browser pool, login to library when needed
+        meta.update({
+            'browser': True,
+            'browser_login': self.use_auth,
+            'pause': True,
+        })
+        return meta
+
+    async def start(self):
+        for request in self.start_requests():
+            yield request
 
     # Getting all start_urls from csv file
     def start_requests(self):
         with open(CSV_FILE_WITH_URLS) as csv_file:
             csv_reader = csv.DictReader(csv_file)
             start_urls = [line['URL'] for line in csv_reader]
-        return [scrapy.Request(url, dont_filter=True) for url in start_urls]
+        return [scrapy.Request(url, dont_filter=True, meta=self.browser_meta()) for url in start_urls]
 
     def parse(self, response):
-        # Go to journal URL
-        self.driver.get(response.url)
-        sleep(randint(self.min_p, self.max_p))
-
-        # Login to library and save cookies
-        if self.use_auth:
-            self.login_to_library()
-            self.cookies = self.driver.get_cookies()
-            pickle.dump(self.cookies, open(COOKIES_FILE, 'wb'))
-
         latest_issue = True
 
-        # Getting html markup for Scrapy
-        html_code = self.driver.page_source
-        art_response = Selector(text=html_code)
-
         # Get journal ISSN
-        issn = art_response.xpath('//div[@id="journal-details"]/div[@class="issn"]/text()').get()
+        issn = XPATHS.get(response, 'issn')
         if issn:
             issn = re.search(r'\d+', issn).group()
         else:
             issn = 'issn not found'
 
         # Get journal name
-        journal_name = art_response.xpath('//div[@id="journal-details"]/h3/text()').get()
+        journal_name = XPATHS.get(response, 'journal_name')
 
         # Get all years divs
-        all_years = art_response.xpath('//div[@id="issues"]//div[@class="accordion-group" and descendant::ul]')
+        all_years = XPATHS.select(response, 'years')
 
         # Log journal without issues
         if not all_years:
-            # save_to_log(LOG_FILE_JOURNAL_WITHOUT_ISSUES, response.meta.get('redirect_urls', [response.url])[0])
-            save_to_log_csv(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [issn, journal_name, response.meta.get('redirect_urls', [response.url])[0]])
-            print('>>>>>>>>>>>>>>> SAVING JOURNAL URL WITH NO CONTENT TO LOG ...')
-            print('-----------------------> SKIP JOURNAL <----------------------')
+            self.events.log(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [issn, journal_name, response.meta.get('redirect_urls', [response.url])[0]])
             return False
 
         # Go through all years
         for year in all_years[:self.limit_years]:
-            sleep(randint(self.min_p, self.max_p))
-
             # Geto all issues links
-            all_issue_links = year.xpath('.//li/a/@href').extract()
+            all_issue_links = [response.urljoin(href) for href in XPATHS.getall(year, 'issue_links')]
 
             # Correction for scraping latest issue
             if latest_issue:
-                all_issue_links.insert(0, self.driver.current_url)
+                all_issue_links.insert(0, response.url)
                 latest_issue = False
 
             # Go through all issues
             for issue_link in all_issue_links[:self.limit_issues]:
-                sleep(randint(self.min_p, self.max_p))
-
-                # Go to issue page
-                if issue_link != self.driver.current_url:
-                    self.driver.get(issue_link)
-                    sleep(5)
-                    # html_code = (self.driver.page_source).encode('utf-8')
-                    html_code = self.driver.page_source
-
-                    # Save cookies if need auth
-                    self.cookies = self.driver.get_cookies()
-                    if self.use_auth:
-                        pickle.dump(self.cookies, open(COOKIES_FILE, 'wb'))
-
-                    art_response = Selector(text=html_code)
-
-                # Check if PDF Download articles on the page
-                check_pdf_links = art_response.xpath('//div[@id="result-list"]/ol[@id="toc"]/li/div[@class="journal-result"]//div[@class="clear links"]//a[contains(text(), "PDF Download")]')
-                # Check if NO PDF articles
-                check_no_pdf_link = art_response.xpath('//div[@id="result-list"]/ol[@id="toc"]/li/div[@class="journal-result"]//div[@class="clear links"]//a[contains(text(), "Find Full-Text @ My Library")]')
-
-                if check_pdf_links or check_no_pdf_link:
-
-                    # Log URL of the issue that has a MIX of both types of articles
-                    if check_pdf_links and check_no_pdf_link:
-                        # save_to_log(LOG_FILE_ISSUE_MIX_ARTICLES, self.driver.current_url)
-                        save_to_log_csv(LOG_FILE_ISSUE_MIX_ARTICLES, [issn, journal_name, self.driver.current_url])
-                        print('>>>>>>>>>>>>>>> SAVING JOURNAL ISSUE URL WITH MIX OF PDF AND NOT PDF TO LOG ...')
-
-                    # Log URL of the issue that has NO PDF articles
-                    if not check_pdf_links:
-                        # save_to_log(LOG_FILE_ISSUE_NO_PDF_ARTICLES, self.driver.current_url)
-                        save_to_log_csv(LOG_FILE_ISSUE_NO_PDF_ARTICLES, [issn, journal_name, self.driver.current_url])
-                        print('>>>>>>>>>>>>>>> SAVING JOURNAL ISSUE URL WITH NO PDF TO LOG ...')
-
-                    articles = art_response.xpath('//div[@id="result-list"]/ol[@id="toc"]/li[contains(@class, "journal-item row-")]/div[@class="journal-result"]')
-                    for article in articles:
-                        l = ItemLoader(item=JournalItem(), selector=article)
-                        l.default_output_processor = TakeFirst()
-
-                        l.add_value('journal', art_response.xpath('//div[@id="journal-details"]/h3/text()').extract())
-                        l.add_xpath('file_name', './/h4//span[@class="article-title"]/text()')
-                        l.add_xpath('journal', '//div[@id="journal-details"]/h3/text()')
-                        l.add_value('issue', art_response.xpath('//div[@id="journal-details"]/following-sibling::div[@style]//span/text()').extract())
-                        l.add_value('year', art_response.xpath('//div[@id="journal-details"]/following-sibling::div[@style]//span/text()').extract())
-
-                        # Detail page URL
-                        detail_article_url = article.xpath('.//h4//a/@href').get()
-                        sleep(randint(2, 4))
-
-                        # Go to detailed page
-                        self.driver.get(detail_article_url)
-                        sleep(5)
-
-                        # Login to library and save cookies
-                        if self.use_auth:
-                            self.login_to_library()
-                            self.cookies = self.driver.get_cookies()
-                            pickle.dump(self.cookies, open(COOKIES_FILE, 'wb'))
-
-                        l.add_value('cookies', self.driver.get_cookies())
-
-                        # Get link to PDF document
-                        try:
-                            pdf_url = self.driver.find_element_by_xpath('//div[@class="download-btn"]/a[contains(., "PDF Download")]').get_attribute('href')
-                            l.add_value('file_urls', pdf_url)
-                        except NoSuchElementException:
-                            # Log no PDF file for article
-                            # save_to_log(LOG_FILE_ARTICLE_NO_PDF, self.driver.current_url)
-                            save_to_log_csv(LOG_FILE_ARTICLE_NO_PDF, [issn, journal_name, self.driver.current_url])
-                            print('>>>>>>>>>>>>>>> SAVING URL ARTICLE WITH NO PDF FILE FOR DOWNLOAD TO LOG ...')
-
-                        # Get link to RIS file
-                        try:
-                            ris_url = self.driver.find_element_by_xpath('//li/a[contains(text(), "RIS (EndNote)")]').get_attribute('href')
-                            l.add_value('file_urls', ris_url)
-                        except NoSuchElementException:
-                            # Log no RIS file for article
-                            # save_to_log(LOG_FILE_ARTICLE_NO_RIS, self.driver.current_url)
-                            save_to_log_csv(LOG_FILE_ARTICLE_NO_RIS, [issn, journal_name, self.driver.current_url])
-                            print('>>>>>>>>>>>>>>> SAVING URL ARTICLE WITH NO RIS FILE FOR DOWNLOAD TO LOG ...')
-
-                        # yield scrapy.Request(url=detail_article_url, callback=self.datailed_page, meta={'item': item}, dont_filter=True)
-                        yield l.load_item()
-                else:
-                    # Log URL of the issue that has no articles
-                    # save_to_log(LOG_FILE_ISSUE_NO_ATRICLES, self.driver.current_url)
-                    save_to_log_csv(LOG_FILE_ISSUE_NO_ATRICLES, [issn, journal_name, self.driver.current_url])
-                    print('>>>>>>>>>>>>>>> SAVING JOURNAL ISSUE URL WITHOUT ATRICLES TO LOG ...')
-                    print('-------------------------> GO TO NEXT JOURNAL ISSUE <--------------------------')
+                # Journal page already shows the latest issue
+                if issue_link == response.url:
+                    for result in self.parse_issue_page(response, issn, journal_name):
+                        yield result
                     continue
 
-    def close(self, reason):
-        self.driver.close()
+                yield scrapy.Request(issue_link, dont_filter=True, callback=self.parse_issue, meta=self.browser_meta(issn=issn, journal_name=journal_name))
+
+    def parse_issue(self, response):
+        return self.parse_issue_page(response, response.meta['issn'], response.meta['journal_name'])
+
+    def parse_issue_page(self, response, issn, journal_name):
+        # Check if PDF Download articles on the page
+        check_pdf_links = XPATHS.evaluate(response, 'pdf_links')
+        # Check if NO PDF articles
+        check_no_pdf_link = XPATHS.evaluate(response, 'no_pdf_links')
+
+        if not check_pdf_links and not check_no_pdf_link:
+            # Log URL of the issue that has no articles
+            self.events.log(LOG_FILE_ISSUE_NO_ATRICLES, [issn, journal_name, response.url])
+            return
+
+        # Log URL of the issue that has a MIX of both types of articles
+        if check_pdf_links and check_no_pdf_link:
+            self.events.log(LOG_FILE_ISSUE_MIX_ARTICLES, [issn, journal_name, response.url])
+
+        # Log URL of the issue that has NO PDF articles
+        if not check_pdf_links:
+            self.events.log(LOG_FILE_ISSUE_NO_PDF_ARTICLES, [issn, journal_name, response.url])
+
+        # Same for every article on the page
+        journal = XPATHS.getall(response, 'journal_name')
+        issue_details = XPATHS.getall(response, 'issue_details')
+
+        articles = XPATHS.evaluate(response, 'articles')
+        for article in articles:
+            l = ItemLoader(item=JournalItem())
+            l.default_output_processor = TakeFirst()
+
+            l.add_value('journal', journal)
+            l.add_value('file_name', XPATHS.getall(article, 'article_title'))
+            l.add_value('issue', issue_details)
+            l.add_value('year', issue_details)
+
+            # Go to detailed page
+            detail_article_url = XPATHS.get(article, 'article_url')
+            yield response.follow(detail_article_url, dont_filter=True, callback=self.parse_article, meta=self.browser_meta(item=l.load_item(), issn=issn, journal_name=journal_name))
+
+    def parse_article(self, response):
+        issn = response.meta['issn']
+        journal_name = response.meta['journal_name']
+
+        item = response.meta['item']
+        item['cookies'] = response.meta['browser_cookies']
+        item['file_urls'] = []
+
+        # Get link to PDF document
+        pdf_url = XPATHS.get(response, 'pdf_url')
+        if pdf_url:
+            item['file_urls'].append(response.urljoin(pdf_url))
+        else:
+            # Log no PDF file for article
+            self.events.log(LOG_FILE_ARTICLE_NO_PDF, [issn, journal_name, response.url])
+
+        # Get link to RIS file
+        ris_url = XPATHS.get(response, 'ris_url')
+        if ris_url:
+            item['file_urls'].append(response.urljoin(ris_url))
+        else:
+            # Log no RIS file for article
+            self.events.log(LOG_FILE_ARTICLE_NO_RIS, [issn, journal_name, response.url])
+
+        yield item
@@ -3,14 +3,17 @@ import scrapy
 import csv
 import os.path
 import re
+from urllib.parse import urljoin
 
 from scrapy import FormRequest
-from scrapy.utils.project import get_project_settings
 from w3lib.html import replace_escape_chars, replace_entities
 from scrapy.utils.response import open_in_browser
+from journal.citations import batches, citation_batch_request, key_doi, split_ris
+from journal.context import JournalContext
+from journal.events import EventSink
 from journal.items import TaylorItem
-from time import sleep
-from random import randint
+from journal.ledger import STATUS_FAILED, STATUS_MISSING, DownloadLedger, article_doi, article_key
+from journal.selectors import XPathRegistry
 
 
 # User configuration parameters
@@ -19,13 +22,12 @@ LIMIT_ISSUES = 2  # None - all issues
 LIMIT_ARTICLES = None  # None - all articles
 MIN_PAUSE_SECONDS = 5
 MAX_PAUSE_SECONDS = 7
-
-# Spider settings
-settings = get_project_settings()
+TOC_ONLY = False  # True - PDF links built from the issue TOC, article pages only when they fail
 
 # Spider folders
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 CSV_FILE_WITH_URLS = os.path.join(ROOT_DIR, 'journals.csv')
+LEDGER_FILE = os.path.join(ROOT_DIR, 'download_ledger.sqlite')
 
 # Log configuration
 LOG_HEADERS = ['Journal_Name', 'URL']
@@ -39,6 +41,23 @@ LOG_FILE_ISSUE_NO_ATRICLES = os.path.join(LOG_FOLDER, 'log_no_article_issues.csv
 LOG_FILE_ARTICLE_NO_PDF = os.path.join(LOG_FOLDER, 'log_article_no_pdf_file.csv')
 LOG_FILE_ARTICLE_NO_RIS = os.path.join(LOG_FOLDER, 'log_article_no_ris_file.csv')
 
+# Parse callbacks XPath expressions, compiled once
+XPATHS = XPathRegistry(
+    journal_name='//title/text()',
+    volumes='//ul[@class="list-of-issues"]/li[@class="vol_li "]/a',
+    volume_title='./h3/text()',
+    issues='//li[@class="vol_li active"]/ul/li/a',
+    issue_number='./div[contains(@class, "issue-num")]/text()',
+    articles='//table[@class="articleEntry"]//div[@class="art_title linkable"]/a',
+    link_href='./@href',
+    article_title='./span/text()',
+    pdf_url='//a[@class="show-pdf"]/@href',
+    citation_url='//li[@class="downloadCitations"]/a/@href',
+)
+
+# PDF link of an article DOI in the TOC-only mode
+PDF_URL_TEMPLATE = '/doi/pdf/{doi}'
+
 
 def remove_garbage(val):
     val = replace_escape_chars(val)
@@ -60,51 +79,40 @@ class TaylorFrancisDownloadAuthSpider(scrapy.Spider):
     # start_urls = ['https://www-tandfonline-com.proxy.library.carleton.ca/loi/calr20']
 
     custom_settings = {
-        'FILES_STORE': settings.get('JOURNALS_STORAGE'),
         'ITEM_PIPELINES': {
+            'journal.pipelines.RisWriterPipeline': 200,
             'journal.pipelines.TaylorPdfPipeline': 300,
         },
     }
 
-    def init_folders_path(self, folder_path):
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-
-    def save_to_log_csv(self, file_path, list_values):
-        row = dict(zip(LOG_HEADERS, list_values))
-        file_exists = os.path.exists(file_path)
-
-        with open(file_path, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=LOG_HEADERS)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(row)
+    @classmethod
+    def update_settings(cls, settings):
+        # Files go to JOURNALS_STORAGE of the crawl settings unless custom_settings say otherwise
+        settings.set('FILES_STORE', settings.get('JOURNALS_STORAGE'), priority='spider')
+        super(TaylorFrancisDownloadAuthSpider, cls).update_settings(settings)
 
-    def save_ris_file(self, response, meta):
-        storage = self.settings['JOURNALS_STORAGE']
-        journal_name = meta['journal_name']
-        volume_title = meta['volume_title']
-        issue_number = meta['issue_number']
-        article_title = meta['article_title']
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        # Settings of the crawl, not read when the spider module is imported
+        spider = super(TaylorFrancisDownloadAuthSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.events = EventSink.from_settings(crawler.settings, LOG_FOLDER, LOG_HEADERS)
+        return spider
 
-        storage_path = os.path.join(storage, journal_name, volume_title, issue_number)
-        ris_file = article_title + '.txt'
-        ris_file_path = os.path.join(storage_path, ris_file)
-
-        self.init_folders_path(storage_path)
-        with open(ris_file_path, 'w', encoding='utf-8') as f:
-            f.write(response.text)
-
-    def __init__(self, limit_years=LIMIT_YEARS, limit_issues=LIMIT_ISSUES, limit_articles=LIMIT_ARTICLES, min_p=MIN_PAUSE_SECONDS, max_p=MAX_PAUSE_SECONDS, *args, **kwargs):
+    def __init__(self, limit_years=LIMIT_YEARS, limit_issues=LIMIT_ISSUES, limit_articles=LIMIT_ARTICLES, min_p=MIN_PAUSE_SECONDS, max_p=MAX_PAUSE_SECONDS, toc_only=TOC_ONLY, *args, **kwargs):
         super(TaylorFrancisDownloadAuthSpider, self).__init__(*args, **kwargs)
-        self.settings = settings
         self.limit_years = limit_years
         self.limit_issues = limit_issues
         self.limit_articles = limit_articles
         self.min_p = min_p
         self.max_p = max_p
+        # Needs the citation batches for the RIS files (CITATION_BATCH_SIZE)
+        self.toc_only = str(toc_only).lower() in ('true', '1', 'yes')
         self.login_form_xpath = '//form[@id="mc1" and @action="/login"]'
-        self.init_folders_path(LOG_FOLDER)
+        self.ledger = DownloadLedger(LEDGER_FILE)
+
+    def closed(self, reason):
+        self.events.close()
+        self.ledger.close()
 
     # Getting all start_urls from csv file
     # def start_requests(self):
@@ -113,12 +121,16 @@ class TaylorFrancisDownloadAuthSpider(scrapy.Spider):
     #         start_urls = [line['Journal_URL'] for line in csv_reader]
     #     return [scrapy.Request(url, dont_filter=True) for url in start_urls]
 
+    async def start(self):
+        for request in self.start_requests():
+            yield request
+
     # Getting all start_urls from csv file
     def start_requests(self):
         with open(CSV_FILE_WITH_URLS) as csv_file:
             csv_reader = csv.DictReader(csv_file)
             start_urls = [line['Journal_URL'] for line in csv_reader]
-        yield scrapy.Request(start_urls[0], dont_filter=True, meta={'start_urls': start_urls}, callback=self.login_to_library)
+        yield scrapy.Request(start_urls[0], dont_filter=True, meta={'start_urls': start_urls, 'dont_relogin': True}, callback=self.login_to_library)
 
     def login_to_library(self, response):
         start_urls = response.meta['start_urls']
@@ -128,7 +140,7 @@ class TaylorFrancisDownloadAuthSpider(scrapy.Spider):
                 'user': self.settings['CREDENTIALS']['user'],
                 'pass': self.settings['CREDENTIALS']['pass'],
             }
-            yield FormRequest.from_response(response, formxpath=self.login_form_xpath, formdata=credentials, meta={'start_urls': start_urls}, dont_filter=True, callback=self.parse_journals)
+            yield FormRequest.from_response(response, formxpath=self.login_form_xpath, formdata=credentials, meta={'start_urls': start_urls, 'dont_relogin': True}, dont_filter=True, callback=self.parse_journals)
         else:
             # If no login required
             yield scrapy.Request(response.url, dont_filter=True, meta={'start_urls': start_urls}, callback=self.parse_journals)
@@ -136,147 +148,216 @@ class TaylorFrancisDownloadAuthSpider(scrapy.Spider):
     def parse_journals(self, response):
         for journal_url in response.meta['start_urls']:
             # Pause between request to journals
-            sleep(randint(self.min_p, self.max_p))
-            yield scrapy.Request(journal_url, dont_filter=True, callback=self.parse_journal)
+            yield scrapy.Request(journal_url, dont_filter=True, meta={'pause': True, 'cache_page': 'journal'}, callback=self.parse_journal)
 
     def parse_journal(self, response):
         # journal_name = response.xpath('//title/text()').get()
-        meta = {
-            'journal_name': response.xpath('//title/text()').get(),
-        }
+        context = JournalContext(journal_name=XPATHS.get(response, 'journal_name'))
 
-        volumes = response.xpath('//ul[@class="list-of-issues"]/li[@class="vol_li "]/a')
+        volumes = XPATHS.select(response, 'volumes')
 
         # Log journal without content
         if not volumes:
-            self.save_to_log_csv(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [meta['journal_name'], response.meta.get('redirect_urls', [response.url])[0]])
-            print('>>>>>>>>>>>>>>> SAVING JOURNAL WITH NO CONTENT TO LOG ...')
+            self.events.log(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [context.journal_name, response.meta.get('redirect_urls', [response.url])[0]])
             return False
 
-        for volume in volumes[:self.limit_years]:
-            volume_title = volume.xpath('./h3/text()').get()
-            meta['volume_title'] = remove_garbage(volume_title)
-            yield response.follow(volume, callback=self.parse_volume, dont_filter=True, meta=meta)
+        for index, volume in enumerate(volumes[:self.limit_years]):
+            volume_title = XPATHS.get(volume, 'volume_title')
+            yield response.follow(volume, callback=self.parse_volume, dont_filter=True, meta={
+                'context': context.child(volume_title=remove_garbage(volume_title)),
+                # Newest volume first, only it still gets new issues
+                'cache_page': 'closed_volume' if index else 'current_volume',
+            })
 
     def parse_volume(self, response):
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-        }
+        context = response.meta['context']
 
-        issues = response.xpath('//li[@class="vol_li active"]/ul/li/a')
+        issues = XPATHS.select(response, 'issues')
 
         # Log journal without issues
         if not issues:
-            self.save_to_log_csv(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING JOURNAL WITHOUT ISSUES TO LOG ...')
+            self.events.log(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [context.journal_name, response.url])
             return False
 
         for issue in issues[:self.limit_issues]:
             # Pause between issues
-            sleep(randint(self.min_p, self.max_p))
-            meta['issue_number'] = issue.xpath('./div[contains(@class, "issue-num")]/text()').get()
-            yield response.follow(issue, callback=self.parse_issue, dont_filter=True, meta=meta)
+            yield response.follow(issue, callback=self.parse_issue, dont_filter=True, meta={
+                'context': context.child(issue_number=XPATHS.get(issue, 'issue_number')),
+                'cache_page': response.meta['cache_page'],
+                'pause': True,
+            })
 
     def parse_issue(self, response):
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-            'issue_number': response.meta['issue_number'],
-        }
+        context = response.meta['context']
 
-        articles = response.xpath('//table[@class="articleEntry"]//div[@class="art_title linkable"]/a')
+        articles = XPATHS.select(response, 'articles')
 
         # Log issue without articles
         if not articles:
-            self.save_to_log_csv(LOG_FILE_ISSUE_NO_ATRICLES, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING ISSUE WITHOUT ARTICLES TO LOG ...')
+            self.events.log(LOG_FILE_ISSUE_NO_ATRICLES, [context.journal_name, response.url])
             return False
 
+        batch = []
+        batch_size = self.settings.getint('CITATION_BATCH_SIZE')
         for article in articles[:self.limit_articles]:
+            article_url = response.urljoin(XPATHS.get(article, 'link_href'))
+            key = article_key(article_url)
+
+            # Skip article downloaded by previous run
+            if self.ledger.is_complete(key):
+                self.crawler.stats.inc_value('ledger/skipped_articles')
+                continue
+
+            article_context = context.child(article_title=XPATHS.get(article, 'article_title'), article_key=key)
+
+            # RIS of the articles with a DOI come in the issue citation batches
+            if batch_size and key_doi(key):
+                batch.append((article_url, article_context))
+                continue
+
             # Pause between requsts to articles
-            sleep(randint(self.min_p, self.max_p))
-            meta['article_title'] = article.xpath('./span/text()').get()
-            yield response.follow(article, callback=self.parse_article, dont_filter=True, meta=meta)
+            yield response.follow(article, callback=self.parse_article, dont_filter=True, meta={
+                'context': article_context,
+                'pause': True,
+            })
+
+        for articles_batch in batches(batch, batch_size):
+            yield citation_batch_request(response, articles_batch, callback=self.parse_citations, errback=self.citations_failed)
+
+    def parse_citations(self, response):
+        records = split_ris(response.body)
+
+        # Error or HTML page sent with a 200
+        if not records:
+            for result in self.failed_batch(response.meta['articles']):
+                yield result
+            return
+
+        self.crawler.stats.inc_value('citations/batches')
+        for article_url, context in response.meta['articles']:
+            ris_body = records.get(key_doi(context.article_key))
+            if ris_body is None:
+                # Left out of the answer, RIS (and PDF) from the article page
+                self.crawler.stats.inc_value('citations/fallbacks')
+                yield self.article_request(article_url, context)
+            else:
+                for result in self.follow_article(article_url, context, None, ris_body):
+                    yield result
+
+    def citations_failed(self, failure):
+        return self.failed_batch(failure.request.meta['articles'])
+
+    def failed_batch(self, articles):
+        # Articles are still downloaded, without RIS
+        self.crawler.stats.inc_value('citations/failed_batches')
+        for article_url, context in articles:
+            for result in self.follow_article(article_url, context, STATUS_FAILED):
+                yield result
+
+    def follow_article(self, article_url, context, ris_status, ris_body=None):
+        # PDF link from the DOI, the article page only if it fails (pdf_fallback_request)
+        if self.toc_only:
+            self.ledger.update(context.article_key, journal_name=context.journal_name, article_url=article_url)
+            pdf_url = urljoin(article_url, PDF_URL_TEMPLATE.format(doi=article_doi(article_url)))
+            for item in self.ris_items(context.child(pdf_url=pdf_url, article_url=article_url), ris_status, ris_body):
+                item['pdf_fallback_url'] = article_url
+                yield item
+        else:
+            yield self.article_request(article_url, context, ris_status=ris_status, ris_body=ris_body)
+
+    def article_request(self, article_url, context, **meta):
+        # Pause between requsts to articles
+        meta.update(context=context, pause=True)
+        return scrapy.Request(article_url, callback=self.parse_article, dont_filter=True, meta=meta)
+
+    def pdf_fallback_request(self, item):
+        # Article page of a TOC-only PDF link which didn't work, its RIS is done
+        context = JournalContext(journal_name=item['journal_name']).child(volume_title=item['volume_title'])
+        context = context.child(issue_number=item['issue_number']).child(article_title=item['article_title'], article_key=item['article_key'])
+        return self.article_request(item['pdf_fallback_url'], context, pdf_only=True)
 
     def parse_article(self, response):
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-            'issue_number': response.meta['issue_number'],
-            'article_title': response.meta['article_title'],
-        }
+        context = response.meta['context']
+        self.ledger.update(context.article_key, journal_name=context.journal_name, article_url=response.url)
 
-        pdf_url = response.xpath('//a[@class="show-pdf"]/@href').get()
+        pdf_url = XPATHS.get(response, 'pdf_url')
 
         # Log article without pdf
         if not pdf_url:
-            self.save_to_log_csv(LOG_FILE_ARTICLE_NO_PDF, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT PDF TO LOG ...')
+            self.ledger.update(context.article_key, pdf_status=STATUS_MISSING)
+            self.events.log(LOG_FILE_ARTICLE_NO_PDF, [context.journal_name, response.url])
+
+        context = context.child(pdf_url=response.urljoin(pdf_url) if pdf_url else None, article_url=response.url)
 
-        meta['pdf_url'] = response.urljoin(pdf_url)
-        meta['article_url'] = response.url
+        # PDF of a TOC-only article
+        if response.meta.get('pdf_only'):
+            if pdf_url:
+                yield self.make_item(context)
+            return
+
+        # RIS of the issue citation batch
+        if 'ris_status' in response.meta:
+            for item in self.ris_items(context, response.meta['ris_status'], response.meta.get('ris_body')):
+                yield item
+            return
 
-        citation_url = response.xpath('//li[@class="downloadCitations"]/a/@href').get()
+        citation_url = XPATHS.get(response, 'citation_url')
 
         # Log article without ris
         if not citation_url:
-            self.save_to_log_csv(LOG_FILE_ARTICLE_NO_RIS, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT RIS FILE TO LOG ...')
+            for item in self.no_ris(context):
+                yield item
 
             # Check ability to download PDF
-            if meta['pdf_url']:
-                item = TaylorItem()
-                item['journal_name'] = prevent_spec_chars(response.meta['journal_name'])
-                item['volume_title'] = prevent_spec_chars(response.meta['volume_title'])
-                item['issue_number'] = prevent_spec_chars(response.meta['issue_number'])
-                item['article_title'] = prevent_spec_chars(response.meta['article_title'])
-                item['file_urls'] = [response.meta['pdf_url']]
-                yield item
-            else:
+            if not context.pdf_url:
                 # No PDF and RIS for downloading
                 return False
 
-        yield response.follow(citation_url, callback=self.parse_citation, dont_filter=True, meta=meta)
+        yield response.follow(citation_url, callback=self.parse_citation, dont_filter=True, meta={'context': context})
 
     def parse_citation(self, response):
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-            'issue_number': response.meta['issue_number'],
-            'article_title': response.meta['article_title'],
-            'pdf_url': response.meta['pdf_url'],
-            'article_url': response.meta['article_url'],
-        }
-
         formdata = {
             'include': 'abs',
         }
-        yield FormRequest.from_response(response, formxpath='//form[@action="/action/downloadCitation"]', formdata=formdata, dont_filter=True, meta=meta, callback=self.save_data)
+        yield FormRequest.from_response(response, formxpath='//form[@action="/action/downloadCitation"]', formdata=formdata, dont_filter=True, meta={'context': response.meta['context']}, callback=self.save_data)
 
     def save_data(self, response):
-        # meta = {
-        #     'journal_name': response.meta['journal_name'],
-        #     'volume_title': response.meta['volume_title'],
-        #     'issue_number': response.meta['issue_number'],
-        #     'article_title': response.meta['article_title'],
-        #     'pdf_url': response.meta['pdf_url'],
-        # }
+        # self.save_ris_file(response, meta)
+        return self.save_ris(response.meta['context'], response.body if response.status == 200 else None)
 
+    def make_item(self, context):
         item = TaylorItem()
-        item['journal_name'] = prevent_spec_chars(response.meta['journal_name'])
-        item['volume_title'] = prevent_spec_chars(response.meta['volume_title'])
-        item['issue_number'] = prevent_spec_chars(response.meta['issue_number'])
-        item['article_title'] = prevent_spec_chars(response.meta['article_title'])
-        item['file_urls'] = [response.meta['pdf_url']]
-
-        # self.save_ris_file(response, meta)
-        if response.status == 200:
-            self.save_ris_file(response, item)
+        item['journal_name'] = prevent_spec_chars(context.journal_name)
+        item['volume_title'] = prevent_spec_chars(context.volume_title)
+        item['issue_number'] = prevent_spec_chars(context.issue_number)
+        item['article_title'] = prevent_spec_chars(context.article_title)
+        item['article_key'] = context.article_key
+        # RIS only when the article has no PDF
+        item['file_urls'] = [context.pdf_url] if context.pdf_url else []
+        return item
+
+    def ris_items(self, context, ris_status, ris_body):
+        if ris_status == STATUS_MISSING:
+            return self.no_ris(context)
+        return self.save_ris(context, ris_body)
+
+    def no_ris(self, context):
+        self.ledger.update(context.article_key, ris_status=STATUS_MISSING)
+        self.events.log(LOG_FILE_ARTICLE_NO_RIS, [context.journal_name, context.article_url])
+
+        # Check ability to download PDF
+        if context.pdf_url:
+            yield self.make_item(context)
+
+    def save_ris(self, context, ris_body):
+        # ris_body is None when its download failed
+        item = self.make_item(context)
+
+        if ris_body is not None:
+            item['ris_body'] = ris_body
         else:
+            self.ledger.update(item['article_key'], ris_status=STATUS_FAILED)
             # Log article without ris
-            self.save_to_log_csv(LOG_FILE_ARTICLE_NO_RIS, [item['journal_name'], response.meta['article_url']])
-            print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT RIS FILE TO LOG ...')
+            self.events.log(LOG_FILE_ARTICLE_NO_RIS, [item['journal_name'], context.article_url])
 
-        # yield meta
         yield item
@@ -2,16 +2,18 @@
 import csv
 import os.path
 import re
-from random import randint
-from time import sleep
 
 import scrapy
 from scrapy import FormRequest
-from scrapy.utils.project import get_project_settings
 from scrapy.utils.response import open_in_browser
 from w3lib.html import replace_entities, replace_escape_chars
 
+from journal.citations import batches, citation_batch_request, key_doi, split_ris
+from journal.context import JournalContext
+from journal.events import EventSink
 from journal.items import WileyItem
+from journal.ledger import STATUS_FAILED, STATUS_MISSING, DownloadLedger, article_key
+from journal.selectors import XPathRegistry
 
 # User configuration parameters
 LIMIT_YEARS = 2  # None - all years
@@ -20,12 +22,10 @@ LIMIT_ARTICLES = None  # None - all articles
 MIN_PAUSE_SECONDS = 1
 MAX_PAUSE_SECONDS = 3
 
-# Spider settings
-settings = get_project_settings()
-
 # Spider folders
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 CSV_FILE_WITH_URLS = os.path.join(ROOT_DIR, 'journals.csv')
+LEDGER_FILE = os.path.join(ROOT_DIR, 'download_ledger.sqlite')
 
 # Log configuration
 LOG_HEADERS = ['Journal_Name', 'URL']
@@ -39,6 +39,20 @@ LOG_FILE_ARTICLE_NO_RIS = os.path.join(LOG_FOLDER, 'log_article_no_ris_file.csv'
 LOG_FILE_ARTICLE_NO_PDF_NO_RIS = os.path.join(LOG_FOLDER, 'log_article_no_pdf_no_ris.csv')
 
 
+# Parse callbacks XPath expressions, compiled once
+XPATHS = XPathRegistry(
+    journal_name='//h1[@id="journal-banner-text"]/text()',
+    volumes='//ul[contains(@class, "loi__list")]//li/a',
+    issues='//ul[contains(@class, "loi__issues")]//h4/a',
+    articles='//div[@class="issue-item"]/a[h2]',
+    link_text='string(.)',
+    link_href='./@href',
+    article_title='string(./h2)',
+    pdf_url='//div[@class="coolBar__second rlist"]//a[contains(@class, "pdf-download") and @title="Article PDF"]/@href',
+    citation_url='//a[starts-with(@href, "/action/showCitFormats?")]/@href',
+)
+
+
 def remove_garbage(val):
     val = replace_escape_chars(val)
     val = replace_entities(val)
@@ -57,57 +71,48 @@ class WileyDownloadAuthSpider(scrapy.Spider):
     name = 'wiley_download_auth'
 
     custom_settings = {
-        'FILES_STORE': settings.get('JOURNALS_STORAGE'),
         'ITEM_PIPELINES': {
+            'journal.pipelines.RisWriterPipeline': 200,
             'journal.pipelines.WileyPdfPipeline': 300,
         },
     }
 
-    def init_folders_path(self, folder_path):
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-
-    def save_to_log_csv(self, file_path, list_values):
-        row = dict(zip(LOG_HEADERS, list_values))
-        file_exists = os.path.exists(file_path)
-
-        with open(file_path, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=LOG_HEADERS)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(row)
+    @classmethod
+    def update_settings(cls, settings):
+        # Files go to JOURNALS_STORAGE of the crawl settings unless custom_settings say otherwise
+        settings.set('FILES_STORE', settings.get('JOURNALS_STORAGE'), priority='spider')
+        super(WileyDownloadAuthSpider, cls).update_settings(settings)
 
-    def save_ris_file(self, response, meta):
-        storage = self.settings['JOURNALS_STORAGE']
-        journal_name = meta['journal_name']
-        volume_title = meta['volume_title']
-        issue_number = meta['issue_number']
-        article_title = meta['article_title']
-
-        storage_path = os.path.join(storage, journal_name, volume_title, issue_number)
-        ris_file = article_title + '.txt'
-        ris_file_path = os.path.join(storage_path, ris_file)
-
-        self.init_folders_path(storage_path)
-        with open(ris_file_path, 'w', encoding='utf-8') as f:
-            f.write(response.text)
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        # Settings of the crawl, not read when the spider module is imported
+        spider = super(WileyDownloadAuthSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.events = EventSink.from_settings(crawler.settings, LOG_FOLDER, LOG_HEADERS)
+        return spider
 
     def __init__(self, limit_years=LIMIT_YEARS, limit_issues=LIMIT_ISSUES, limit_articles=LIMIT_ARTICLES, min_p=MIN_PAUSE_SECONDS, max_p=MAX_PAUSE_SECONDS, *args, **kwargs):
         super(WileyDownloadAuthSpider, self).__init__(*args, **kwargs)
-        self.settings = settings
         self.limit_years = limit_years
         self.limit_issues = limit_issues
         self.limit_articles = limit_articles
         self.min_p = min_p
         self.max_p = max_p
         self.login_form_xpath = '//form[@id="mc1" and @action="/login"]'
-        self.init_folders_path(LOG_FOLDER)
+        self.ledger = DownloadLedger(LEDGER_FILE)
+
+    def closed(self, reason):
+        self.events.close()
+        self.ledger.close()
+
+    async def start(self):
+        for request in self.start_requests():
+            yield request
 
     def start_requests(self):
         with open(CSV_FILE_WITH_URLS) as csv_file:
             csv_reader = csv.DictReader(csv_file)
             start_urls = [line['Journal_URL'] for line in csv_reader]
-        yield scrapy.Request(start_urls[0], dont_filter=True, meta={'start_urls': start_urls}, callback=self.login_to_library)
+        yield scrapy.Request(start_urls[0], dont_filter=True, meta={'start_urls': start_urls, 'dont_relogin': True}, callback=self.login_to_library)
 
     def login_to_library(self, response):
         start_urls = response.meta['start_urls']
@@ -118,7 +123,7 @@ class WileyDownloadAuthSpider(scrapy.Spider):
                 'pass': self.settings['CREDENTIALS']['pass'],
             }
             # open_in_browser(response)
-            yield FormRequest.from_response(response, formxpath=self.login_form_xpath, formdata=credentials, meta={'start_urls': start_urls}, dont_filter=True, callback=self.parse_journals)
+            yield FormRequest.from_response(response, formxpath=self.login_form_xpath, formdata=credentials, meta={'start_urls': start_urls, 'dont_relogin': True}, dont_filter=True, callback=self.parse_journals)
         else:
             # If no login required
             # open_in_browser(response)
@@ -128,152 +133,202 @@ class WileyDownloadAuthSpider(scrapy.Spider):
         # open_in_browser(response)
         for journal_url in response.meta['start_urls']:
             # Pause between request to journals
-            sleep(randint(self.min_p, self.max_p))
-            yield scrapy.Request(journal_url, dont_filter=True, callback=self.parse_journal)
+            yield scrapy.Request(journal_url, dont_filter=True, meta={'pause': True, 'cache_page': 'journal'}, callback=self.parse_journal)
 
     def parse_journal(self, response):
         # open_in_browser(response)
-        meta = {
-            'journal_name': response.xpath('//h1[@id="journal-banner-text"]/text()').get(),
-        }
+        context = JournalContext(journal_name=XPATHS.get(response, 'journal_name'))
 
-        volumes = response.xpath('//ul[contains(@class, "loi__list")]//li/a')
+        volumes = XPATHS.select(response, 'volumes')
 
         # Log journal without content
         if not volumes:
-            self.save_to_log_csv(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [meta['journal_name'], response.meta.get('redirect_urls', [response.url])[0]])
-            print('>>>>>>>>>>>>>>> SAVING JOURNAL WITH NO CONTENT TO LOG ...')
+            self.events.log(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [context.journal_name, response.meta.get('redirect_urls', [response.url])[0]])
             return False
 
-        for volume in volumes[:self.limit_years]:
-            volume_title = volume.xpath('string(.)').get()
-            meta['volume_title'] = remove_garbage(volume_title)
-            yield response.follow(volume, callback=self.parse_volume, dont_filter=True, meta=meta)
+        for index, volume in enumerate(volumes[:self.limit_years]):
+            volume_title = XPATHS.get(volume, 'link_text')
+            yield response.follow(volume, callback=self.parse_volume, dont_filter=True, meta={
+                'context': context.child(volume_title=remove_garbage(volume_title)),
+                # Newest volume first, only it still gets new issues
+                'cache_page': 'closed_volume' if index else 'current_volume',
+            })
 
     def parse_volume(self, response):
         # open_in_browser(response)
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-        }
+        context = response.meta['context']
 
-        issues = response.xpath('//ul[contains(@class, "loi__issues")]//h4/a')
+        issues = XPATHS.select(response, 'issues')
 
         # Log journal without issues
         if not issues:
-            self.save_to_log_csv(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING JOURNAL WITHOUT ISSUES TO LOG ...')
+            self.events.log(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [context.journal_name, response.url])
             return False
 
         for issue in issues[:self.limit_issues]:
             # Pause between issues
-            sleep(randint(self.min_p, self.max_p))
-            meta['issue_number'] = issue.xpath('string(.)').get()
-            yield response.follow(issue, callback=self.parse_issue, dont_filter=True, meta=meta)
+            yield response.follow(issue, callback=self.parse_issue, dont_filter=True, meta={
+                'context': context.child(issue_number=XPATHS.get(issue, 'link_text')),
+                'cache_page': response.meta['cache_page'],
+                'pause': True,
+            })
 
     def parse_issue(self, response):
         # open_in_browser(response)
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-            'issue_number': response.meta['issue_number'],
-        }
+        context = response.meta['context']
 
-        articles = response.xpath('//div[@class="issue-item"]/a[h2]')
+        articles = XPATHS.select(response, 'articles')
 
         # Log issue without articles
         if not articles:
-            self.save_to_log_csv(LOG_FILE_ISSUE_NO_ATRICLES, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING ISSUE WITHOUT ARTICLES TO LOG ...')
+            self.events.log(LOG_FILE_ISSUE_NO_ATRICLES, [context.journal_name, response.url])
             return False
 
+        batch = []
+        batch_size = self.settings.getint('CITATION_BATCH_SIZE')
         for article in articles[:self.limit_articles]:
+            article_url = response.urljoin(XPATHS.get(article, 'link_href'))
+            key = article_key(article_url)
+
+            # Skip article downloaded by previous run
+            if self.ledger.is_complete(key):
+                self.crawler.stats.inc_value('ledger/skipped_articles')
+                continue
+
+            article_context = context.child(article_title=XPATHS.get(article, 'article_title'), article_key=key)
+
+            # RIS of the articles with a DOI come in the issue citation batches
+            if batch_size and key_doi(key):
+                batch.append((article_url, article_context))
+                continue
+
             # Pause between requsts to articles
-            sleep(randint(self.min_p, self.max_p))
-            meta['article_title'] = article.xpath('string(./h2)').get()
-            yield response.follow(article, callback=self.parse_article, dont_filter=True, meta=meta)
+            yield response.follow(article, callback=self.parse_article, dont_filter=True, meta={
+                'context': article_context,
+                'pause': True,
+            })
+
+        for articles_batch in batches(batch, batch_size):
+            yield citation_batch_request(response, articles_batch, callback=self.parse_citations, errback=self.citations_failed)
+
+    def parse_citations(self, response):
+        records = split_ris(response.body)
+
+        # Error or HTML page sent with a 200
+        if not records:
+            for request in self.failed_batch(response.meta['articles']):
+                yield request
+            return
+
+        self.crawler.stats.inc_value('citations/batches')
+        for article_url, context in response.meta['articles']:
+            ris_body = records.get(key_doi(context.article_key))
+            if ris_body is None:
+                # Left out of the answer, RIS from the article page
+                self.crawler.stats.inc_value('citations/fallbacks')
+                yield self.article_request(article_url, context)
+            else:
+                yield self.article_request(article_url, context, ris_status=None, ris_body=ris_body)
+
+    def citations_failed(self, failure):
+        return self.failed_batch(failure.request.meta['articles'])
+
+    def failed_batch(self, articles):
+        # Articles are still downloaded, without RIS
+        self.crawler.stats.inc_value('citations/failed_batches')
+        for article_url, context in articles:
+            yield self.article_request(article_url, context, ris_status=STATUS_FAILED)
+
+    def article_request(self, article_url, context, **meta):
+        # Pause between requsts to articles
+        meta.update(context=context, pause=True)
+        return scrapy.Request(article_url, callback=self.parse_article, dont_filter=True, meta=meta)
 
     def parse_article(self, response):
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-            'issue_number': response.meta['issue_number'],
-            'article_title': response.meta['article_title'],
-        }
+        context = response.meta['context']
+        self.ledger.update(context.article_key, journal_name=context.journal_name, article_url=response.url)
 
-        pdf_url = response.xpath('//div[@class="coolBar__second rlist"]//a[contains(@class, "pdf-download") and @title="Article PDF"]/@href').get()
+        pdf_url = XPATHS.get(response, 'pdf_url')
 
         # Log article without pdf
         if not pdf_url:
-            self.save_to_log_csv(LOG_FILE_ARTICLE_NO_PDF, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT PDF TO LOG ...')
+            self.ledger.update(context.article_key, pdf_status=STATUS_MISSING)
+            self.events.log(LOG_FILE_ARTICLE_NO_PDF, [context.journal_name, response.url])
 
-        meta['pdf_url'] = response.urljoin(pdf_url)
-        meta['article_url'] = response.url
+        context = context.child(pdf_url=response.urljoin(pdf_url) if pdf_url else None, article_url=response.url)
 
-        citation_url = response.xpath('//a[starts-with(@href, "/action/showCitFormats?")]/@href').get()
+        # RIS of the issue citation batch
+        if 'ris_status' in response.meta:
+            if response.meta['ris_status'] == STATUS_MISSING:
+                items = self.no_ris(context)
+            else:
+                items = self.save_ris(context, response.meta.get('ris_body'))
+            for item in items:
+                yield item
+            return
+
+        citation_url = XPATHS.get(response, 'citation_url')
 
         # Log article without ris
         if not citation_url:
-            # Check ability to download PDF
-            if meta['pdf_url']:
-                # No RIS for downloading
-                self.save_to_log_csv(LOG_FILE_ARTICLE_NO_RIS, [meta['journal_name'], response.url])
-                print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT RIS FILE TO LOG ...')
-
-                item = WileyItem()
-                item['journal_name'] = prevent_spec_chars(meta['journal_name'])
-                item['volume_title'] = prevent_spec_chars(meta['volume_title'])
-                item['issue_number'] = prevent_spec_chars(meta['issue_number'])
-                item['article_title'] = prevent_spec_chars(meta['article_title'])
-                item['file_urls'] = [meta['pdf_url']]
+            for item in self.no_ris(context):
                 yield item
-            else:
-                # No PDF and RIS for downloading
-                self.save_to_log_csv(LOG_FILE_ARTICLE_NO_PDF_NO_RIS, [meta['journal_name'], response.url])
-                print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT PDF AND RIS TO LOG ...')
-                return False
         else:
-            yield response.follow(citation_url, callback=self.parse_citation, dont_filter=True, meta=meta)
+            yield response.follow(citation_url, callback=self.parse_citation, dont_filter=True, meta={'context': context})
 
     def parse_citation(self, response):
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-            'issue_number': response.meta['issue_number'],
-            'article_title': response.meta['article_title'],
-            'pdf_url': response.meta['pdf_url'],
-            'article_url': response.meta['article_url'],
-        }
-
         formdata = {
             'include': 'abs',
         }
-        yield FormRequest.from_response(response, formxpath='//form[@action="/action/downloadCitation"]', formdata=formdata, dont_filter=True, meta=meta, callback=self.save_data)
+        yield FormRequest.from_response(response, formxpath='//form[@action="/action/downloadCitation"]', formdata=formdata, dont_filter=True, meta={'context': response.meta['context']}, callback=self.save_data)
 
     def save_data(self, response):
+        return self.save_ris(response.meta['context'], response.body if response.status == 200 else None)
+
+    def make_item(self, context):
         item = WileyItem()
-        item['journal_name'] = prevent_spec_chars(response.meta['journal_name'])
-        item['volume_title'] = prevent_spec_chars(response.meta['volume_title'])
-        item['issue_number'] = prevent_spec_chars(response.meta['issue_number'])
-        item['article_title'] = prevent_spec_chars(response.meta['article_title'])
-        item['file_urls'] = [response.meta['pdf_url']]
-
-        if response.status == 200:
-            self.save_ris_file(response, item)
+        item['journal_name'] = prevent_spec_chars(context.journal_name)
+        item['volume_title'] = prevent_spec_chars(context.volume_title)
+        item['issue_number'] = prevent_spec_chars(context.issue_number)
+        item['article_title'] = prevent_spec_chars(context.article_title)
+        item['article_key'] = context.article_key
+        item['file_urls'] = [context.pdf_url]
+        return item
+
+    def no_ris(self, context):
+        self.ledger.update(context.article_key, ris_status=STATUS_MISSING)
+
+        # Check ability to download PDF
+        if context.pdf_url:
+            # No RIS for downloading
+            self.events.log(LOG_FILE_ARTICLE_NO_RIS, [context.journal_name, context.article_url])
+            yield self.make_item(context)
+        else:
+            # No PDF and RIS for downloading
+            self.events.log(LOG_FILE_ARTICLE_NO_PDF_NO_RIS, [context.journal_name, context.article_url])
+
+    def save_ris(self, context, ris_body):
+        # ris_body is None when its download failed
+        item = self.make_item(context)
+
+        if ris_body is not None:
+            item['ris_body'] = ris_body
             ris_downloaded = True
         else:
             # RIS file download error
+            self.ledger.update(item['article_key'], ris_status=STATUS_FAILED)
             ris_downloaded = False
 
-        if response.meta['pdf_url']:
+        if context.pdf_url:
             if not ris_downloaded:
                 # No RIS for downloading
-                self.save_to_log_csv(LOG_FILE_ARTICLE_NO_RIS, [response.meta['journal_name'], response.meta['article_url']])
-                print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT RIS FILE TO LOG ...')
+                self.events.log(LOG_FILE_ARTICLE_NO_RIS, [context.journal_name, context.article_url])
             yield item
         else:
             if not ris_downloaded:
                 # No PDF and RIS for downloading
-                self.save_to_log_csv(LOG_FILE_ARTICLE_NO_PDF_NO_RIS, [response.meta['journal_name'], response.meta['article_url']])
-                print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT PDF AND RIS TO LOG ...')
+                self.events.log(LOG_FILE_ARTICLE_NO_PDF_NO_RIS, [context.journal_name, context.article_url])
+            else:
+                # RIS file only
+                item['file_urls'] = []
+                yield item
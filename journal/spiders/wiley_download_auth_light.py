@@ -2,16 +2,17 @@
 import csv
 import os.path
 import re
-from random import randint
-from time import sleep
 
 import scrapy
 from scrapy import FormRequest
-from scrapy.utils.project import get_project_settings
 from scrapy.utils.response import open_in_browser
 from w3lib.html import replace_entities, replace_escape_chars
 
+from journal.context import JournalContext
+from journal.events import EventSink
 from journal.items import WileyItem
+from journal.ledger import STATUS_MISSING, DownloadLedger, article_doi, article_key
+from journal.selectors import XPathRegistry
 
 # User configuration parameters
 LIMIT_YEARS = 2  # None - all years
@@ -19,13 +20,12 @@ LIMIT_ISSUES = 1  # None - all issues
 LIMIT_ARTICLES = None  # None - all articles
 MIN_PAUSE_SECONDS = 1
 MAX_PAUSE_SECONDS = 3
-
-# Spider settings
-settings = get_project_settings()
+TOC_ONLY = False  # True - PDF links built from the issue TOC, article pages only when they fail
 
 # Spider folders
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 CSV_FILE_WITH_URLS = os.path.join(ROOT_DIR, 'journals.csv')
+LEDGER_FILE = os.path.join(ROOT_DIR, 'download_ledger.sqlite')
 
 # Log configuration
 LOG_HEADERS = ['Journal_Name', 'URL']
@@ -37,6 +37,22 @@ LOG_FILE_ISSUE_NO_ATRICLES = os.path.join(LOG_FOLDER, 'log_no_article_issues.csv
 LOG_FILE_ARTICLE_NO_PDF = os.path.join(LOG_FOLDER, 'log_article_no_pdf_file.csv')
 
 
+# Parse callbacks XPath expressions, compiled once
+XPATHS = XPathRegistry(
+    journal_name='//h1[@id="journal-banner-text"]/text()',
+    volumes='//ul[contains(@class, "loi__list")]//li/a',
+    issues='//ul[contains(@class, "loi__issues")]//h4/a',
+    articles='//div[@class="issue-item"]/a[h2]',
+    link_text='string(.)',
+    link_href='./@href',
+    article_title='string(./h2)',
+    pdf_url='//div[@class="coolBar__second rlist"]//a[contains(@class, "pdf-download") and @title="Article PDF"]/@href',
+)
+
+# PDF link of an article DOI in the TOC-only mode
+PDF_URL_TEMPLATE = '/doi/pdf/{doi}'
+
+
 def remove_garbage(val):
     val = replace_escape_chars(val)
     val = replace_entities(val)
@@ -55,42 +71,48 @@ class WileyDownloadAuthLightSpider(scrapy.Spider):
     name = 'wiley_download_auth_light'
 
     custom_settings = {
-        'FILES_STORE': settings.get('JOURNALS_STORAGE'),
         'ITEM_PIPELINES': {
             'journal.pipelines.WileyPdfPipeline': 300,
         },
     }
 
-    def init_folders_path(self, folder_path):
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
+    @classmethod
+    def update_settings(cls, settings):
+        # Files go to JOURNALS_STORAGE of the crawl settings unless custom_settings say otherwise
+        settings.set('FILES_STORE', settings.get('JOURNALS_STORAGE'), priority='spider')
+        super(WileyDownloadAuthLightSpider, cls).update_settings(settings)
 
-    def save_to_log_csv(self, file_path, list_values):
-        row = dict(zip(LOG_HEADERS, list_values))
-        file_exists = os.path.exists(file_path)
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        # Settings of the crawl, not read when the spider module is imported
+        spider = super(WileyDownloadAuthLightSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.events = EventSink.from_settings(crawler.settings, LOG_FOLDER, LOG_HEADERS)
+        return spider
 
-        with open(file_path, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=LOG_HEADERS)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(row)
-
-    def __init__(self, limit_years=LIMIT_YEARS, limit_issues=LIMIT_ISSUES, limit_articles=LIMIT_ARTICLES, min_p=MIN_PAUSE_SECONDS, max_p=MAX_PAUSE_SECONDS, *args, **kwargs):
+    def __init__(self, limit_years=LIMIT_YEARS, limit_issues=LIMIT_ISSUES, limit_articles=LIMIT_ARTICLES, min_p=MIN_PAUSE_SECONDS, max_p=MAX_PAUSE_SECONDS, toc_only=TOC_ONLY, *args, **kwargs):
         super(WileyDownloadAuthLightSpider, self).__init__(*args, **kwargs)
-        self.settings = settings
         self.limit_years = limit_years
         self.limit_issues = limit_issues
         self.limit_articles = limit_articles
         self.min_p = min_p
         self.max_p = max_p
+        self.toc_only = str(toc_only).lower() in ('true', '1', 'yes')
         self.login_form_xpath = '//form[@id="mc1" and @action="/login"]'
-        self.init_folders_path(LOG_FOLDER)
+        self.ledger = DownloadLedger(LEDGER_FILE)
+
+    def closed(self, reason):
+        self.events.close()
+        self.ledger.close()
+
+    async def start(self):
+        for request in self.start_requests():
+            yield request
 
     def start_requests(self):
         with open(CSV_FILE_WITH_URLS) as csv_file:
             csv_reader = csv.DictReader(csv_file)
             start_urls = [line['Journal_URL'] for line in csv_reader]
-        yield scrapy.Request(start_urls[0], dont_filter=True, meta={'start_urls': start_urls}, callback=self.login_to_library)
+        yield scrapy.Request(start_urls[0], dont_filter=True, meta={'start_urls': start_urls, 'dont_relogin': True}, callback=self.login_to_library)
 
     def login_to_library(self, response):
         start_urls = response.meta['start_urls']
@@ -101,7 +123,7 @@ class WileyDownloadAuthLightSpider(scrapy.Spider):
                 'pass': self.settings['CREDENTIALS']['pass'],
             }
             # open_in_browser(response)
-            yield FormRequest.from_response(response, formxpath=self.login_form_xpath, formdata=credentials, meta={'start_urls': start_urls}, dont_filter=True, callback=self.parse_journals)
+            yield FormRequest.from_response(response, formxpath=self.login_form_xpath, formdata=credentials, meta={'start_urls': start_urls, 'dont_relogin': True}, dont_filter=True, callback=self.parse_journals)
         else:
             # If no login required
             # open_in_browser(response)
@@ -111,87 +133,109 @@ class WileyDownloadAuthLightSpider(scrapy.Spider):
         # open_in_browser(response)
         for journal_url in response.meta['start_urls']:
             # Pause between request to journals
-            sleep(randint(self.min_p, self.max_p))
-            yield scrapy.Request(journal_url, dont_filter=True, callback=self.parse_journal)
+            yield scrapy.Request(journal_url, dont_filter=True, meta={'pause': True, 'cache_page': 'journal'}, callback=self.parse_journal)
 
     def parse_journal(self, response):
         # open_in_browser(response)
-        meta = {
-            'journal_name': response.xpath('//h1[@id="journal-banner-text"]/text()').get(),
-        }
+        context = JournalContext(journal_name=XPATHS.get(response, 'journal_name'))
 
-        volumes = response.xpath('//ul[contains(@class, "loi__list")]//li/a')
+        volumes = XPATHS.select(response, 'volumes')
 
         # Log journal without content
         if not volumes:
-            self.save_to_log_csv(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [meta['journal_name'], response.meta.get('redirect_urls', [response.url])[0]])
-            print('>>>>>>>>>>>>>>> SAVING JOURNAL WITH NO CONTENT TO LOG ...')
+            self.events.log(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [context.journal_name, response.meta.get('redirect_urls', [response.url])[0]])
             return False
 
-        for volume in volumes[:self.limit_years]:
-            volume_title = volume.xpath('string(.)').get()
-            meta['volume_title'] = remove_garbage(volume_title)
-            yield response.follow(volume, callback=self.parse_volume, dont_filter=True, meta=meta)
+        for index, volume in enumerate(volumes[:self.limit_years]):
+            volume_title = XPATHS.get(volume, 'link_text')
+            yield response.follow(volume, callback=self.parse_volume, dont_filter=True, meta={
+                'context': context.child(volume_title=remove_garbage(volume_title)),
+                # Newest volume first, only it still gets new issues
+                'cache_page': 'closed_volume' if index else 'current_volume',
+            })
 
     def parse_volume(self, response):
         # open_in_browser(response)
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-        }
+        context = response.meta['context']
 
-        issues = response.xpath('//ul[contains(@class, "loi__issues")]//h4/a')
+        issues = XPATHS.select(response, 'issues')
 
         # Log journal without issues
         if not issues:
-            self.save_to_log_csv(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING JOURNAL WITHOUT ISSUES TO LOG ...')
+            self.events.log(LOG_FILE_JOURNAL_WITHOUT_ISSUES, [context.journal_name, response.url])
             return False
 
         for issue in issues[:self.limit_issues]:
             # Pause between issues
-            sleep(randint(self.min_p, self.max_p))
-            meta['issue_number'] = issue.xpath('string(.)').get()
-            yield response.follow(issue, callback=self.parse_issue, dont_filter=True, meta=meta)
+            yield response.follow(issue, callback=self.parse_issue, dont_filter=True, meta={
+                'context': context.child(issue_number=XPATHS.get(issue, 'link_text')),
+                'cache_page': response.meta['cache_page'],
+                'pause': True,
+            })
 
     def parse_issue(self, response):
         # open_in_browser(response)
-        meta = {
-            'journal_name': response.meta['journal_name'],
-            'volume_title': response.meta['volume_title'],
-            'issue_number': response.meta['issue_number'],
-        }
+        context = response.meta['context']
 
-        articles = response.xpath('//div[@class="issue-item"]/a[h2]')
+        articles = XPATHS.select(response, 'articles')
 
         # Log issue without articles
         if not articles:
-            self.save_to_log_csv(LOG_FILE_ISSUE_NO_ATRICLES, [meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING ISSUE WITHOUT ARTICLES TO LOG ...')
+            self.events.log(LOG_FILE_ISSUE_NO_ATRICLES, [context.journal_name, response.url])
             return False
 
         for article in articles[:self.limit_articles]:
+            article_url = response.urljoin(XPATHS.get(article, 'link_href'))
+            key = article_key(article_url)
+
+            # Skip article downloaded by previous run
+            if self.ledger.is_complete(key, need_ris=False):
+                self.crawler.stats.inc_value('ledger/skipped_articles')
+                continue
+
+            article_context = context.child(article_title=XPATHS.get(article, 'article_title'), article_key=key)
+
+            # PDF link from the DOI, the article page only if it fails (pdf_fallback_request)
+            doi = article_doi(article_url)
+            if self.toc_only and doi:
+                self.ledger.update(key, journal_name=context.journal_name, article_url=article_url)
+                item = self.make_item(article_context, response.urljoin(PDF_URL_TEMPLATE.format(doi=doi)))
+                item['pdf_fallback_url'] = article_url
+                yield item
+                continue
+
             # Pause between requsts to articles
-            sleep(randint(self.min_p, self.max_p))
-            meta['article_title'] = article.xpath('string(./h2)').get()
-            yield response.follow(article, callback=self.parse_article, dont_filter=True, meta=meta)
+            yield response.follow(article, callback=self.parse_article, dont_filter=True, meta={
+                'context': article_context,
+                'pause': True,
+            })
+
+    def pdf_fallback_request(self, item):
+        # Article page of a TOC-only PDF link which didn't work
+        context = JournalContext(journal_name=item['journal_name']).child(volume_title=item['volume_title'])
+        context = context.child(issue_number=item['issue_number']).child(article_title=item['article_title'], article_key=item['article_key'])
+        return scrapy.Request(item['pdf_fallback_url'], callback=self.parse_article, dont_filter=True, meta={'context': context, 'pause': True})
 
     def parse_article(self, response):
-        pdf_relative_url = response.xpath('//div[@class="coolBar__second rlist"]//a[contains(@class, "pdf-download") and @title="Article PDF"]/@href').get()
+        context = response.meta['context']
+        self.ledger.update(context.article_key, journal_name=context.journal_name, article_url=response.url)
+
+        pdf_relative_url = XPATHS.get(response, 'pdf_url')
 
         # Log article without pdf
         if not pdf_relative_url:
-            self.save_to_log_csv(LOG_FILE_ARTICLE_NO_PDF, [response.meta['journal_name'], response.url])
-            print('>>>>>>>>>>>>>>> SAVING ARTICLE WITHOUT PDF TO LOG ...')
+            self.ledger.update(context.article_key, pdf_status=STATUS_MISSING)
+            self.events.log(LOG_FILE_ARTICLE_NO_PDF, [context.journal_name, response.url])
             return False
 
-        pdf_url = response.urljoin(pdf_relative_url)
+        yield self.make_item(context, response.urljoin(pdf_relative_url))
 
+    def make_item(self, context, pdf_url):
         item = WileyItem()
-        item['journal_name'] = prevent_spec_chars(response.meta['journal_name'])
-        item['volume_title'] = prevent_spec_chars(response.meta['volume_title'])
-        item['issue_number'] = prevent_spec_chars(response.meta['issue_number'])
-        item['article_title'] = prevent_spec_chars(response.meta['article_title'])
+        item['journal_name'] = prevent_spec_chars(context.journal_name)
+        item['volume_title'] = prevent_spec_chars(context.volume_title)
+        item['issue_number'] = prevent_spec_chars(context.issue_number)
+        item['article_title'] = prevent_spec_chars(context.article_title)
+        item['article_key'] = context.article_key
         item['file_urls'] = [pdf_url]
-
-        yield item
+        return item
@@ -5,10 +5,10 @@ import os.path
 import re
 
 from scrapy import FormRequest
-from scrapy.utils.project import get_project_settings
 from scrapy.utils.response import open_in_browser
-from time import sleep
-from random import randint
+
+from journal.events import EventSink
+from journal.snapshot import DisciplineSnapshot, entry_fingerprint, snapshot_key
 
 
 # Spider folders
@@ -16,18 +16,17 @@ ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__fil
 
 # User configuration parameters
 LIMIT_DISCIPLINE_JOURNALS = None
+DELTA = False  # True - follow only journals new or changed since the previous run
 MIN_PAUSE_SECONDS = 1
 MAX_PAUSE_SECONDS = 2
 CSV_FILE_WITH_URLS = os.path.join(ROOT_DIR, 'discipline_input_wiley.csv')
+SNAPSHOT_FILE = os.path.join(ROOT_DIR, 'wiley_discipline_snapshot.sqlite')
 
 # Log configuration
 LOG_HEADERS = ['Journal_Name', 'URL']
 LOG_FOLDER = os.path.join(ROOT_DIR, 'logs')
 LOG_FILE_NO_CONTENT = os.path.join(LOG_FOLDER, 'taylor_francis_discipline_no_content.csv')
 
-# Spider settings
-settings = get_project_settings()
-
 
 class WileyScrapeDiscilineSpider(scrapy.Spider):
     name = 'wiley_scrape_disciline'
@@ -47,30 +46,32 @@ class WileyScrapeDiscilineSpider(scrapy.Spider):
         ],
     }
 
-    def init_folders_path(self, folder_path):
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-
-    def save_to_log_csv(self, file_path, list_values):
-        row = dict(zip(LOG_HEADERS, list_values))
-        file_exists = os.path.exists(file_path)
-
-        with open(file_path, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=LOG_HEADERS)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(row)
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        # Settings of the crawl, not read when the spider module is imported
+        spider = super(WileyScrapeDiscilineSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.events = EventSink.from_settings(crawler.settings, LOG_FOLDER, LOG_HEADERS)
+        return spider
 
     # def __init__(self, limit_discipline_journals=LIMIT_DISCIPLINE_JOURNALS, *args, **kwargs):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, delta=DELTA, *args, **kwargs):
         super(WileyScrapeDiscilineSpider, self).__init__(*args, **kwargs)
-        self.settings = settings
+        # Spider arguments from command line come as strings
+        self.delta = str(delta).lower() in ('true', '1', 'yes')
         # self.limit_discipline_journals = limit_discipline_journals
         self.limit_discipline_journals = LIMIT_DISCIPLINE_JOURNALS
         self.min_p = MIN_PAUSE_SECONDS
         self.max_p = MAX_PAUSE_SECONDS
         self.login_form_xpath = '//form[@id="mc1" and @action="/login"]'
-        self.init_folders_path(LOG_FOLDER)
+        self.snapshot = DisciplineSnapshot(SNAPSHOT_FILE)
+
+    def closed(self, reason):
+        self.events.close()
+        self.snapshot.close()
+
+    async def start(self):
+        for request in self.start_requests():
+            yield request
 
     def start_requests(self):
         with open(CSV_FILE_WITH_URLS) as csv_file:
@@ -81,7 +82,7 @@ class WileyScrapeDiscilineSpider(scrapy.Spider):
                 'Discipline_Name': line['Discipline_Name'],
             } for line in csv_reader]
 
-        yield scrapy.Request(csv_lines[0]['Discipline URL'], dont_filter=True, meta={'csv_lines': csv_lines}, callback=self.login_to_library)
+        yield scrapy.Request(csv_lines[0]['Discipline URL'], dont_filter=True, meta={'csv_lines': csv_lines, 'dont_relogin': True}, callback=self.login_to_library)
 
     def login_to_library(self, response):
         # open_in_browser(response)
@@ -93,7 +94,7 @@ class WileyScrapeDiscilineSpider(scrapy.Spider):
                 'user': self.settings['CREDENTIALS']['user'],
                 'pass': self.settings['CREDENTIALS']['pass'],
             }
-            yield FormRequest.from_response(response, formxpath=self.login_form_xpath, formdata=credentials, meta={'csv_lines': csv_lines}, dont_filter=True, callback=self.parse_csv_lines)
+            yield FormRequest.from_response(response, formxpath=self.login_form_xpath, formdata=credentials, meta={'csv_lines': csv_lines, 'dont_relogin': True}, dont_filter=True, callback=self.parse_csv_lines)
         else:
             # If no login required
             yield scrapy.Request(response.url, dont_filter=True, meta={'csv_lines': csv_lines}, callback=self.parse_csv_lines)
@@ -120,14 +121,10 @@ class WileyScrapeDiscilineSpider(scrapy.Spider):
 
         # Log if discipline search is empty
         if not journals:
-            self.save_to_log_csv(LOG_FILE_NO_CONTENT, [meta['Discipline_Name'], response.meta.get('redirect_urls', [response.url])[0]])
-            print('>>>>>>>>>>>>>>> SAVING DISCIPLINE WITH NO CONTENT TO LOG ...')
+            self.events.log(LOG_FILE_NO_CONTENT, [meta['Discipline_Name'], response.meta.get('redirect_urls', [response.url])[0]])
             return False
 
         for journal in journals[:self.limit_discipline_journals]:
-            # Pause between request to journals
-            sleep(randint(self.min_p, self.max_p))
-
             currently_known_as = journal.xpath('.//span[contains(@class, "meta__title__currentVersion")]/a')
             if currently_known_as:
                 meta['Currently_known_as'] = currently_known_as.xpath('string(.)').get()
@@ -146,7 +143,17 @@ class WileyScrapeDiscilineSpider(scrapy.Spider):
             meta['Start_Year'] = start_year.get() if start_year else None
             meta['Latest_Year'] = latest_year.get() if latest_year else None
 
-            yield response.follow(journal_href, dont_filter=True, meta=meta, callback=self.parse_journal)
+            # Emit journal from the previous run if its search result entry is the same
+            key = snapshot_key(meta['Discipline_Tree'], meta['Discipline_Name'], response.urljoin(journal_href))
+            fingerprint = entry_fingerprint(journal_href, meta['Journal_Name'], meta['Currently_known_as'], meta['Start_Year'], meta['Latest_Year'])
+            if self.delta:
+                item = self.snapshot.unchanged_item(key, fingerprint)
+                if item is not None:
+                    self.crawler.stats.inc_value('snapshot/unchanged')
+                    yield item
+                    continue
+
+            yield response.follow(journal_href, dont_filter=True, meta=dict(meta, pause=True, snapshot_key=key, snapshot_fingerprint=fingerprint), callback=self.parse_journal)
 
         # Pagination: Next page
         next_page = response.xpath('//div[@class="pagination"]/span/a[@title="Next page"]')
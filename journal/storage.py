@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Files stores for the PDF pipelines
+#
+# See documentation in:
+# https://doc.scrapy.org/en/latest/topics/media-pipeline.html
+
+import csv
+import hashlib
+import os
+import os.path
+from pathlib import Path
+
+from scrapy.pipelines.files import FSFilesStore
+
+BLOBS_FOLDER = '.blobs'
+PARTIAL_FOLDER = '.partial'
+MANIFEST_FILE = 'manifest.csv'
+MANIFEST_HEADERS = ['Path', 'SHA256']
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class JournalFilesStore(FSFilesStore):
+    # Files store which also takes bodies already streamed to a temp file
+
+    def persist_temp_file(self, path, temp_path, info, digest=None):
+        absolute_path = self._get_filesystem_path(path)
+        self._mkdir(absolute_path.parent, info)
+        os.replace(temp_path, absolute_path)
+
+    def stored_path(self, path):
+        # File on disk holding the body of path
+        return self._get_filesystem_path(path)
+
+
+class ContentAddressedFilesStore(JournalFilesStore):
+    # Each unique file body is written once under .blobs/<sha256[:2]>/<sha256>.<ext>.
+    # The journal/year/issue/file_name paths are hardlinks to the blob, and
+    # every path is also recorded in manifest.csv, which is what resolves the
+    # path when the file system can't hardlink.
+
+    def __init__(self, basedir):
+        super(ContentAddressedFilesStore, self).__init__(basedir)
+        self.blobs_dir = os.path.join(self.basedir, BLOBS_FOLDER)
+        self.manifest_path = os.path.join(self.basedir, MANIFEST_FILE)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, newline='', encoding='utf-8') as f:
+            return {row['Path']: row['SHA256'] for row in csv.DictReader(f)}
+
+    def save_to_manifest(self, path, digest):
+        if self.manifest.get(path) == digest:
+            return
+        file_exists = os.path.exists(self.manifest_path)
+        with open(self.manifest_path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_HEADERS)
+            if not file_exists:
+                writer.writeheader()
+            writer.writerow({'Path': path, 'SHA256': digest})
+        self.manifest[path] = digest
+
+    def get_blob_path(self, digest, path):
+        extension = os.path.splitext(path)[1]
+        return os.path.join(self.blobs_dir, digest[:2], digest + extension)
+
+    def stored_path(self, path):
+        # The blob when the journal tree path is only in the manifest (no hardlink)
+        absolute_path = self._get_filesystem_path(path)
+        if path in self.manifest and not os.path.exists(absolute_path):
+            return self.get_blob_path(self.manifest[path], path)
+        return absolute_path
+
+    def inc_stats(self, info, key, count=1):
+        if info is not None:
+            info.spider.crawler.stats.inc_value('files_store/' + key, count)
+
+    def persist_file(self, path, buf, info, meta=None, headers=None):
+        data = buf.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.get_blob_path(digest, path)
+
+        if os.path.exists(blob_path):
+            self.inc_stats(info, 'deduplicated')
+        else:
+            self._mkdir(Path(blob_path).parent, info)
+            temp_path = blob_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, blob_path)
+            self.inc_stats(info, 'blobs')
+            self.inc_stats(info, 'blob_bytes', len(data))
+
+        self.link_blob(blob_path, path, info)
+        self.save_to_manifest(path, digest)
+
+    def persist_temp_file(self, path, temp_path, info, digest=None):
+        if digest is None:
+            digest = file_sha256(temp_path)
+        blob_path = self.get_blob_path(digest, path)
+
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+            self.inc_stats(info, 'deduplicated')
+        else:
+            self._mkdir(Path(blob_path).parent, info)
+            self.inc_stats(info, 'blobs')
+            self.inc_stats(info, 'blob_bytes', os.path.getsize(temp_path))
+            os.replace(temp_path, blob_path)
+
+        self.link_blob(blob_path, path, info)
+        self.save_to_manifest(path, digest)
+
+    def link_blob(self, blob_path, path, info):
+        absolute_path = self._get_filesystem_path(path)
+        self._mkdir(absolute_path.parent, info)
+
+        if os.path.exists(absolute_path):
+            if os.path.samefile(absolute_path, blob_path):
+                return
+            os.remove(absolute_path)
+
+        try:
+            os.link(blob_path, absolute_path)
+        except OSError:
+            # No hardlinks on this file system, manifest keeps the path
+            self.inc_stats(info, 'manifest_only')
+
+    def stat_file(self, path, info):
+        result = super(ContentAddressedFilesStore, self).stat_file(path, info)
+        if result or path not in self.manifest:
+            return result
+        return super(ContentAddressedFilesStore, self).stat_file(
+            os.path.relpath(self.get_blob_path(self.manifest[path], path), self.basedir).replace(os.sep, '/'),
+            info,
+        )
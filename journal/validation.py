@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# PDF body checks of the files pipelines (PDF_VALIDATION_ENABLED)
+#
+# A lapsed proxy session, a viewer page or a dropped connection answer a PDF
+# link with something else: an HTML page, an empty or cut short body. The
+# checks run on the body as it arrives, so a download is stopped as soon as
+# it can't be a PDF instead of being saved under <article_title>.pdf:
+#
+#   validator = PdfValidator.from_settings(settings)
+#   reason = validator.check_headers(headers)     # Content-Type
+#   reason = validator.feed(chunk)                # %PDF- in the first KB
+#   reason = validator.finish()                   # size and %%EOF trailer
+#
+# Every method answers None while the body looks fine, else the reason of
+# the rejection (one of the REASON_* values), kept by the validator.
+
+PDF_MAGIC = b'%PDF-'
+PDF_EOF = b'%%EOF'
+# Readers accept junk before the header and after the trailer in this many bytes
+PDF_HEAD_SIZE = 1024
+PDF_TAIL_SIZE = 1024
+
+REASON_CONTENT_TYPE = 'content-type'
+REASON_HTML = 'html-page'
+REASON_NOT_PDF = 'not-pdf'
+REASON_TOO_SMALL = 'too-small'
+REASON_TRUNCATED = 'truncated'
+
+
+class InvalidPdf(Exception):
+    # Download stopped by the checks, reason is one of the REASON_* values.
+    # Not an IOError, RetryMiddleware doesn't retry it without a re-login
+
+    def __init__(self, reason, url):
+        super(InvalidPdf, self).__init__('Invalid PDF ({}) from {}'.format(reason, url))
+        self.reason = reason
+        self.url = url
+
+
+class PdfValidator(object):
+    # Checks of one download, fed with the body chunks in order
+
+    def __init__(self, min_size=0, content_types=()):
+        self.min_size = min_size
+        self.content_types = [content_type.lower() for content_type in content_types]
+        self.head = b''
+        self.tail = b''
+        self.size = 0
+        self.started = False
+        self.reason = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('PDF_MIN_SIZE'), settings.getlist('PDF_CONTENT_TYPES'))
+
+    def fail(self, reason):
+        if self.reason is None:
+            self.reason = reason
+        return self.reason
+
+    def check_headers(self, headers):
+        # A missing Content-Type is left to the body checks
+        content_type = headers.get(b'Content-Type')
+        if not content_type or not self.content_types:
+            return self.reason
+        content_type = content_type.decode('latin1').split(';')[0].strip().lower()
+        if 'html' in content_type:
+            return self.fail(REASON_HTML)
+        if content_type not in self.content_types:
+            return self.fail(REASON_CONTENT_TYPE)
+        return self.reason
+
+    def feed(self, data):
+        if self.reason is not None:
+            return self.reason
+        self.size += len(data)
+        if not self.started:
+            self.head += data[:PDF_HEAD_SIZE - len(self.head)]
+            if PDF_MAGIC in self.head:
+                self.started = True
+            elif self.head.lstrip()[:1] == b'<':
+                # Markup, no need to wait for the rest
+                return self.fail(REASON_HTML)
+            elif len(self.head) >= PDF_HEAD_SIZE:
+                return self.fail(REASON_NOT_PDF)
+        self.tail = (self.tail + data[-PDF_TAIL_SIZE:])[-PDF_TAIL_SIZE:]
+        return None
+
+    def finish(self):
+        if self.reason is not None:
+            return self.reason
+        if not self.started:
+            return self.fail(REASON_NOT_PDF)
+        if self.size < self.min_size:
+            return self.fail(REASON_TOO_SMALL)
+        if PDF_EOF not in self.tail:
+            return self.fail(REASON_TRUNCATED)
+        return None
+
+    def check(self, headers, body):
+        # Whole body at once (downloads which were not streamed)
+        self.check_headers(headers)
+        self.feed(body)
+        return self.finish()